@@ -4,11 +4,20 @@ API для генерации и активации кодов доступа к
 """
 import json
 import os
+import hashlib
+import time
+import jwt
 import psycopg2
-import random
+from psycopg2 import extensions, pool
+from collections import OrderedDict
+from contextlib import contextmanager
+import csv
+import io
+import secrets
 import string
+import uuid
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Dict, List, Tuple
 
 
 def get_env(key: str, default: str = "") -> str:
@@ -16,10 +25,75 @@ def get_env(key: str, default: str = "") -> str:
     return os.environ.get(key, default)
 
 
-def get_db_connection():
-    """Создать подключение к базе данных"""
-    dsn = get_env("DATABASE_URL")
-    return psycopg2.connect(dsn)
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(get_env("DB_POOL_MIN_SIZE", "1")),
+            int(get_env("DB_POOL_MAX_SIZE", "5")),
+            get_env("DATABASE_URL")
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(get_env("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(get_env("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
 
 
 def cors_response(status_code: int, body: dict) -> dict:
@@ -36,25 +110,122 @@ def cors_response(status_code: int, body: dict) -> dict:
     }
 
 
+JWT_SECRET = get_env("JWT_SECRET")
+JWT_CACHE_MAX_SIZE = int(get_env("JWT_CACHE_MAX_SIZE", "1024"))
+JWT_CACHE_TTL = float(get_env("JWT_CACHE_TTL", "300"))
+
+_jwt_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+jwt_cache_stats = {"hits": 0, "misses": 0}
+
+
 def verify_jwt(token: str) -> Optional[int]:
-    """Проверка JWT токена и извлечение user_id"""
+    """
+    Проверка JWT токена и извлечение user_id.
+    Расшифрованные токены кэшируются (LRU по SHA-256 токена) до истечения
+    exp, но не дольше JWT_CACHE_TTL секунд.
+    """
     if not token:
         return None
     
-    import jwt
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    
+    cached = _jwt_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _jwt_cache.move_to_end(token_hash)
+        jwt_cache_stats["hits"] += 1
+        return cached[0]
+    
+    jwt_cache_stats["misses"] += 1
+    _jwt_cache.pop(token_hash, None)
+    
     try:
-        jwt_secret = get_env("JWT_SECRET")
-        payload = jwt.decode(token, jwt_secret, algorithms=["HS256"])
-        return payload.get("user_id")
-    except:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except jwt.PyJWTError:
         return None
+    
+    user_id = payload.get("user_id")
+    if user_id:
+        expires_at = min(payload.get("exp", now + JWT_CACHE_TTL), now + JWT_CACHE_TTL)
+        _jwt_cache[token_hash] = (user_id, expires_at)
+        if len(_jwt_cache) > JWT_CACHE_MAX_SIZE:
+            _jwt_cache.popitem(last=False)
+    return user_id
+
+
+CODE_LENGTH = 8
+# Без похожих друг на друга O/0 и I/1
+CODE_ALPHABET = ''.join(
+    c for c in string.ascii_uppercase + string.digits if c not in 'O0I1'
+)
+CODE_INSERT_ATTEMPTS = 5
+MAX_BULK_CODES = int(get_env("MAX_BULK_CODES", "10000"))
+MAX_CODE_EXPIRY_DAYS = int(get_env("MAX_CODE_EXPIRY_DAYS", "3650"))
+EXPORT_FETCH_SIZE = 2000
+
+# Администраторы кодов активации: id пользователей через запятую
+ACTIVATION_ADMIN_USER_IDS = frozenset(
+    int(value) for value in get_env("ACTIVATION_ADMIN_USER_IDS").split(",") if value.strip().isdigit()
+)
 
 
 def generate_code() -> str:
-    """Сгенерировать уникальный код активации (8 символов)"""
-    chars = string.ascii_uppercase + string.digits
-    chars = chars.replace('O', '').replace('0', '').replace('I', '').replace('1')
-    return ''.join(random.choices(chars, k=8))
+    """Сгенерировать код активации (8 символов)"""
+    return ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+
+
+def insert_codes(cursor, count: int, expires_at: datetime, issued_by: int,
+                 batch_id: Optional[str] = None) -> List[Tuple]:
+    """
+    Создать count уникальных кодов: кандидаты вставляются одним запросом,
+    совпавшие с существующими отбрасывает ON CONFLICT DO NOTHING, недостающие
+    догенерируются следующей попыткой. Возвращает строки (id, code, created_at).
+    """
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    created = []
+    
+    for _ in range(CODE_INSERT_ATTEMPTS):
+        missing = count - len(created)
+        if missing <= 0:
+            break
+        
+        candidates = set()
+        while len(candidates) < missing:
+            candidates.add(generate_code())
+        
+        cursor.execute(f"""
+            INSERT INTO {schema}.activation_codes (code, expires_at, issued_by, batch_id)
+            SELECT candidate, %s, %s, %s
+            FROM unnest(%s::varchar[]) AS candidate
+            ON CONFLICT (code) DO NOTHING
+            RETURNING id, code, created_at
+        """, (expires_at, issued_by, batch_id, list(candidates)))
+        created.extend(cursor.fetchall())
+    
+    return created
+
+
+def can_issue_batches(cursor, user_id: int) -> bool:
+    """Выпускать и выгружать пачки кодов могут администраторы кодов и действующие бухгалтеры"""
+    if user_id in ACTIVATION_ADMIN_USER_IDS:
+        return True
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    cursor.execute(f"""
+        SELECT 1 FROM {schema}.accountants
+        WHERE user_id = %s AND is_active
+        LIMIT 1
+    """, (user_id,))
+    return cursor.fetchone() is not None
+
+
+def parse_expires_in_days(body: dict) -> Optional[int]:
+    """Срок действия кода в днях (по умолчанию 30); None, если значение некорректно"""
+    value = body.get('expires_in_days', 30)
+    if isinstance(value, bool) or not isinstance(value, int):
+        return None
+    if value < 1 or value > MAX_CODE_EXPIRY_DAYS:
+        return None
+    return value
 
 
 def create_activation_code(event: dict) -> dict:
@@ -77,54 +248,182 @@ def create_activation_code(event: dict) -> dict:
     except:
         body = {}
     
-    expires_in_days = body.get('expires_in_days', 30)
+    expires_in_days = parse_expires_in_days(body)
+    if expires_in_days is None:
+        return cors_response(400, {"error": f"expires_in_days must be an integer between 1 and {MAX_CODE_EXPIRY_DAYS}"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        
-        # Генерировать уникальный код
-        max_attempts = 10
-        code = None
-        
-        for _ in range(max_attempts):
-            candidate = generate_code()
-            cursor.execute(f"""
-                SELECT id FROM {schema}.activation_codes
-                WHERE code = %s
-            """, (candidate,))
+        with db_connection() as conn:
+            cursor = conn.cursor()
             
-            if not cursor.fetchone():
-                code = candidate
-                break
-        
-        if not code:
+            # Создать код
+            expires_at = datetime.now() + timedelta(days=expires_in_days)
+            created = insert_codes(cursor, 1, expires_at, user_id)
+            
+            if not created:
+                cursor.close()
+                return cors_response(500, {"error": "Failed to generate unique code"})
+            
+            code_id, code, created_at = created[0]
+            conn.commit()
             cursor.close()
-            conn.close()
-            return cors_response(500, {"error": "Failed to generate unique code"})
-        
-        # Создать код
-        expires_at = datetime.now() + timedelta(days=expires_in_days)
-        
-        cursor.execute(f"""
-            INSERT INTO {schema}.activation_codes (code, expires_at)
-            VALUES (%s, %s)
-            RETURNING id, created_at
-        """, (code, expires_at))
-        
-        code_id, created_at = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return cors_response(201, {
-            "success": True,
-            "code": code,
-            "expires_at": expires_at.isoformat(),
-            "created_at": created_at.isoformat() if created_at else None
-        })
-        
+            
+            return cors_response(201, {
+                "success": True,
+                "code": code,
+                "expires_at": expires_at.isoformat(),
+                "created_at": created_at.isoformat() if created_at else None
+            })
+            
+    except Exception as e:
+        return cors_response(500, {"error": f"Database error: {str(e)}"})
+
+
+def csv_response(file_name: str, content: str) -> dict:
+    """Ответ с CSV файлом"""
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'text/csv; charset=utf-8',
+            'Content-Disposition': f'attachment; filename="{file_name}"',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, X-Authorization'
+        },
+        'body': content
+    }
+
+
+def write_codes_csv(rows) -> str:
+    """CSV с кодами: code, expires_at, created_at"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["code", "expires_at", "created_at"])
+    for code, expires_at, created_at in rows:
+        writer.writerow([
+            code,
+            expires_at.isoformat() if expires_at else "",
+            created_at.isoformat() if created_at else ""
+        ])
+    return output.getvalue()
+
+
+def create_activation_codes_bulk(event: dict) -> dict:
+    """
+    POST /activation?action=bulk
+    Выпустить пачку кодов для корпоративного подключения одним запросом
+    Body: {"count": 500, "expires_in_days": 30, "format": "csv"}
+    Ответ - CSV с кодами (format=csv, по умолчанию; файл целиком в теле ответа)
+    или JSON с batch_id. Доступно администраторам кодов и бухгалтерам.
+    """
+    # Авторизация
+    auth_header = event.get('headers', {}).get('X-Authorization', '')
+    token = auth_header.replace('Bearer ', '') if auth_header else ''
+    user_id = verify_jwt(token)
+    
+    if not user_id:
+        return cors_response(401, {"error": "Unauthorized"})
+    
+    # Парсинг запроса
+    try:
+        body = json.loads(event.get('body', '{}'))
+    except:
+        return cors_response(400, {"error": "Invalid JSON"})
+    
+    try:
+        count = int(body.get('count', 0))
+    except (TypeError, ValueError):
+        count = 0
+    if count < 1 or count > MAX_BULK_CODES:
+        return cors_response(400, {"error": f"count must be between 1 and {MAX_BULK_CODES}"})
+    
+    expires_in_days = parse_expires_in_days(body)
+    if expires_in_days is None:
+        return cors_response(400, {"error": f"expires_in_days must be an integer between 1 and {MAX_CODE_EXPIRY_DAYS}"})
+    
+    batch_id = str(uuid.uuid4())
+    
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            if not can_issue_batches(cursor, user_id):
+                cursor.close()
+                return cors_response(403, {"error": "Forbidden"})
+            
+            expires_at = datetime.now() + timedelta(days=expires_in_days)
+            created = insert_codes(cursor, count, expires_at, user_id, batch_id)
+            
+            if len(created) < count:
+                cursor.close()
+                return cors_response(500, {"error": "Failed to generate unique codes"})
+            
+            conn.commit()
+            cursor.close()
+            
+    except Exception as e:
+        return cors_response(500, {"error": f"Database error: {str(e)}"})
+    
+    if body.get('format', 'csv') == 'csv':
+        return csv_response(
+            f"activation_codes_{batch_id}.csv",
+            write_codes_csv((code, expires_at, created_at) for _, code, created_at in created)
+        )
+    
+    return cors_response(201, {
+        "success": True,
+        "batch_id": batch_id,
+        "count": len(created),
+        "expires_at": expires_at.isoformat()
+    })
+
+
+def export_activation_codes(event: dict) -> dict:
+    """
+    GET /activation?action=export&batch_id=...
+    Выгрузить коды пачки в CSV. Бухгалтер выгружает свои пачки,
+    администратор кодов - любые. Строки читаются из БД серверным курсором
+    порциями, CSV собирается в памяти и отдаётся одним телом ответа.
+    """
+    # Авторизация
+    auth_header = event.get('headers', {}).get('X-Authorization', '')
+    token = auth_header.replace('Bearer ', '') if auth_header else ''
+    user_id = verify_jwt(token)
+    
+    if not user_id:
+        return cors_response(401, {"error": "Unauthorized"})
+    
+    params = event.get('queryStringParameters', {}) or {}
+    try:
+        batch_id = str(uuid.UUID(params.get('batch_id', '')))
+    except ValueError:
+        return cors_response(400, {"error": "Invalid batch_id"})
+    
+    try:
+        with db_connection() as conn:
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            
+            with conn.cursor() as cursor:
+                if not can_issue_batches(cursor, user_id):
+                    return cors_response(403, {"error": "Forbidden"})
+            
+            # Администратор выгружает пачку любого эмитента
+            issuer_filter, values = "AND issued_by = %s", (batch_id, user_id)
+            if user_id in ACTIVATION_ADMIN_USER_IDS:
+                issuer_filter, values = "", (batch_id,)
+            
+            with conn.cursor(name=f"export_{batch_id.replace('-', '')}") as cursor:
+                cursor.itersize = EXPORT_FETCH_SIZE
+                cursor.execute(f"""
+                    SELECT code, expires_at, created_at
+                    FROM {schema}.activation_codes
+                    WHERE batch_id = %s {issuer_filter}
+                    ORDER BY id
+                """, values)
+                content = write_codes_csv(cursor)
+            
+            return csv_response(f"activation_codes_{batch_id}.csv", content)
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
@@ -154,53 +453,43 @@ def activate_code(event: dict) -> dict:
         return cors_response(400, {"error": "Code is required"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        
-        # Проверить код
-        cursor.execute(f"""
-            SELECT id, user_id, used_at, expires_at
-            FROM {schema}.activation_codes
-            WHERE code = %s
-        """, (code,))
-        
-        row = cursor.fetchone()
-        if not row:
-            cursor.close()
-            conn.close()
-            return cors_response(404, {"error": "Code not found"})
-        
-        code_id, existing_user_id, used_at, expires_at = row
-        
-        # Проверка использования
-        if used_at:
-            cursor.close()
-            conn.close()
-            return cors_response(400, {"error": "Code already used"})
-        
-        # Проверка срока действия
-        if expires_at < datetime.now():
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            
+            # Активировать код одним условным UPDATE: из двух одновременных
+            # активаций строку получит только одна
+            cursor.execute(f"""
+                UPDATE {schema}.activation_codes
+                SET user_id = %s, used_at = CURRENT_TIMESTAMP
+                WHERE code = %s AND used_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+                RETURNING id
+            """, (user_id, code))
+            
+            if not cursor.fetchone():
+                # Медленный путь: выяснить, почему код не активирован
+                cursor.execute(f"""
+                    SELECT used_at
+                    FROM {schema}.activation_codes
+                    WHERE code = %s
+                """, (code,))
+                
+                row = cursor.fetchone()
+                cursor.close()
+                if not row:
+                    return cors_response(404, {"error": "Code not found"})
+                if row[0]:
+                    return cors_response(400, {"error": "Code already used"})
+                return cors_response(400, {"error": "Code expired"})
+            
+            conn.commit()
             cursor.close()
-            conn.close()
-            return cors_response(400, {"error": "Code expired"})
-        
-        # Активировать код
-        cursor.execute(f"""
-            UPDATE {schema}.activation_codes
-            SET user_id = %s, used_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (user_id, code_id))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {
-            "success": True,
-            "message": "Code activated successfully"
-        })
-        
+            
+            return cors_response(200, {
+                "success": True,
+                "message": "Code activated successfully"
+            })
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
@@ -208,7 +497,9 @@ def activate_code(event: dict) -> dict:
 def get_user_codes(event: dict) -> dict:
     """
     GET /activation
-    Получить список кодов пользователя
+    Получить список кодов пользователя: активированные им
+    и выпущенные им действующие коды. Администратор кодов видит также
+    действующие коды, выпущенные до учёта эмитента (issued_by IS NULL).
     """
     # Авторизация
     auth_header = event.get('headers', {}).get('X-Authorization', '')
@@ -219,32 +510,51 @@ def get_user_codes(event: dict) -> dict:
         return cors_response(401, {"error": "Unauthorized"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        
-        cursor.execute(f"""
-            SELECT code, used_at, expires_at, created_at
-            FROM {schema}.activation_codes
-            WHERE user_id = %s OR (user_id IS NULL AND expires_at > CURRENT_TIMESTAMP)
-            ORDER BY created_at DESC
-        """, (user_id,))
-        
-        codes = []
-        for row in cursor.fetchall():
-            codes.append({
-                "code": row[0],
-                "used_at": row[1].isoformat() if row[1] else None,
-                "expires_at": row[2].isoformat() if row[2] else None,
-                "created_at": row[3].isoformat() if row[3] else None,
-                "is_active": row[1] is None and row[2] > datetime.now()
-            })
-        
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {"codes": codes})
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            
+            # Активированные пользователем коды и выпущенные им, ещё не
+            # активированные - две ветки, каждая читается своим индексом
+            legacy_branch = ""
+            if user_id in ACTIVATION_ADMIN_USER_IDS:
+                # Эмитент старых кодов неизвестен - их видит администратор
+                legacy_branch = f"""
+                UNION ALL
+                SELECT code, used_at, expires_at, created_at
+                FROM {schema}.activation_codes
+                WHERE issued_by IS NULL
+                  AND user_id IS NULL AND used_at IS NULL
+                  AND expires_at > CURRENT_TIMESTAMP
+                """
+            cursor.execute(f"""
+                SELECT code, used_at, expires_at, created_at
+                FROM {schema}.activation_codes
+                WHERE user_id = %s
+                UNION ALL
+                SELECT code, used_at, expires_at, created_at
+                FROM {schema}.activation_codes
+                WHERE issued_by = %s
+                  AND user_id IS NULL AND used_at IS NULL
+                  AND expires_at > CURRENT_TIMESTAMP
+                {legacy_branch}
+                ORDER BY created_at DESC
+            """, (user_id, user_id))
+            
+            codes = []
+            for row in cursor.fetchall():
+                codes.append({
+                    "code": row[0],
+                    "used_at": row[1].isoformat() if row[1] else None,
+                    "expires_at": row[2].isoformat() if row[2] else None,
+                    "created_at": row[3].isoformat() if row[3] else None,
+                    "is_active": row[1] is None and row[2] > datetime.now()
+                })
+            
+            cursor.close()
+            
+            return cors_response(200, {"codes": codes})
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
@@ -254,7 +564,9 @@ def handler(event: dict, context) -> dict:
     Главный обработчик для кодов активации.
     POST /activation - создать код
     POST /activation?action=activate - активировать код
+    POST /activation?action=bulk - выпустить пачку кодов (CSV, администраторы и бухгалтеры)
     GET /activation - список кодов пользователя
+    GET /activation?action=export&batch_id=... - CSV пачки кодов
     """
     method = event.get('httpMethod', 'GET')
     
@@ -268,9 +580,14 @@ def handler(event: dict, context) -> dict:
         
         if action == 'activate':
             return activate_code(event)
+        elif action == 'bulk':
+            return create_activation_codes_bulk(event)
         else:
             return create_activation_code(event)
     elif method == 'GET':
+        params = event.get('queryStringParameters', {}) or {}
+        if params.get('action') == 'export':
+            return export_activation_codes(event)
         return get_user_codes(event)
     else:
         return cors_response(405, {"error": "Method not allowed"})
@@ -1,11 +1,520 @@
 import json
 import os
+import random
+import re
+import time
+import uuid
+import hashlib
+import threading
 import psycopg2
+from psycopg2 import extensions, pool
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Optional, Dict, List, Tuple, Iterator
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "512"))
+
+# Экземпляр функции обслуживает один запрос за раз, поэтому контекст лога
+# хранится в состоянии модуля
+_log_context: Dict[str, Any] = {"request_id": None, "sampled": True}
+
+
+def start_request_log(event: dict, context) -> None:
+    """
+    Запомнить id запроса для строк лога и решить, попадает ли запрос в выборку:
+    DEBUG/INFO пишутся для доли LOG_SAMPLE_RATE запросов, WARNING и ERROR всегда
+    """
+    request_id = (
+        getattr(context, "request_id", None)
+        or (event.get("requestContext") or {}).get("requestId")
+        or uuid.uuid4().hex
+    )
+    _log_context["request_id"] = request_id
+    _log_context["sampled"] = random.random() < LOG_SAMPLE_RATE
+
+
+def log_enabled(level: str) -> bool:
+    """Дешёвая проверка перед сборкой дорогих полей лога"""
+    level_no = LOG_LEVELS[level]
+    if level_no < LOG_LEVEL:
+        return False
+    return level_no >= LOG_LEVELS["WARNING"] or _log_context["sampled"]
+
+
+def _log_field(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if len(text) > LOG_MAX_FIELD_CHARS:
+        return text[:LOG_MAX_FIELD_CHARS] + f"...(+{len(text) - LOG_MAX_FIELD_CHARS} chars)"
+    return text
+
+
+def _write_log(level: str, message: str, fields: Dict[str, Any]) -> None:
+    record = {"level": level, "msg": message, "request_id": _log_context["request_id"]}
+    for key, value in fields.items():
+        record[key] = _log_field(value)
+    print(json.dumps(record, ensure_ascii=False))
+
+
+def log(level: str, message: str, **fields: Any) -> None:
+    """Одна строка лога в JSON; поля длиннее LOG_MAX_FIELD_CHARS обрезаются"""
+    if log_enabled(level):
+        _write_log(level, message, fields)
+
+
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            int(os.environ.get("DB_POOL_MAX_SIZE", "5")),
+            os.environ["DATABASE_URL"]
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(os.environ.get("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(os.environ.get("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+
+
+SYSTEM_PROMPT = """Ты - профессиональный бухгалтерский помощник для аграриев и малого бизнеса в России. 
+    Твоя задача:
+    - Консультировать по вопросам бухучета, налогов, отчетности
+    - Помогать с ФГИС Зерно, Меркурий, субсидиями
+    - Напоминать о сроках сдачи отчетов
+    - Давать практические советы по оптимизации налогов
+    - Объяснять простым языком сложные бухгалтерские вопросы
+
+    Отвечай кратко, по делу, профессионально но дружелюбно."""
+
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', '86400'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '512'))
+RESPONSE_CACHE_MAX_QUESTION_CHARS = int(os.environ.get('RESPONSE_CACHE_MAX_QUESTION_CHARS', '300'))
+
+# Версия промпта входит в ключ кэша: при изменении SYSTEM_PROMPT или
+# RESPONSE_CACHE_VERSION старые ответы перестают находиться
+PROMPT_VERSION = hashlib.sha256(
+    f"{SYSTEM_PROMPT}:{os.environ.get('RESPONSE_CACHE_VERSION', '1')}".encode()
+).hexdigest()[:16]
+
+WORD_RE = re.compile(r'\w+')
+
+_response_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+response_cache_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'errors': 0}
+
+# Слова, которые отсылают к предыдущей переписке или к самому клиенту: ответ
+# на вопрос с ними зависит от контекста и в общий кэш ответов не попадает
+CONTEXT_WORDS = frozenset((
+    'это этот эта эти этого этой этих этом этому этим тот та то те того той тех тем'
+    'такой такая такое такие так тоже также еще там тут тогда выше ранее раньше'
+    'прошлый предыдущий он она оно они его ее их него нее них ему ей им ним ней нем'
+    'я меня мне мной мой моя мое мои моего моей моих моим мы нас нам наш наша наше наши нашего нашей наших'
+).split())
+# Так начинаются уточнения к предыдущему ответу: «а для ИП?»
+FOLLOW_UP_WORDS = frozenset(('а и но').split())
+STANDALONE_MIN_WORDS = 3
+
+
+def normalize_question(text: str) -> str:
+    """Нормализация вопроса для кэша: регистр, ё/е, пунктуация и лишние пробелы"""
+    return ' '.join(WORD_RE.findall(text.lower().replace('ё', 'е')))
+
+
+def is_standalone_question(question: str) -> bool:
+    """
+    Общий вопрос, понятный без переписки и не касающийся данных клиента
+    («когда сдавать УСН»): модель отвечает на него без истории, поэтому
+    ответ одинаков для всех и кладётся в общий кэш независимо от истории
+    """
+    words = normalize_question(question).split()
+    if len(words) < STANDALONE_MIN_WORDS or words[0] in FOLLOW_UP_WORDS:
+        return False
+    return CONTEXT_WORDS.isdisjoint(words)
+
+
+def response_cache_key(normalized: str) -> str:
+    """Ключ кэша ответов: SHA-256 версии промпта и нормализованного вопроса"""
+    return hashlib.sha256(f'{PROMPT_VERSION}:{normalized}'.encode()).hexdigest()
+
+
+def remember_response(cache_key: str, response: str, expires_at: float) -> None:
+    """Положить ответ в LRU процесса, ограниченный RESPONSE_CACHE_MAX_ENTRIES записями"""
+    _response_cache[cache_key] = (response, expires_at)
+    _response_cache.move_to_end(cache_key)
+    while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+        _response_cache.popitem(last=False)
+
+
+@contextmanager
+def response_cache_savepoint(cur):
+    """
+    Запросы к ai_response_cache внутри точки сохранения: ошибка откатывает
+    только их и не прерывает транзакцию, в которой сохраняется переписка
+    """
+    cur.execute('SAVEPOINT response_cache')
+    try:
+        yield
+    except psycopg2.Error as e:
+        cur.execute('ROLLBACK TO SAVEPOINT response_cache')
+        response_cache_stats['errors'] += 1
+        log('WARNING', 'Response cache error', error=str(e))
+    else:
+        cur.execute('RELEASE SAVEPOINT response_cache')
+
+
+def get_cached_response(cur, question: str) -> Optional[str]:
+    """
+    Готовый ответ на частый вопрос по точному совпадению нормализованного
+    вопроса: LRU процесса, затем таблица ai_response_cache
+    """
+    normalized = normalize_question(question)
+    if not normalized or len(question) > RESPONSE_CACHE_MAX_QUESTION_CHARS:
+        return None
+    
+    cache_key = response_cache_key(normalized)
+    now = time.time()
+    
+    cached = _response_cache.get(cache_key)
+    if cached and cached[1] > now:
+        _response_cache.move_to_end(cache_key)
+        response_cache_stats['memory_hits'] += 1
+        return cached[0]
+    
+    row = None
+    with response_cache_savepoint(cur):
+        cur.execute("""
+            UPDATE ai_response_cache
+            SET hits = hits + 1, last_hit_at = NOW()
+            WHERE cache_key = %s AND expires_at > NOW()
+            RETURNING response, EXTRACT(EPOCH FROM expires_at - NOW())
+        """, (cache_key,))
+        row = cur.fetchone()
+    
+    if not row:
+        response_cache_stats['misses'] += 1
+        return None
+    
+    response_cache_stats['db_hits'] += 1
+    remember_response(cache_key, row[0], now + float(row[1]))
+    return row[0]
+
+
+def store_cached_response(cur, question: str, response: str) -> None:
+    """
+    Сохранить ответ на вопрос в LRU процесса и в ai_response_cache на
+    RESPONSE_CACHE_TTL секунд. Ошибка записи не влияет на ответ клиенту.
+    """
+    normalized = normalize_question(question)
+    if not normalized or len(question) > RESPONSE_CACHE_MAX_QUESTION_CHARS:
+        return
+    
+    cache_key = response_cache_key(normalized)
+    remember_response(cache_key, response, time.time() + RESPONSE_CACHE_TTL)
+    
+    with response_cache_savepoint(cur):
+        cur.execute("""
+            INSERT INTO ai_response_cache (cache_key, prompt_version, question, response, expires_at)
+            VALUES (%s, %s, %s, %s, NOW() + make_interval(secs => %s))
+            ON CONFLICT (cache_key) DO UPDATE SET
+                response = EXCLUDED.response,
+                expires_at = EXCLUDED.expires_at
+        """, (cache_key, PROMPT_VERSION, normalized, response, RESPONSE_CACHE_TTL))
+
+
+def get_response_cache_stats() -> Dict:
+    """Счётчики кэша ответов и доля попаданий"""
+    stats = dict(response_cache_stats)
+    stats['entries'] = len(_response_cache)
+    hits = stats['memory_hits'] + stats['db_hits']
+    lookups = hits + stats['misses']
+    stats['hit_ratio'] = round(hits / lookups, 4) if lookups else 0.0
+    return stats
+
+
+YANDEX_GPT_URL = os.environ.get('YANDEX_GPT_URL', 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion')
+
+
+class YandexGPTError(Exception):
+    """Ошибка ответа YandexGPT"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(YandexGPTError):
+    """YandexGPT недоступен: после серии ошибок запросы временно не отправляются"""
+
+
+class YandexGPTClient:
+    """
+    Клиент YandexGPT на весь процесс: keep-alive сессия, повтор с
+    экспоненциальной задержкой (с учётом Retry-After) при 429 и 5xx,
+    потоковая выдача ответа и автоматический выключатель — после
+    failure_threshold ошибок подряд запросы reset_timeout секунд
+    завершаются сразу CircuitOpenError, затем пропускается пробный запрос.
+    """
+    
+    def __init__(self, api_key: str, folder_id: str, model: str = 'yandexgpt-lite',
+                 url: str = YANDEX_GPT_URL, timeout: float = 30, max_retries: int = 3,
+                 failure_threshold: int = 5, reset_timeout: float = 30):
+        self.url = url
+        self.model_uri = f'gpt://{folder_id}/{model}'
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(['POST']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=4, max_retries=retry))
+        self.session.headers.update({
+            'Authorization': f'Api-Key {api_key}',
+            'Content-Type': 'application/json'
+        })
+        
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+    
+    def _check_circuit(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError('YandexGPT circuit is open')
+            # Полуоткрытое состояние: пропускаем один пробный запрос
+            self._opened_at = time.monotonic()
+    
+    def _record_result(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+    
+    def _post(self, messages: List[Dict], stream: bool, temperature: float, max_tokens: int) -> requests.Response:
+        self._check_circuit()
+        try:
+            response = self.session.post(self.url, json={
+                'modelUri': self.model_uri,
+                'completionOptions': {
+                    'stream': stream,
+                    'temperature': temperature,
+                    'maxTokens': max_tokens
+                },
+                'messages': messages
+            }, timeout=self.timeout, stream=stream)
+        except requests.RequestException:
+            self._record_result(False)
+            raise
+        
+        if response.status_code != 200:
+            response.close()
+            self._record_result(response.status_code < 500 and response.status_code != 429)
+            raise YandexGPTError(f'Статус: {response.status_code}', response.status_code)
+        return response
+    
+    @staticmethod
+    def _alternative_text(result: Dict) -> Optional[str]:
+        alternatives = result.get('result', {}).get('alternatives')
+        if not alternatives:
+            return None
+        return alternatives[0].get('message', {}).get('text')
+    
+    def complete(self, messages: List[Dict], temperature: float = 0.6, max_tokens: int = 2000) -> str:
+        """Полный ответ модели одной строкой"""
+        response = self._post(messages, False, temperature, max_tokens)
+        try:
+            text = self._alternative_text(response.json())
+        except ValueError:
+            text = None
+        self._record_result(text is not None)
+        if text is None:
+            raise YandexGPTError('Не удалось получить ответ')
+        return text
+    
+    def stream(self, messages: List[Dict], temperature: float = 0.6, max_tokens: int = 2000) -> Iterator[str]:
+        """
+        Потоковый ответ: фрагменты текста по мере генерации. API присылает
+        строки JSON с накопленным текстом, наружу отдаётся только прирост.
+        """
+        response = self._post(messages, True, temperature, max_tokens)
+        text = ''
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                current = self._alternative_text(json.loads(line))
+                if current and len(current) > len(text):
+                    yield current[len(text):]
+                    text = current
+        except (requests.RequestException, ValueError):
+            self._record_result(False)
+            raise
+        finally:
+            response.close()
+        
+        self._record_result(bool(text))
+        if not text:
+            raise YandexGPTError('Не удалось получить ответ')
+
+
+_yandex_gpt_client: Optional[YandexGPTClient] = None
+
+
+def get_yandex_gpt_client() -> Optional[YandexGPTClient]:
+    """Клиент YandexGPT, общий для тёплых вызовов функции. None — если ключи не настроены"""
+    global _yandex_gpt_client
+    api_key = os.environ.get('YANDEX_GPT_API_KEY', '')
+    folder_id = os.environ.get('YANDEX_FOLDER_ID', '')
+    if not api_key or not folder_id:
+        return None
+    
+    if _yandex_gpt_client is None:
+        _yandex_gpt_client = YandexGPTClient(
+            api_key,
+            folder_id,
+            timeout=float(os.environ.get('YANDEX_GPT_TIMEOUT', '30')),
+            max_retries=int(os.environ.get('YANDEX_GPT_MAX_RETRIES', '3')),
+            failure_threshold=int(os.environ.get('YANDEX_GPT_FAILURE_THRESHOLD', '5')),
+            reset_timeout=float(os.environ.get('YANDEX_GPT_RESET_TIMEOUT', '30'))
+        )
+    return _yandex_gpt_client
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Сформировать событие Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def load_agent_context(cur, agent_id: str) -> Tuple[Optional[int], List[Dict]]:
+    """
+    Пользователь агента и последние 10 сообщений истории (в хронологическом
+    порядке) одним запросом. Возвращает (None, []) если пользователь не найден.
+    """
+    cur.execute("""
+        WITH agent_user AS (
+            SELECT id FROM users WHERE agent_id = %s LIMIT 1
+        ),
+        recent AS (
+            SELECT message_text, message_type, created_at FROM agent_history
+            WHERE agent_id = %s
+            ORDER BY created_at DESC
+            LIMIT 10
+        )
+        SELECT u.id, r.message_text, r.message_type
+        FROM agent_user u
+        LEFT JOIN recent r ON true
+        ORDER BY r.created_at
+    """, (agent_id, agent_id))
+    
+    rows = cur.fetchall()
+    if not rows:
+        return None, []
+    
+    history = []
+    for row in rows:
+        if row[1] is None:
+            continue
+        history.append({
+            'role': 'user' if row[2] == 'user' else 'assistant',
+            'text': row[1]
+        })
+    return rows[0][0], history
+
+
+def save_agent_exchange(cur, agent_id: str, user_id: int, message: str, received_at: datetime,
+                        agent_response: str, answered_at: datetime) -> None:
+    """Сохранить вопрос пользователя и ответ агента одной вставкой"""
+    cur.execute("""
+        INSERT INTO agent_history (agent_id, user_id, message_type, message_text, created_at)
+        VALUES (%s, %s, 'user', %s, %s), (%s, %s, 'agent', %s, %s)
+    """, (agent_id, user_id, message, received_at, agent_id, user_id, agent_response, answered_at))
+
 
 def handler(event: dict, context) -> dict:
-    """Чат с ИИ-агентом на базе YandexGPT для бухгалтерских консультаций"""
+    """
+    Чат с ИИ-агентом на базе YandexGPT для бухгалтерских консультаций.
+    При "stream": true ответ отдаётся событиями SSE. Тело ответа функции
+    собирается целиком, поэтому клиент получает события разом; если поток
+    YandexGPT оборвался, приходит уже сгенерированная часть и событие error.
+    """
+    start_request_log(event, context)
     
     method = event.get('httpMethod', 'POST')
     
@@ -34,6 +543,7 @@ def handler(event: dict, context) -> dict:
         message = body.get('message', '')
         agent_id = body.get('agent_id', '')
         user_phone = body.get('user_phone', '')
+        stream = body.get('stream') is True
         
         if not message or not agent_id:
             return {
@@ -43,118 +553,115 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT id FROM users WHERE agent_id = %s
-        """, (agent_id,))
+        received_at = datetime.now()
         
-        user_result = cur.fetchone()
-        if not user_result:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            db_started = time.perf_counter()
+            
+            user_id, history = load_agent_context(cur, agent_id)
+            if not user_id:
+                cur.close()
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'User not found'}),
+                    'isBase64Encoded': False
+                }
+            
+            db_ms = (time.perf_counter() - db_started) * 1000
+            
+            client = get_yandex_gpt_client()
+            deltas = []
+            generated = False
+            stream_error = None
+            
+            # Общий вопрос задаётся YandexGPT без истории агента: ответ на него
+            # не зависит от клиента, поэтому берётся из кэша и кладётся в кэш
+            standalone = is_standalone_question(message)
+            
+            # Частый вопрос - ответ из кэша без вызова YandexGPT
+            agent_response = get_cached_response(cur, message) if standalone else None
+            cached = agent_response is not None
+            if cached and log_enabled('DEBUG'):
+                log('DEBUG', 'Response cache hit', **get_response_cache_stats())
+            elif not client:
+                agent_response = f"Здравствуйте! Я бухгалтерский помощник. Вы спросили: '{message}'. Для полноценных ответов необходимо настроить YandexGPT API ключи."
+            else:
+                messages = [
+                    {'role': 'system', 'text': SYSTEM_PROMPT}
+                ]
+                
+                if not standalone:
+                    for h in history[-5:]:
+                        messages.append(h)
+                
+                messages.append({'role': 'user', 'text': message})
+                
+                try:
+                    if stream:
+                        for delta in client.stream(messages):
+                            deltas.append(delta)
+                        agent_response = ''.join(deltas)
+                    else:
+                        agent_response = client.complete(messages)
+                    generated = True
+                except CircuitOpenError:
+                    agent_response = "YandexGPT временно недоступен, попробуйте повторить вопрос через минуту."
+                except YandexGPTError as e:
+                    agent_response = f"Произошла ошибка при обращении к YandexGPT. {str(e)}"
+                except Exception as e:
+                    agent_response = f"Ошибка связи с YandexGPT: {str(e)}"
+                
+                # Поток оборвался на середине: сохраняем и отдаём уже полученную
+                # часть ответа, а текст ошибки уходит отдельным событием error
+                if deltas and not generated:
+                    stream_error = agent_response
+                    agent_response = ''.join(deltas)
+            
+            db_started = time.perf_counter()
+            save_agent_exchange(cur, agent_id, user_id, message, received_at, agent_response, datetime.now())
+            if generated and standalone:
+                store_cached_response(cur, message, agent_response)
+            conn.commit()
             cur.close()
-            conn.close()
+            db_ms += (time.perf_counter() - db_started) * 1000
+            log('DEBUG', 'Agent request', db_ms=round(db_ms, 1), cached=cached)
+            
+            if stream:
+                events = [sse_event('delta', {'text': delta}) for delta in deltas or [agent_response]]
+                if stream_error:
+                    events.append(sse_event('error', {'error': stream_error}))
+                events.append(sse_event('done', {
+                    'success': True,
+                    'message': agent_response,
+                    'agent_id': agent_id,
+                    'cached': cached,
+                    'partial': stream_error is not None
+                }))
+                return {
+                    'statusCode': 200,
+                    'headers': {
+                        'Content-Type': 'text/event-stream; charset=utf-8',
+                        'Cache-Control': 'no-cache',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': ''.join(events),
+                    'isBase64Encoded': False
+                }
+            
             return {
-                'statusCode': 404,
+                'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'User not found'}),
+                'body': json.dumps({
+                    'success': True,
+                    'message': agent_response,
+                    'agent_id': agent_id,
+                    'cached': cached
+                }),
                 'isBase64Encoded': False
             }
-        
-        user_id = user_result[0]
-        
-        cur.execute("""
-            SELECT message_text, message_type FROM agent_history 
-            WHERE agent_id = %s 
-            ORDER BY created_at DESC 
-            LIMIT 10
-        """, (agent_id,))
-        
-        history_rows = cur.fetchall()
-        history = []
-        for row in reversed(history_rows):
-            history.append({
-                'role': 'user' if row[1] == 'user' else 'assistant',
-                'text': row[0]
-            })
-        
-        cur.execute("""
-            INSERT INTO agent_history (agent_id, user_id, message_type, message_text, created_at)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (agent_id, user_id, 'user', message, datetime.now().isoformat()))
-        
-        conn.commit()
-        
-        yandex_api_key = os.environ.get('YANDEX_GPT_API_KEY', '')
-        yandex_folder_id = os.environ.get('YANDEX_FOLDER_ID', '')
-        
-        if not yandex_api_key or not yandex_folder_id:
-            agent_response = f"Здравствуйте! Я бухгалтерский помощник. Вы спросили: '{message}'. Для полноценных ответов необходимо настроить YandexGPT API ключи."
-        else:
-            system_prompt = """Ты - профессиональный бухгалтерский помощник для аграриев и малого бизнеса в России. 
-Твоя задача:
-- Консультировать по вопросам бухучета, налогов, отчетности
-- Помогать с ФГИС Зерно, Меркурий, субсидиями
-- Напоминать о сроках сдачи отчетов
-- Давать практические советы по оптимизации налогов
-- Объяснять простым языком сложные бухгалтерские вопросы
-
-Отвечай кратко, по делу, профессионально но дружелюбно."""
-
-            messages = [
-                {'role': 'system', 'text': system_prompt}
-            ]
-            
-            for h in history[-5:]:
-                messages.append(h)
-            
-            messages.append({'role': 'user', 'text': message})
             
-            yandex_url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
-            yandex_headers = {
-                'Authorization': f'Api-Key {yandex_api_key}',
-                'Content-Type': 'application/json'
-            }
-            yandex_data = {
-                'modelUri': f'gpt://{yandex_folder_id}/yandexgpt-lite',
-                'completionOptions': {
-                    'stream': False,
-                    'temperature': 0.6,
-                    'maxTokens': 2000
-                },
-                'messages': messages
-            }
-            
-            try:
-                response = requests.post(yandex_url, headers=yandex_headers, json=yandex_data, timeout=30)
-                if response.status_code == 200:
-                    result = response.json()
-                    agent_response = result.get('result', {}).get('alternatives', [{}])[0].get('message', {}).get('text', 'Не удалось получить ответ')
-                else:
-                    agent_response = f"Произошла ошибка при обращении к YandexGPT. Статус: {response.status_code}"
-            except Exception as e:
-                agent_response = f"Ошибка связи с YandexGPT: {str(e)}"
-        
-        cur.execute("""
-            INSERT INTO agent_history (agent_id, user_id, message_type, message_text, created_at)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (agent_id, user_id, 'agent', agent_response, datetime.now().isoformat()))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'message': agent_response,
-                'agent_id': agent_id
-            }),
-            'isBase64Encoded': False
-        }
-        
     except Exception as e:
         return {
             'statusCode': 500,
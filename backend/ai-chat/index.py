@@ -4,9 +4,22 @@ AI-агент для общения с клиентами и автоматич
 """
 import json
 import os
+import hashlib
+import random
+import re
+import tempfile
+import time
+import uuid
+import httpx
+import jwt
 import psycopg2
+import tiktoken
+from openai import OpenAI
+from psycopg2 import extensions, pool
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Any, Optional, List, Dict, Tuple
 
 
 def get_env(key: str, default: str = "") -> str:
@@ -14,10 +27,129 @@ def get_env(key: str, default: str = "") -> str:
     return os.environ.get(key, default)
 
 
-def get_db_connection():
-    """Создать подключение к базе данных"""
-    dsn = get_env("DATABASE_URL")
-    return psycopg2.connect(dsn)
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "512"))
+
+# Экземпляр функции обслуживает один запрос за раз, поэтому контекст лога
+# хранится в состоянии модуля
+_log_context: Dict[str, Any] = {"request_id": None, "sampled": True}
+
+
+def start_request_log(event: dict, context) -> None:
+    """
+    Запомнить id запроса для строк лога и решить, попадает ли запрос в выборку:
+    DEBUG/INFO пишутся для доли LOG_SAMPLE_RATE запросов, WARNING и ERROR всегда
+    """
+    request_id = (
+        getattr(context, "request_id", None)
+        or (event.get("requestContext") or {}).get("requestId")
+        or uuid.uuid4().hex
+    )
+    _log_context["request_id"] = request_id
+    _log_context["sampled"] = random.random() < LOG_SAMPLE_RATE
+
+
+def log_enabled(level: str) -> bool:
+    """Дешёвая проверка перед сборкой дорогих полей лога"""
+    level_no = LOG_LEVELS[level]
+    if level_no < LOG_LEVEL:
+        return False
+    return level_no >= LOG_LEVELS["WARNING"] or _log_context["sampled"]
+
+
+def _log_field(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if len(text) > LOG_MAX_FIELD_CHARS:
+        return text[:LOG_MAX_FIELD_CHARS] + f"...(+{len(text) - LOG_MAX_FIELD_CHARS} chars)"
+    return text
+
+
+def _write_log(level: str, message: str, fields: Dict[str, Any]) -> None:
+    record = {"level": level, "msg": message, "request_id": _log_context["request_id"]}
+    for key, value in fields.items():
+        record[key] = _log_field(value)
+    print(json.dumps(record, ensure_ascii=False))
+
+
+def log(level: str, message: str, **fields: Any) -> None:
+    """Одна строка лога в JSON; поля длиннее LOG_MAX_FIELD_CHARS обрезаются"""
+    if log_enabled(level):
+        _write_log(level, message, fields)
+
+
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(get_env("DB_POOL_MIN_SIZE", "1")),
+            int(get_env("DB_POOL_MAX_SIZE", "5")),
+            get_env("DATABASE_URL")
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(get_env("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(get_env("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
 
 
 def cors_response(status_code: int, body: dict) -> dict:
@@ -34,38 +166,47 @@ def cors_response(status_code: int, body: dict) -> dict:
     }
 
 
+JWT_SECRET = get_env("JWT_SECRET")
+JWT_CACHE_MAX_SIZE = int(get_env("JWT_CACHE_MAX_SIZE", "1024"))
+JWT_CACHE_TTL = float(get_env("JWT_CACHE_TTL", "300"))
+
+_jwt_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+jwt_cache_stats = {"hits": 0, "misses": 0}
+
+
 def verify_jwt(token: str) -> Optional[int]:
-    """Проверка JWT токена и извлечение user_id"""
+    """
+    Проверка JWT токена и извлечение user_id.
+    Расшифрованные токены кэшируются (LRU по SHA-256 токена) до истечения
+    exp, но не дольше JWT_CACHE_TTL секунд.
+    """
     if not token:
         return None
     
-    import jwt
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    
+    cached = _jwt_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _jwt_cache.move_to_end(token_hash)
+        jwt_cache_stats["hits"] += 1
+        return cached[0]
+    
+    jwt_cache_stats["misses"] += 1
+    _jwt_cache.pop(token_hash, None)
+    
     try:
-        jwt_secret = get_env("JWT_SECRET")
-        payload = jwt.decode(token, jwt_secret, algorithms=["HS256"])
-        return payload.get("user_id")
-    except:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except jwt.PyJWTError:
         return None
-
-
-def get_chat_history(cursor, user_id: int, limit: int = 10) -> List[Dict]:
-    """Получить последние сообщения чата"""
-    schema = get_env("MAIN_DB_SCHEMA", "public")
-    cursor.execute(f"""
-        SELECT role, content, created_at
-        FROM {schema}.ai_chat_messages
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-        LIMIT %s
-    """, (user_id, limit))
     
-    messages = []
-    for row in reversed(cursor.fetchall()):
-        messages.append({
-            "role": row[0],
-            "content": row[1]
-        })
-    return messages
+    user_id = payload.get("user_id")
+    if user_id:
+        expires_at = min(payload.get("exp", now + JWT_CACHE_TTL), now + JWT_CACHE_TTL)
+        _jwt_cache[token_hash] = (user_id, expires_at)
+        if len(_jwt_cache) > JWT_CACHE_MAX_SIZE:
+            _jwt_cache.popitem(last=False)
+    return user_id
 
 
 def save_message(cursor, user_id: int, role: str, content: str):
@@ -119,14 +260,7 @@ def create_task_for_accountant(cursor, user_id: int, task_data: dict) -> int:
     return task_id
 
 
-def call_openai(messages: List[Dict]) -> str:
-    """Вызов OpenAI API для генерации ответа"""
-    try:
-        from openai import OpenAI
-        
-        client = OpenAI(api_key=get_env("OPENAI_API_KEY"))
-        
-        system_prompt = """Ты - AI-ассистент бухгалтерской компании "Ремонт под ключ".
+SYSTEM_PROMPT = """Ты - AI-ассистент бухгалтерской компании "Ремонт под ключ".
 Твоя задача:
 1. Отвечать на вопросы клиентов о бухгалтерских услугах
 2. Помогать формулировать задачи для бухгалтера
@@ -145,10 +279,95 @@ def call_openai(messages: List[Dict]) -> str:
 
 Если это обычный вопрос, отвечай просто текстом без JSON."""
 
-        response = client.chat.completions.create(
+ERROR_REPLY_PREFIX = "Извините, произошла ошибка"
+
+
+OPENAI_TIMEOUT = float(get_env("OPENAI_TIMEOUT", "30"))
+OPENAI_CONNECT_TIMEOUT = float(get_env("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_MAX_RETRIES = int(get_env("OPENAI_MAX_RETRIES", "2"))
+
+_openai_client: Optional[OpenAI] = None
+_openai_http_client: Optional[httpx.Client] = None
+_llm_timing: Dict[str, float] = {}
+llm_call_metrics: "deque[Dict]" = deque(maxlen=100)
+
+
+def trace_http(event_name: str, info: dict) -> None:
+    """Трассировка httpcore: моменты установки соединения и получения заголовков ответа"""
+    now = time.monotonic()
+    if event_name == "connection.connect_tcp.started":
+        _llm_timing.setdefault("connect_started", now)
+    elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+        _llm_timing["connect_complete"] = now
+    elif event_name.endswith("receive_response_headers.complete"):
+        _llm_timing.setdefault("headers_received", now)
+
+
+def attach_http_trace(request: httpx.Request) -> None:
+    """Хук httpx: включить трассировку для каждого запроса к OpenAI"""
+    request.extensions["trace"] = trace_http
+
+
+def get_openai_client() -> OpenAI:
+    """
+    Клиент OpenAI на весь процесс: keep-alive пул соединений переживает
+    тёплые вызовы функции, таймауты и число повторов задаются через окружение
+    """
+    global _openai_client, _openai_http_client
+    if _openai_client is None:
+        _openai_http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=120),
+            event_hooks={"request": [attach_http_trace]}
+        )
+        _openai_client = OpenAI(
+            api_key=get_env("OPENAI_API_KEY"),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=_openai_http_client
+        )
+    return _openai_client
+
+
+def warm_up_openai() -> None:
+    """Прогрев: создать клиента и заранее открыть TLS-соединение с API"""
+    client = get_openai_client()
+    try:
+        _openai_http_client.get(str(client.base_url), timeout=OPENAI_CONNECT_TIMEOUT)
+    except httpx.HTTPError:
+        pass
+
+
+def record_llm_call(started_at: float) -> Dict:
+    """
+    Записать задержки вызова LLM: установка соединения (0 — соединение из пула),
+    время до первого байта и общее время
+    """
+    finished_at = time.monotonic()
+    connect_ms = 0.0
+    if "connect_started" in _llm_timing:
+        connect_ms = (_llm_timing.get("connect_complete", finished_at) - _llm_timing["connect_started"]) * 1000
+    ttfb_at = _llm_timing.get("headers_received", finished_at)
+    
+    metric = {
+        "connect_ms": round(connect_ms, 1),
+        "ttfb_ms": round((ttfb_at - started_at) * 1000, 1),
+        "total_ms": round((finished_at - started_at) * 1000, 1),
+        "reused_connection": "connect_started" not in _llm_timing
+    }
+    llm_call_metrics.append(metric)
+    log("INFO", "LLM call", **metric)
+    return metric
+
+
+def call_openai(messages: List[Dict]) -> str:
+    """Вызов OpenAI API для генерации ответа"""
+    _llm_timing.clear()
+    started_at = time.monotonic()
+    try:
+        response = get_openai_client().chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 *messages
             ],
             temperature=0.7,
@@ -157,7 +376,355 @@ def call_openai(messages: List[Dict]) -> str:
         
         return response.choices[0].message.content
     except Exception as e:
-        return f"Извините, произошла ошибка: {str(e)}"
+        return f"{ERROR_REPLY_PREFIX}: {str(e)}"
+    finally:
+        record_llm_call(started_at)
+
+
+CHAT_RECENT_MESSAGES = int(get_env("CHAT_RECENT_MESSAGES", "10"))
+CHAT_SUMMARY_EVERY = int(get_env("CHAT_SUMMARY_EVERY", "10"))
+CHAT_SUMMARY_MAX_TOKENS = int(get_env("CHAT_SUMMARY_MAX_TOKENS", "300"))
+CHAT_PROMPT_TOKEN_BUDGET = int(get_env("CHAT_PROMPT_TOKEN_BUDGET", "3000"))
+
+# Служебные токены на каждое сообщение в формате chat completions
+MESSAGE_TOKEN_OVERHEAD = 4
+
+SUMMARY_PROMPT = """Ты ведёшь краткое содержание переписки клиента с AI-ассистентом бухгалтерской компании.
+Дополни текущее краткое содержание новыми сообщениями. Сохрани факты о клиенте, его запросы,
+созданные задачи и договорённости; опусти приветствия и повторы. Пиши по-русски, не длиннее
+нескольких абзацев."""
+
+# Файл кодировки tiktoken скачивает при первом обращении и кладёт в TIKTOKEN_CACHE_DIR:
+# каталог в /tmp переживает тёплые вызовы, а в сборку файл можно положить заранее,
+# указав каталог с ним в TIKTOKEN_CACHE_DIR
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tiktoken"))
+TOKEN_ENCODING_RETRY_AFTER = float(get_env("TOKEN_ENCODING_RETRY_AFTER", "300"))
+
+# Пока кодировка недоступна, токены оцениваются по длине с запасом:
+# в o200k_base на токен приходится больше 3 символов русского текста
+CHARS_PER_TOKEN_ESTIMATE = 3
+
+_token_encoding = None
+_token_encoding_failed_at: Optional[float] = None
+
+
+def get_token_encoding():
+    """
+    Кодировка o200k_base или None, если загрузить её не удалось;
+    повторная попытка не раньше чем через TOKEN_ENCODING_RETRY_AFTER секунд
+    """
+    global _token_encoding, _token_encoding_failed_at
+    if _token_encoding is None:
+        failed_at = _token_encoding_failed_at
+        if failed_at is not None and time.monotonic() - failed_at < TOKEN_ENCODING_RETRY_AFTER:
+            return None
+        try:
+            _token_encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            _token_encoding_failed_at = time.monotonic()
+            log("WARNING", "Token encoding unavailable, estimating by length", error=str(e))
+            return None
+    return _token_encoding
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов текста в кодировке модели gpt-4o-mini (оценка по длине без кодировки)"""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN_ESTIMATE)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    """Число токенов списка сообщений с учётом служебных токенов"""
+    return sum(count_tokens(m["content"]) + MESSAGE_TOKEN_OVERHEAD for m in messages)
+
+
+def get_chat_summary(cursor, user_id: int) -> Tuple[str, int]:
+    """Получить краткое содержание чата и id последнего вошедшего в него сообщения"""
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    cursor.execute(f"""
+        SELECT summary, last_message_id
+        FROM {schema}.ai_chat_summaries
+        WHERE user_id = %s
+    """, (user_id,))
+    
+    row = cursor.fetchone()
+    return (row[0], row[1]) if row else ("", 0)
+
+
+def get_unsummarized_messages(cursor, user_id: int, after_id: int) -> List[Dict]:
+    """
+    Сообщения, ещё не вошедшие в краткое содержание (в хронологическом порядке).
+    Не больше окна последних сообщений плюс одна порция для свёртки — более
+    старые сообщения без сводки в промпт не попадают.
+    """
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    cursor.execute(f"""
+        SELECT id, role, content
+        FROM {schema}.ai_chat_messages
+        WHERE user_id = %s AND id > %s
+        ORDER BY id DESC
+        LIMIT %s
+    """, (user_id, after_id, CHAT_RECENT_MESSAGES + CHAT_SUMMARY_EVERY))
+    
+    messages = []
+    for row in reversed(cursor.fetchall()):
+        messages.append({
+            "id": row[0],
+            "role": row[1],
+            "content": row[2]
+        })
+    return messages
+
+
+def summarize_messages(summary: str, messages: List[Dict]) -> Optional[str]:
+    """Дополнить краткое содержание новыми сообщениями. None — если вызов модели не удался"""
+    transcript = '\n'.join(
+        f"{'Клиент' if m['role'] == 'user' else 'Ассистент'}: {m['content']}" for m in messages
+    )
+    _llm_timing.clear()
+    started_at = time.monotonic()
+    try:
+        response = get_openai_client().chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Текущее краткое содержание:\n{summary or '(пусто)'}\n\nНовые сообщения:\n{transcript}"}
+            ],
+            temperature=0.2,
+            max_tokens=CHAT_SUMMARY_MAX_TOKENS
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        log("WARNING", "User summary update failed", error=str(e))
+        return None
+    finally:
+        record_llm_call(started_at)
+
+
+def save_chat_summary(cursor, user_id: int, summary: str, last_message_id: int, folded: int):
+    """Сохранить краткое содержание чата"""
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    cursor.execute(f"""
+        INSERT INTO {schema}.ai_chat_summaries (user_id, summary, last_message_id, summarized_count)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET
+            summary = EXCLUDED.summary,
+            last_message_id = EXCLUDED.last_message_id,
+            summarized_count = {schema}.ai_chat_summaries.summarized_count + EXCLUDED.summarized_count,
+            updated_at = CURRENT_TIMESTAMP
+    """, (user_id, summary, last_message_id, folded))
+
+
+def get_chat_context(cursor, user_id: int) -> List[Dict]:
+    """
+    Сообщения для промпта: краткое содержание разговора и последние сообщения.
+    Когда за окном последних CHAT_RECENT_MESSAGES накапливается CHAT_SUMMARY_EVERY
+    сообщений, они сворачиваются в сводку. Старые сообщения окна отбрасываются,
+    пока промпт не уложится в CHAT_PROMPT_TOKEN_BUDGET токенов.
+    """
+    summary, last_message_id = get_chat_summary(cursor, user_id)
+    messages = get_unsummarized_messages(cursor, user_id, last_message_id)
+    
+    to_fold = messages[:-CHAT_RECENT_MESSAGES] if len(messages) > CHAT_RECENT_MESSAGES else []
+    if len(to_fold) >= CHAT_SUMMARY_EVERY:
+        new_summary = summarize_messages(summary, to_fold)
+        if new_summary:
+            save_chat_summary(cursor, user_id, new_summary, to_fold[-1]["id"], len(to_fold))
+            summary = new_summary
+            messages = messages[len(to_fold):]
+    
+    recent = [{"role": m["role"], "content": m["content"]} for m in messages[-CHAT_RECENT_MESSAGES:]]
+    context = []
+    if summary:
+        context.append({"role": "system", "content": f"Краткое содержание предыдущего разговора:\n{summary}"})
+    
+    budget = CHAT_PROMPT_TOKEN_BUDGET - count_tokens(SYSTEM_PROMPT) - MESSAGE_TOKEN_OVERHEAD - count_message_tokens(context)
+    while len(recent) > 1 and count_message_tokens(recent) > budget:
+        recent.pop(0)
+    
+    return context + recent
+
+
+RESPONSE_CACHE_TTL = int(get_env("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_MAX_ENTRIES = int(get_env("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+RESPONSE_CACHE_MAX_QUESTION_CHARS = int(get_env("RESPONSE_CACHE_MAX_QUESTION_CHARS", "300"))
+
+# Версия промпта входит в ключ кэша: при изменении SYSTEM_PROMPT или
+# RESPONSE_CACHE_VERSION старые ответы перестают находиться
+PROMPT_VERSION = hashlib.sha256(
+    f"{SYSTEM_PROMPT}:{get_env('RESPONSE_CACHE_VERSION', '1')}".encode()
+).hexdigest()[:16]
+
+WORD_RE = re.compile(r"\w+")
+
+_response_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+response_cache_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "errors": 0}
+
+# Слова, которые отсылают к предыдущей переписке или к самому клиенту: ответ
+# на вопрос с ними зависит от контекста и в общий кэш ответов не попадает
+CONTEXT_WORDS = frozenset((
+    "это этот эта эти этого этой этих этом этому этим тот та то те того той тех тем"
+    "такой такая такое такие так тоже также еще там тут тогда выше ранее раньше"
+    "прошлый предыдущий он она оно они его ее их него нее них ему ей им ним ней нем"
+    "я меня мне мной мой моя мое мои моего моей моих моим мы нас нам наш наша наше наши нашего нашей наших"
+).split())
+# Так начинаются уточнения к предыдущему ответу: «а для ИП?»
+FOLLOW_UP_WORDS = frozenset(("а и но").split())
+STANDALONE_MIN_WORDS = 3
+
+
+def normalize_question(text: str) -> str:
+    """Нормализация вопроса для кэша: регистр, ё/е, пунктуация и лишние пробелы"""
+    return ' '.join(WORD_RE.findall(text.lower().replace('ё', 'е')))
+
+
+def is_standalone_question(question: str) -> bool:
+    """
+    Общий вопрос, понятный без переписки и не касающийся данных клиента
+    («когда сдавать УСН»): модель отвечает на него без истории, поэтому
+    ответ одинаков для всех и кладётся в общий кэш независимо от истории
+    """
+    words = normalize_question(question).split()
+    if len(words) < STANDALONE_MIN_WORDS or words[0] in FOLLOW_UP_WORDS:
+        return False
+    return CONTEXT_WORDS.isdisjoint(words)
+
+
+def response_cache_key(normalized: str) -> str:
+    """Ключ кэша ответов: SHA-256 версии промпта и нормализованного вопроса"""
+    return hashlib.sha256(f"{PROMPT_VERSION}:{normalized}".encode()).hexdigest()
+
+
+def remember_response(cache_key: str, response: str, expires_at: float) -> None:
+    """Положить ответ в LRU процесса, ограниченный RESPONSE_CACHE_MAX_ENTRIES записями"""
+    _response_cache[cache_key] = (response, expires_at)
+    _response_cache.move_to_end(cache_key)
+    while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+        _response_cache.popitem(last=False)
+
+
+@contextmanager
+def response_cache_savepoint(cursor):
+    """
+    Запросы к ai_response_cache внутри точки сохранения: ошибка откатывает
+    только их и не прерывает транзакцию, в которой сохраняется переписка
+    """
+    cursor.execute("SAVEPOINT response_cache")
+    try:
+        yield
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT response_cache")
+        response_cache_stats["errors"] += 1
+        log("WARNING", "Response cache error", error=str(e))
+    else:
+        cursor.execute("RELEASE SAVEPOINT response_cache")
+
+
+def get_cached_response(cursor, question: str) -> Optional[str]:
+    """
+    Готовый ответ на частый вопрос по точному совпадению нормализованного
+    вопроса: LRU процесса, затем таблица ai_response_cache
+    """
+    normalized = normalize_question(question)
+    if not normalized or len(question) > RESPONSE_CACHE_MAX_QUESTION_CHARS:
+        return None
+    
+    cache_key = response_cache_key(normalized)
+    now = time.time()
+    
+    cached = _response_cache.get(cache_key)
+    if cached and cached[1] > now:
+        _response_cache.move_to_end(cache_key)
+        response_cache_stats["memory_hits"] += 1
+        return cached[0]
+    
+    row = None
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    with response_cache_savepoint(cursor):
+        cursor.execute(f"""
+            UPDATE {schema}.ai_response_cache
+            SET hits = hits + 1, last_hit_at = NOW()
+            WHERE cache_key = %s AND expires_at > NOW()
+            RETURNING response, EXTRACT(EPOCH FROM expires_at - NOW())
+        """, (cache_key,))
+        row = cursor.fetchone()
+    
+    if not row:
+        response_cache_stats["misses"] += 1
+        return None
+    
+    response_cache_stats["db_hits"] += 1
+    remember_response(cache_key, row[0], now + float(row[1]))
+    return row[0]
+
+
+def store_cached_response(cursor, question: str, response: str) -> None:
+    """
+    Сохранить ответ на вопрос в LRU процесса и в ai_response_cache на
+    RESPONSE_CACHE_TTL секунд. Ошибка записи не влияет на ответ клиенту.
+    """
+    normalized = normalize_question(question)
+    if not normalized or len(question) > RESPONSE_CACHE_MAX_QUESTION_CHARS:
+        return
+    
+    cache_key = response_cache_key(normalized)
+    remember_response(cache_key, response, time.time() + RESPONSE_CACHE_TTL)
+    
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    with response_cache_savepoint(cursor):
+        cursor.execute(f"""
+            INSERT INTO {schema}.ai_response_cache (cache_key, prompt_version, question, response, expires_at)
+            VALUES (%s, %s, %s, %s, NOW() + make_interval(secs => %s))
+            ON CONFLICT (cache_key) DO UPDATE SET
+                response = EXCLUDED.response,
+                expires_at = EXCLUDED.expires_at
+        """, (cache_key, PROMPT_VERSION, normalized, response, RESPONSE_CACHE_TTL))
+
+
+def purge_expired_responses(cursor) -> int:
+    """Удалить из ai_response_cache истёкшие ответы (в том числе от прежних версий промпта)"""
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    cursor.execute(f"DELETE FROM {schema}.ai_response_cache WHERE expires_at <= NOW()")
+    return cursor.rowcount
+
+
+def get_response_cache_stats() -> Dict:
+    """Счётчики кэша ответов и доля попаданий"""
+    stats = dict(response_cache_stats)
+    stats["entries"] = len(_response_cache)
+    hits = stats["memory_hits"] + stats["db_hits"]
+    lookups = hits + stats["misses"]
+    stats["hit_ratio"] = round(hits / lookups, 4) if lookups else 0.0
+    return stats
+
+
+def handle_ai_response(cursor, user_id: int, ai_response: str,
+                       question: Optional[str] = None) -> Tuple[str, bool, Optional[int]]:
+    """
+    Разобрать ответ модели: если это JSON с create_task — создать задачу.
+    Сохраняет ответ в историю и возвращает (текст для клиента, создана ли задача, id задачи).
+    Если передан question, обычный текстовый ответ кладётся в кэш ответов.
+    """
+    task_created = False
+    task_id = None
+    response_text = ai_response
+    
+    try:
+        parsed = json.loads(ai_response)
+        if 'create_task' in parsed:
+            task_id = create_task_for_accountant(cursor, user_id, parsed['create_task'])
+            task_created = True
+            response_text = parsed.get('response', 'Задача создана для вашего бухгалтера.')
+    except:
+        # Не JSON - обычный текстовый ответ
+        pass
+    
+    save_message(cursor, user_id, "assistant", response_text)
+    if question and not task_created and not response_text.startswith(ERROR_REPLY_PREFIX):
+        store_cached_response(cursor, question, response_text)
+    return response_text, task_created, task_id
 
 
 def process_message(event: dict) -> dict:
@@ -185,50 +752,46 @@ def process_message(event: dict) -> dict:
         return cors_response(400, {"error": "Message is required"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Сохранить сообщение пользователя
-        save_message(cursor, user_id, "user", user_message)
-        
-        # Получить историю
-        chat_history = get_chat_history(cursor, user_id, limit=10)
-        
-        # Вызвать OpenAI
-        ai_response = call_openai(chat_history)
-        
-        # Попробовать распарсить как JSON (создание задачи)
-        task_created = False
-        task_id = None
-        response_text = ai_response
-        
-        try:
-            parsed = json.loads(ai_response)
-            if 'create_task' in parsed:
-                task_id = create_task_for_accountant(cursor, user_id, parsed['create_task'])
-                task_created = True
-                response_text = parsed.get('response', 'Задача создана для вашего бухгалтера.')
-        except:
-            # Не JSON - обычный текстовый ответ
-            pass
-        
-        # Сохранить ответ AI
-        save_message(cursor, user_id, "assistant", response_text)
-        
-        # Получить инфо о бухгалтере
-        accountant_id = get_accountant_for_client(cursor, user_id)
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {
-            "response": response_text,
-            "task_created": task_created,
-            "task_id": task_id,
-            "has_accountant": accountant_id is not None
-        })
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Сохранить сообщение пользователя
+            save_message(cursor, user_id, "user", user_message)
+            
+            # Получить краткое содержание и последние сообщения
+            chat_history = get_chat_context(cursor, user_id)
+            
+            # Общий вопрос задаётся модели без сводки и истории: ответ на него
+            # не зависит от клиента, поэтому берётся из кэша и кладётся в кэш
+            standalone = is_standalone_question(user_message)
+            cached_response = get_cached_response(cursor, user_message) if standalone else None
+            if cached_response and log_enabled("DEBUG"):
+                log("DEBUG", "Response cache hit", **get_response_cache_stats())
+            cache_question = user_message if standalone and not cached_response else None
+            prompt = [{"role": "user", "content": user_message}] if standalone else chat_history
+            
+            # Вызвать OpenAI
+            ai_response = cached_response or call_openai(prompt)
+            
+            # Создать задачу, если нужно, и сохранить ответ AI
+            response_text, task_created, task_id = handle_ai_response(
+                cursor, user_id, ai_response, cache_question
+            )
+            
+            # Получить инфо о бухгалтере
+            accountant_id = get_accountant_for_client(cursor, user_id)
+            
+            conn.commit()
+            cursor.close()
+            
+            return cors_response(200, {
+                "response": response_text,
+                "task_created": task_created,
+                "task_id": task_id,
+                "has_accountant": accountant_id is not None,
+                "cached": cached_response is not None
+            })
+            
     except Exception as e:
         return cors_response(500, {"error": f"Error: {str(e)}"})
 
@@ -250,31 +813,30 @@ def get_history(event: dict) -> dict:
     limit = int(params.get('limit', 50))
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        
-        cursor.execute(f"""
-            SELECT role, content, created_at
-            FROM {schema}.ai_chat_messages
-            WHERE user_id = %s
-            ORDER BY created_at DESC
-            LIMIT %s
-        """, (user_id, limit))
-        
-        messages = []
-        for row in reversed(cursor.fetchall()):
-            messages.append({
-                "role": row[0],
-                "content": row[1],
-                "created_at": row[2].isoformat() if row[2] else None
-            })
-        
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {"messages": messages})
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            
+            cursor.execute(f"""
+                SELECT role, content, created_at
+                FROM {schema}.ai_chat_messages
+                WHERE user_id = %s
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (user_id, limit))
+            
+            messages = []
+            for row in reversed(cursor.fetchall()):
+                messages.append({
+                    "role": row[0],
+                    "content": row[1],
+                    "created_at": row[2].isoformat() if row[2] else None
+                })
+            
+            cursor.close()
+            
+            return cors_response(200, {"messages": messages})
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
@@ -284,7 +846,27 @@ def handler(event: dict, context) -> dict:
     Главный обработчик AI-чата.
     POST /ai-chat - отправить сообщение
     GET /ai-chat - получить историю
+    Вызов без httpMethod (по таймеру) прогревает клиента OpenAI
+    и удаляет истёкшие записи кэша ответов.
     """
+    start_request_log(event, context)
+    if 'httpMethod' not in event:
+        warm_up_openai()
+        purged = 0
+        try:
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                purged = purge_expired_responses(cursor)
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            log("WARNING", "Response cache purge failed", error=str(e))
+        return cors_response(200, {
+            "warmed_up": True,
+            "purged_responses": purged,
+            "response_cache": get_response_cache_stats()
+        })
+    
     method = event.get('httpMethod', 'GET')
     
     # CORS preflight
@@ -297,3 +879,7 @@ def handler(event: dict, context) -> dict:
         return get_history(event)
     else:
         return cors_response(405, {"error": "Method not allowed"})
+
+
+if get_env("OPENAI_WARM_UP") == "1":
+    warm_up_openai()
@@ -0,0 +1,422 @@
+"""
+Архивация и очистка истории чатов (ai_chat_messages, agent_history).
+Таблицы секционированы по месяцам: функция заранее создаёт секции на
+будущие месяцы, а секции старше срока хранения отсоединяет, выгружает
+в S3 сжатым JSONL и удаляет. Запускается по таймеру.
+"""
+import gzip
+import hmac
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import uuid
+import boto3
+import psycopg2
+from psycopg2 import extensions, pool
+from contextlib import contextmanager
+from datetime import date
+from typing import Any, Optional, Dict, List
+
+
+def get_env(key: str, default: str = "") -> str:
+    """Получить переменную окружения"""
+    return os.environ.get(key, default)
+
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "512"))
+
+# Экземпляр функции обслуживает один запрос за раз, поэтому контекст лога
+# хранится в состоянии модуля
+_log_context: Dict[str, Any] = {"request_id": None, "sampled": True}
+
+
+def start_request_log(event: dict, context) -> None:
+    """
+    Запомнить id запроса для строк лога и решить, попадает ли запрос в выборку:
+    DEBUG/INFO пишутся для доли LOG_SAMPLE_RATE запросов, WARNING и ERROR всегда
+    """
+    request_id = (
+        getattr(context, "request_id", None)
+        or (event.get("requestContext") or {}).get("requestId")
+        or uuid.uuid4().hex
+    )
+    _log_context["request_id"] = request_id
+    _log_context["sampled"] = random.random() < LOG_SAMPLE_RATE
+
+
+def log_enabled(level: str) -> bool:
+    """Дешёвая проверка перед сборкой дорогих полей лога"""
+    level_no = LOG_LEVELS[level]
+    if level_no < LOG_LEVEL:
+        return False
+    return level_no >= LOG_LEVELS["WARNING"] or _log_context["sampled"]
+
+
+def _log_field(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if len(text) > LOG_MAX_FIELD_CHARS:
+        return text[:LOG_MAX_FIELD_CHARS] + f"...(+{len(text) - LOG_MAX_FIELD_CHARS} chars)"
+    return text
+
+
+def _write_log(level: str, message: str, fields: Dict[str, Any]) -> None:
+    record = {"level": level, "msg": message, "request_id": _log_context["request_id"]}
+    for key, value in fields.items():
+        record[key] = _log_field(value)
+    print(json.dumps(record, ensure_ascii=False))
+
+
+def log(level: str, message: str, **fields: Any) -> None:
+    """Одна строка лога в JSON; поля длиннее LOG_MAX_FIELD_CHARS обрезаются"""
+    if log_enabled(level):
+        _write_log(level, message, fields)
+
+
+def log_metric(message: str, **fields: Any) -> None:
+    """
+    Строка INFO с итогами запуска, которая не отбрасывается выборкой:
+    при LOG_SAMPLE_RATE < 1 счётчики остаются полными
+    """
+    if LOG_LEVELS["INFO"] >= LOG_LEVEL:
+        _write_log("INFO", message, fields)
+
+
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(get_env("DB_POOL_MIN_SIZE", "1")),
+            int(get_env("DB_POOL_MAX_SIZE", "5")),
+            get_env("DATABASE_URL")
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(get_env("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(get_env("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+
+
+def cors_response(status_code: int, body: dict) -> dict:
+    """Формирование ответа с CORS заголовками"""
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, X-Retention-Token'
+        },
+        'body': json.dumps(body, ensure_ascii=False, default=str)
+    }
+
+
+PARTITIONED_TABLES = ("ai_chat_messages", "agent_history")
+CHAT_RETENTION_MONTHS = int(get_env("CHAT_RETENTION_MONTHS", "12"))
+CHAT_PARTITIONS_AHEAD = int(get_env("CHAT_PARTITIONS_AHEAD", "2"))
+CHAT_ARCHIVE_BUCKET = get_env("CHAT_ARCHIVE_BUCKET", "files")
+CHAT_ARCHIVE_PREFIX = get_env("CHAT_ARCHIVE_PREFIX", "archive/chat-history")
+EXPORT_FETCH_SIZE = 5000
+
+PARTITION_NAME_RE = re.compile(r"_p(\d{4})_(\d{2})$")
+
+
+def get_s3_client():
+    """Создать S3 клиента"""
+    return boto3.client(
+        's3',
+        endpoint_url='https://bucket.poehali.dev',
+        aws_access_key_id=get_env('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=get_env('AWS_SECRET_ACCESS_KEY')
+    )
+
+
+def add_months(month: date, months: int) -> date:
+    """Первое число месяца, отстоящего на months от month"""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    """Имя месячной секции: ai_chat_messages_p2025_01"""
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+def get_default_partition_months(cursor, table: str) -> List[date]:
+    """Месяцы, строки которых попали в секцию по умолчанию, потому что для них не было секции"""
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    cursor.execute("SELECT to_regclass(%s)", (f"{schema}.{table}_default",))
+    if not cursor.fetchone()[0]:
+        return []
+    cursor.execute(f"SELECT DISTINCT date_trunc('month', created_at)::date FROM {schema}.{table}_default")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_partition(cursor, table: str, month: date) -> None:
+    """
+    Создать месячную секцию. Если строки этого месяца уже лежат в секции
+    по умолчанию (таймер пропустил запуски), они переносятся в новую секцию
+    в той же транзакции: иначе PostgreSQL не даёт создать секцию с этим диапазоном.
+    """
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    name = partition_name(table, month)
+    default = f"{table}_default"
+    bounds = (month, add_months(month, 1))
+    
+    has_rows = False
+    cursor.execute("SELECT to_regclass(%s)", (f"{schema}.{default}",))
+    if cursor.fetchone()[0]:
+        # Вставки в секцию по умолчанию ждут конца транзакции
+        cursor.execute(f"LOCK TABLE {schema}.{default} IN EXCLUSIVE MODE")
+        cursor.execute(f"""
+            SELECT EXISTS (SELECT 1 FROM {schema}.{default} WHERE created_at >= %s AND created_at < %s)
+        """, bounds)
+        has_rows = cursor.fetchone()[0]
+    
+    if not has_rows:
+        cursor.execute(f"""
+            CREATE TABLE {schema}.{name} PARTITION OF {schema}.{table}
+            FOR VALUES FROM (%s) TO (%s)
+        """, bounds)
+        return
+    
+    cursor.execute(f"CREATE TABLE {schema}.{name} (LIKE {schema}.{table} INCLUDING DEFAULTS)")
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM {schema}.{default}
+            WHERE created_at >= %s AND created_at < %s
+            RETURNING *
+        )
+        INSERT INTO {schema}.{name} SELECT * FROM moved
+    """, bounds)
+    cursor.execute(f"""
+        ALTER TABLE {schema}.{table} ATTACH PARTITION {schema}.{name}
+        FOR VALUES FROM (%s) TO (%s)
+    """, bounds)
+
+
+def ensure_partitions(cursor, table: str, months_ahead: int) -> List[str]:
+    """
+    Создать секции с текущего месяца на months_ahead месяцев вперёд, а также
+    для месяцев, строки которых оказались в секции по умолчанию
+    """
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    current = date.today().replace(day=1)
+    months = {add_months(current, offset) for offset in range(months_ahead + 1)}
+    months.update(get_default_partition_months(cursor, table))
+    created = []
+    
+    for month in sorted(months):
+        name = partition_name(table, month)
+        cursor.execute("SELECT to_regclass(%s)", (f"{schema}.{name}",))
+        if cursor.fetchone()[0]:
+            continue
+        create_partition(cursor, table, month)
+        created.append(name)
+    return created
+
+
+def get_expired_partitions(cursor, table: str, cutoff: date) -> List[Dict]:
+    """
+    Месячные секции таблицы старше cutoff — и подключённые, и уже
+    отсоединённые прошлым запуском, но не выгруженные из-за ошибки
+    """
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    cursor.execute("""
+        SELECT c.relname, i.inhparent IS NOT NULL
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+        WHERE n.nspname = %s AND c.relkind = 'r' AND c.relname LIKE %s
+        ORDER BY c.relname
+    """, (schema, f"{table}\\_p%"))
+    
+    partitions = []
+    for name, attached in cursor.fetchall():
+        match = PARTITION_NAME_RE.search(name)
+        if not match or name != partition_name(table, date(int(match.group(1)), int(match.group(2)), 1)):
+            continue
+        month = date(int(match.group(1)), int(match.group(2)), 1)
+        if month < cutoff:
+            partitions.append({"name": name, "month": month, "attached": attached})
+    return partitions
+
+
+def export_partition(conn, partition: str, s3_key: str) -> int:
+    """
+    Выгрузить секцию в S3 сжатым JSONL (строка таблицы — строка файла).
+    Строки читаются серверным курсором порциями, файл собирается на диске.
+    """
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    rows = 0
+    
+    with tempfile.TemporaryFile() as archive:
+        with gzip.GzipFile(fileobj=archive, mode="wb") as gz:
+            with conn.cursor(name=f"export_{partition}") as cursor:
+                cursor.itersize = EXPORT_FETCH_SIZE
+                cursor.execute(f"SELECT row_to_json(t)::text FROM {schema}.{partition} t")
+                for (line,) in cursor:
+                    gz.write(line.encode())
+                    gz.write(b"\n")
+                    rows += 1
+        
+        archive.seek(0)
+        get_s3_client().upload_fileobj(
+            archive,
+            CHAT_ARCHIVE_BUCKET,
+            s3_key,
+            ExtraArgs={"ContentType": "application/x-ndjson", "ContentEncoding": "gzip"}
+        )
+    return rows
+
+
+def archive_partition(conn, table: str, partition: Dict) -> Dict:
+    """
+    Отсоединить секцию (сразу пропадает из запросов к таблице), выгрузить
+    в S3 и удалить. Если выгрузка не удалась, секция остаётся отсоединённой
+    и будет выгружена при следующем запуске.
+    """
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    name = partition["name"]
+    cursor = conn.cursor()
+    
+    if partition["attached"]:
+        cursor.execute(f"ALTER TABLE {schema}.{table} DETACH PARTITION {schema}.{name}")
+        conn.commit()
+    
+    s3_key = f"{CHAT_ARCHIVE_PREFIX}/{table}/{partition['month']:%Y-%m}.jsonl.gz"
+    rows = export_partition(conn, name, s3_key)
+    
+    cursor.execute(f"DROP TABLE {schema}.{name}")
+    conn.commit()
+    cursor.close()
+    
+    return {"partition": name, "rows": rows, "s3_key": s3_key}
+
+
+def run_retention() -> Dict:
+    """Создать будущие секции и заархивировать секции старше CHAT_RETENTION_MONTHS месяцев"""
+    cutoff = add_months(date.today().replace(day=1), -CHAT_RETENTION_MONTHS)
+    report = {"cutoff": cutoff.isoformat(), "created": [], "archived": [], "errors": []}
+    
+    with db_connection() as conn:
+        for table in PARTITIONED_TABLES:
+            cursor = conn.cursor()
+            try:
+                report["created"].extend(ensure_partitions(cursor, table, CHAT_PARTITIONS_AHEAD))
+                conn.commit()
+            except Exception as e:
+                # Архивация старых секций выполняется и без новых секций
+                conn.rollback()
+                report["errors"].append({"table": table, "error": str(e)})
+            
+            expired = get_expired_partitions(cursor, table, cutoff)
+            conn.commit()
+            cursor.close()
+            
+            for partition in expired:
+                started_at = time.monotonic()
+                try:
+                    result = archive_partition(conn, table, partition)
+                except Exception as e:
+                    conn.rollback()
+                    report["errors"].append({"partition": partition["name"], "error": str(e)})
+                    continue
+                result["duration_ms"] = round((time.monotonic() - started_at) * 1000, 1)
+                report["archived"].append(result)
+    
+    log_metric("Retention run finished", **report)
+    if report["errors"]:
+        log("ERROR", "Retention run had errors", errors=report["errors"])
+    return report
+
+
+def handler(event: dict, context) -> dict:
+    """
+    Главный обработчик архивации истории чатов.
+    Вызов без httpMethod (по таймеру) запускает архивацию.
+    POST /chat-retention - ручной запуск, нужен заголовок X-Retention-Token
+    """
+    start_request_log(event, context)
+    method = event.get('httpMethod')
+    
+    if method == 'OPTIONS':
+        return cors_response(200, {})
+    
+    if method is not None:
+        if method != 'POST':
+            return cors_response(405, {"error": "Method not allowed"})
+        
+        token = (event.get('headers') or {}).get('X-Retention-Token', '')
+        expected = get_env("CHAT_RETENTION_TOKEN")
+        if not expected or not hmac.compare_digest(token, expected):
+            return cors_response(403, {"error": "Forbidden"})
+    
+    try:
+        return cors_response(200, run_retention())
+    except Exception as e:
+        log("ERROR", "Retention run failed", error=str(e))
+        return cors_response(500, {"error": f"Database error: {str(e)}"})
@@ -1,6 +1,56 @@
 import json
 import os
+import time
+from typing import Optional
+
 import requests
+from requests.adapters import HTTPAdapter
+
+
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+TELEGRAM_MAX_RETRY_WAIT = float(os.environ.get('TELEGRAM_MAX_RETRY_WAIT', '10'))
+
+_telegram_session: Optional[requests.Session] = None
+
+
+def get_telegram_session() -> requests.Session:
+    '''Keep-alive сессия к api.telegram.org, общая для тёплых вызовов функции'''
+    global _telegram_session
+    if _telegram_session is None:
+        _telegram_session = requests.Session()
+        _telegram_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return _telegram_session
+
+
+def send_telegram_message(bot_token: str, chat_id: str, text: str) -> requests.Response:
+    '''
+    Отправка сообщения через Bot API. Функция отправляет одно сообщение за
+    вызов, поэтому своего ограничителя частоты у неё нет: на 429 запрос
+    повторяется через указанный Telegram retry_after (не больше
+    TELEGRAM_MAX_RETRIES раз и не дольше TELEGRAM_MAX_RETRY_WAIT секунд)
+    '''
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        response = get_telegram_session().post(
+            f'https://api.telegram.org/bot{bot_token}/sendMessage',
+            json={
+                'chat_id': chat_id,
+                'text': text,
+                'parse_mode': 'HTML'
+            },
+            timeout=10
+        )
+        if response.status_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+            break
+        
+        try:
+            retry_after = float(response.json().get('parameters', {}).get('retry_after', 1))
+        except ValueError:
+            retry_after = 1.0
+        if retry_after > TELEGRAM_MAX_RETRY_WAIT:
+            break
+        time.sleep(retry_after)
+    
+    return response
 
 
 def handler(event: dict, context) -> dict:
@@ -72,15 +122,7 @@ def handler(event: dict, context) -> dict:
         
         text_message += f"\n💬 <b>Сообщение:</b>\n{message}\n"
 
-        response = requests.post(
-            f'https://api.telegram.org/bot{bot_token}/sendMessage',
-            json={
-                'chat_id': chat_id,
-                'text': text_message,
-                'parse_mode': 'HTML'
-            },
-            timeout=10
-        )
+        response = send_telegram_message(bot_token, chat_id, text_message)
 
         if response.status_code != 200:
             return {
@@ -4,11 +4,18 @@ API для загрузки и управления бухгалтерскими
 """
 import json
 import os
+import hashlib
 import base64
+import time
+import jwt
 import psycopg2
+from psycopg2 import extensions, pool
+from collections import OrderedDict
+from contextlib import contextmanager
 import boto3
+from botocore.exceptions import ClientError
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Dict, List, Tuple
 
 
 def get_env(key: str, default: str = "") -> str:
@@ -16,10 +23,75 @@ def get_env(key: str, default: str = "") -> str:
     return os.environ.get(key, default)
 
 
-def get_db_connection():
-    """Создать подключение к базе данных"""
-    dsn = get_env("DATABASE_URL")
-    return psycopg2.connect(dsn)
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(get_env("DB_POOL_MIN_SIZE", "1")),
+            int(get_env("DB_POOL_MAX_SIZE", "5")),
+            get_env("DATABASE_URL")
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(get_env("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(get_env("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
 
 
 def get_s3_client():
@@ -32,6 +104,11 @@ def get_s3_client():
     )
 
 
+UPLOAD_PART_SIZE = int(get_env("UPLOAD_PART_SIZE", str(8 * 1024 * 1024)))
+UPLOAD_URL_TTL = int(get_env("UPLOAD_URL_TTL", "3600"))
+MAX_UPLOAD_PARTS = 10000
+
+
 def cors_response(status_code: int, body: dict) -> dict:
     """Формирование ответа с CORS заголовками"""
     return {
@@ -46,18 +123,63 @@ def cors_response(status_code: int, body: dict) -> dict:
     }
 
 
+JWT_SECRET = get_env("JWT_SECRET")
+JWT_CACHE_MAX_SIZE = int(get_env("JWT_CACHE_MAX_SIZE", "1024"))
+JWT_CACHE_TTL = float(get_env("JWT_CACHE_TTL", "300"))
+
+_jwt_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+jwt_cache_stats = {"hits": 0, "misses": 0}
+
+
 def verify_jwt(token: str) -> Optional[int]:
-    """Проверка JWT токена и извлечение user_id"""
+    """
+    Проверка JWT токена и извлечение user_id.
+    Расшифрованные токены кэшируются (LRU по SHA-256 токена) до истечения
+    exp, но не дольше JWT_CACHE_TTL секунд.
+    """
     if not token:
         return None
     
-    import jwt
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    
+    cached = _jwt_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _jwt_cache.move_to_end(token_hash)
+        jwt_cache_stats["hits"] += 1
+        return cached[0]
+    
+    jwt_cache_stats["misses"] += 1
+    _jwt_cache.pop(token_hash, None)
+    
     try:
-        jwt_secret = get_env("JWT_SECRET")
-        payload = jwt.decode(token, jwt_secret, algorithms=["HS256"])
-        return payload.get("user_id")
-    except:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except jwt.PyJWTError:
+        return None
+    
+    user_id = payload.get("user_id")
+    if user_id:
+        expires_at = min(payload.get("exp", now + JWT_CACHE_TTL), now + JWT_CACHE_TTL)
+        _jwt_cache[token_hash] = (user_id, expires_at)
+        if len(_jwt_cache) > JWT_CACHE_MAX_SIZE:
+            _jwt_cache.popitem(last=False)
+    return user_id
+
+
+def enqueue_ocr_job(cursor, document_id: int, file_type: str) -> Optional[str]:
+    """
+    Поставить документ в очередь распознавания (обрабатывается воркером
+    parse-document-ocr). Возвращает статус OCR или None для файлов без OCR.
+    """
+    if not (file_type.startswith('image/') or file_type == 'application/pdf'):
         return None
+    
+    schema = get_env("MAIN_DB_SCHEMA", "public")
+    cursor.execute(f"""
+        INSERT INTO {schema}.ocr_jobs (document_id)
+        VALUES (%s)
+    """, (document_id,))
+    return "pending"
 
 
 def upload_document(event: dict) -> dict:
@@ -110,42 +232,316 @@ def upload_document(event: dict) -> dict:
         file_url = f"https://cdn.poehali.dev/projects/{aws_key}/bucket/{unique_name}"
         
         # Сохранение в БД
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            cursor.execute(f"""
+                INSERT INTO {schema}.accounting_documents 
+                (user_id, file_name, file_url, file_type, file_size, status, s3_key)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id, uploaded_at
+            """, (user_id, file_name, file_url, file_type, file_size, 'pending', unique_name))
+            
+            doc_id, uploaded_at = cursor.fetchone()
+            ocr_status = enqueue_ocr_job(cursor, doc_id, file_type)
+            conn.commit()
+            cursor.close()
+            
+            return cors_response(200, {
+                "success": True,
+                "document": {
+                    "id": doc_id,
+                    "file_name": file_name,
+                    "file_url": file_url,
+                    "file_type": file_type,
+                    "file_size": file_size,
+                    "ocr_status": ocr_status,
+                    "uploaded_at": uploaded_at.isoformat() if uploaded_at else None
+                }
+            })
+            
+    except Exception as e:
+        return cors_response(500, {"error": f"Upload failed: {str(e)}"})
+
+
+def request_upload(event: dict) -> dict:
+    """
+    POST /documents?action=upload-url
+    Выдать presigned-ссылки для загрузки файла напрямую в S3.
+    Файлы больше UPLOAD_PART_SIZE загружаются по частям (multipart).
+    Body: {"file_name": "...", "file_type": "image/jpeg", "file_size": 10485760}
+    """
+    # Авторизация
+    auth_header = event.get('headers', {}).get('X-Authorization', '')
+    token = auth_header.replace('Bearer ', '') if auth_header else ''
+    user_id = verify_jwt(token)
+    
+    if not user_id:
+        return cors_response(401, {"error": "Unauthorized"})
+    
+    # Парсинг тела запроса
+    try:
+        body = json.loads(event.get('body', '{}'))
+    except:
+        return cors_response(400, {"error": "Invalid JSON"})
+    
+    file_name = body.get('file_name', 'document.jpg')
+    file_type = body.get('file_type', 'image/jpeg')
+    file_size = int(body.get('file_size') or 0)
+    
+    if file_size <= 0:
+        return cors_response(400, {"error": "Missing file_size"})
+    
+    part_count = (file_size + UPLOAD_PART_SIZE - 1) // UPLOAD_PART_SIZE
+    if part_count > MAX_UPLOAD_PARTS:
+        return cors_response(400, {"error": "File too large"})
+    
+    try:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        unique_name = f"documents/{user_id}/{timestamp}_{file_name}"
+        aws_key = get_env('AWS_ACCESS_KEY_ID')
+        file_url = f"https://cdn.poehali.dev/projects/{aws_key}/bucket/{unique_name}"
         
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        cursor.execute(f"""
-            INSERT INTO {schema}.accounting_documents 
-            (file_name, file_url, file_type, file_size, status)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id, uploaded_at
-        """, (file_name, file_url, file_type, file_size, 'pending'))
+        s3 = get_s3_client()
+        if part_count > 1:
+            upload_id = s3.create_multipart_upload(
+                Bucket='files',
+                Key=unique_name,
+                ContentType=file_type
+            )['UploadId']
+            upload = {
+                "upload_id": upload_id,
+                "part_size": UPLOAD_PART_SIZE,
+                "part_urls": [
+                    s3.generate_presigned_url('upload_part', Params={
+                        'Bucket': 'files',
+                        'Key': unique_name,
+                        'UploadId': upload_id,
+                        'PartNumber': part_number
+                    }, ExpiresIn=UPLOAD_URL_TTL)
+                    for part_number in range(1, part_count + 1)
+                ]
+            }
+        else:
+            upload = {
+                "upload_url": s3.generate_presigned_url('put_object', Params={
+                    'Bucket': 'files',
+                    'Key': unique_name,
+                    'ContentType': file_type
+                }, ExpiresIn=UPLOAD_URL_TTL)
+            }
         
-        doc_id, uploaded_at = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            cursor.execute(f"""
+                INSERT INTO {schema}.accounting_documents 
+                (user_id, file_name, file_url, file_type, file_size, status, s3_key)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (user_id, file_name, file_url, file_type, file_size, 'uploading', unique_name))
+            
+            doc_id = cursor.fetchone()[0]
+            conn.commit()
+            cursor.close()
         
         return cors_response(200, {
             "success": True,
-            "document": {
-                "id": doc_id,
-                "file_name": file_name,
-                "file_url": file_url,
-                "file_type": file_type,
-                "file_size": file_size,
-                "uploaded_at": uploaded_at.isoformat() if uploaded_at else None
-            }
+            "document_id": doc_id,
+            **upload
         })
         
     except Exception as e:
         return cors_response(500, {"error": f"Upload failed: {str(e)}"})
 
 
+def complete_upload(event: dict) -> dict:
+    """
+    POST /documents?action=complete
+    Подтвердить загрузку по presigned-ссылке: собрать multipart-файл
+    и сохранить фактический размер и контрольную сумму (ETag) объекта.
+    Body: {"document_id": 1, "upload_id": "...", "parts": [{"part_number": 1, "etag": "..."}]}
+    """
+    # Авторизация
+    auth_header = event.get('headers', {}).get('X-Authorization', '')
+    token = auth_header.replace('Bearer ', '') if auth_header else ''
+    user_id = verify_jwt(token)
+    
+    if not user_id:
+        return cors_response(401, {"error": "Unauthorized"})
+    
+    # Парсинг тела запроса
+    try:
+        body = json.loads(event.get('body', '{}'))
+    except:
+        return cors_response(400, {"error": "Invalid JSON"})
+    
+    document_id = body.get('document_id')
+    upload_id = body.get('upload_id')
+    parts = body.get('parts') or []
+    
+    if not document_id:
+        return cors_response(400, {"error": "Missing document_id"})
+    
+    if upload_id and not parts:
+        return cors_response(400, {"error": "Missing parts"})
+    
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            # Строка блокируется до конца транзакции: повторное подтверждение
+            # ждёт первое и получает 409, задача OCR ставится один раз
+            cursor.execute(f"""
+                SELECT s3_key, status
+                FROM {schema}.accounting_documents
+                WHERE id = %s AND user_id = %s
+                FOR UPDATE
+            """, (document_id, user_id))
+            
+            row = cursor.fetchone()
+            if not row:
+                cursor.close()
+                return cors_response(404, {"error": "Document not found"})
+            
+            s3_key, status = row
+            if status != 'uploading':
+                cursor.close()
+                return cors_response(409, {"error": "Upload already completed"})
+            
+            s3 = get_s3_client()
+            try:
+                if upload_id:
+                    s3.complete_multipart_upload(
+                        Bucket='files',
+                        Key=s3_key,
+                        UploadId=upload_id,
+                        MultipartUpload={'Parts': [
+                            {'PartNumber': int(part['part_number']), 'ETag': part['etag']}
+                            for part in parts
+                        ]}
+                    )
+                head = s3.head_object(Bucket='files', Key=s3_key)
+            except ClientError as e:
+                cursor.close()
+                return cors_response(400, {"error": f"File not uploaded: {str(e)}"})
+            
+            file_size = head['ContentLength']
+            checksum = head['ETag'].strip('"')
+            
+            cursor.execute(f"""
+                UPDATE {schema}.accounting_documents
+                SET file_size = %s, checksum = %s, status = 'pending'
+                WHERE id = %s AND status = 'uploading'
+                RETURNING file_name, file_url, file_type, uploaded_at
+            """, (file_size, checksum, document_id))
+            
+            row = cursor.fetchone()
+            if not row:
+                cursor.close()
+                return cors_response(409, {"error": "Upload already completed"})
+            
+            file_name, file_url, file_type, uploaded_at = row
+            ocr_status = enqueue_ocr_job(cursor, document_id, file_type)
+            conn.commit()
+            cursor.close()
+            
+            return cors_response(200, {
+                "success": True,
+                "document": {
+                    "id": document_id,
+                    "file_name": file_name,
+                    "file_url": file_url,
+                    "file_type": file_type,
+                    "file_size": file_size,
+                    "checksum": checksum,
+                    "ocr_status": ocr_status,
+                    "uploaded_at": uploaded_at.isoformat() if uploaded_at else None
+                }
+            })
+            
+    except Exception as e:
+        return cors_response(500, {"error": f"Upload failed: {str(e)}"})
+
+
+def get_document(event: dict) -> dict:
+    """
+    GET /documents?id=123
+    Получить документ со статусом и результатом распознавания
+    """
+    # Авторизация
+    auth_header = event.get('headers', {}).get('X-Authorization', '')
+    token = auth_header.replace('Bearer ', '') if auth_header else ''
+    user_id = verify_jwt(token)
+    
+    if not user_id:
+        return cors_response(401, {"error": "Unauthorized"})
+    
+    params = event.get('queryStringParameters', {}) or {}
+    
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            cursor.execute(f"""
+                SELECT id, file_name, file_url, file_type, file_size, 
+                       status, uploaded_at, processed_at, extracted_data, ocr_error
+                FROM {schema}.accounting_documents
+                WHERE id = %s AND user_id = %s
+            """, (params['id'], user_id))
+            
+            row = cursor.fetchone()
+            cursor.close()
+            
+            if not row:
+                return cors_response(404, {"error": "Document not found"})
+            
+            return cors_response(200, {
+                "document": {
+                    "id": row[0],
+                    "file_name": row[1],
+                    "file_url": row[2],
+                    "file_type": row[3],
+                    "file_size": row[4],
+                    "status": row[5],
+                    "uploaded_at": row[6].isoformat() if row[6] else None,
+                    "processed_at": row[7].isoformat() if row[7] else None,
+                    "extracted_data": row[8],
+                    "ocr_error": row[9]
+                }
+            })
+            
+    except Exception as e:
+        return cors_response(500, {"error": f"Database error: {str(e)}"})
+
+
+def encode_cursor(uploaded_at: str, doc_id: int) -> str:
+    """Упаковать позицию последнего документа страницы в непрозрачный курсор"""
+    raw = json.dumps([uploaded_at, doc_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor_value: str) -> Optional[Tuple[str, int]]:
+    """Распаковать курсор; None, если курсор повреждён"""
+    try:
+        padded = cursor_value + '=' * (-len(cursor_value) % 4)
+        uploaded_at, doc_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(uploaded_at).isoformat(), int(doc_id)
+    except (ValueError, TypeError):
+        return None
+
+
 def get_documents(event: dict) -> dict:
     """
-    GET /documents?limit=50&offset=0
-    Получить список документов пользователя
+    GET /documents?limit=50&cursor=...
+    Получить список документов пользователя (новые первыми).
+    Страницы выбираются по курсору через индекс (user_id, uploaded_at, id),
+    следующая страница — по next_cursor из ответа.
+    Незавершённые загрузки (status = 'uploading') в список не попадают.
     """
     # Авторизация
     auth_header = event.get('headers', {}).get('X-Authorization', '')
@@ -157,40 +553,66 @@ def get_documents(event: dict) -> dict:
     
     # Параметры пагинации
     params = event.get('queryStringParameters', {}) or {}
-    limit = int(params.get('limit', 50))
-    offset = int(params.get('offset', 0))
+    try:
+        limit = int(params.get('limit', 50))
+    except ValueError:
+        return cors_response(400, {"error": "Invalid limit"})
+    
+    position = None
+    if params.get('cursor'):
+        position = decode_cursor(params['cursor'])
+        if position is None:
+            return cors_response(400, {"error": "Invalid cursor"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        cursor.execute(f"""
-            SELECT id, file_name, file_url, file_type, file_size, 
-                   status, uploaded_at, processed_at
-            FROM {schema}.accounting_documents
-            ORDER BY uploaded_at DESC
-            LIMIT %s OFFSET %s
-        """, (limit, offset))
-        
-        documents = []
-        for row in cursor.fetchall():
-            documents.append({
-                "id": row[0],
-                "file_name": row[1],
-                "file_url": row[2],
-                "file_type": row[3],
-                "file_size": row[4],
-                "status": row[5],
-                "uploaded_at": row[6].isoformat() if row[6] else None,
-                "processed_at": row[7].isoformat() if row[7] else None
-            })
-        
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {"documents": documents})
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            
+            if position:
+                cursor.execute(f"""
+                    SELECT id, file_name, file_url, file_type, file_size, 
+                           status, uploaded_at, processed_at
+                    FROM {schema}.accounting_documents
+                    WHERE user_id = %s AND status <> 'uploading'
+                      AND (uploaded_at, id) < (%s::timestamp, %s)
+                    ORDER BY uploaded_at DESC, id DESC
+                    LIMIT %s
+                """, (user_id, position[0], position[1], limit + 1))
+            else:
+                cursor.execute(f"""
+                    SELECT id, file_name, file_url, file_type, file_size, 
+                           status, uploaded_at, processed_at
+                    FROM {schema}.accounting_documents
+                    WHERE user_id = %s AND status <> 'uploading'
+                    ORDER BY uploaded_at DESC, id DESC
+                    LIMIT %s
+                """, (user_id, limit + 1))
+            
+            rows = cursor.fetchall()
+            cursor.close()
+            
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(rows[-1][6].isoformat(), rows[-1][0])
+            
+            documents = []
+            for row in rows:
+                documents.append({
+                    "id": row[0],
+                    "file_name": row[1],
+                    "file_url": row[2],
+                    "file_type": row[3],
+                    "file_size": row[4],
+                    "status": row[5],
+                    "uploaded_at": row[6].isoformat() if row[6] else None,
+                    "processed_at": row[7].isoformat() if row[7] else None
+                })
+            
+            return cors_response(200, {"documents": documents, "next_cursor": next_cursor})
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
@@ -198,8 +620,11 @@ def get_documents(event: dict) -> dict:
 def handler(event: dict, context) -> dict:
     """
     Главный обработчик для работы с документами.
-    POST /documents - загрузка документа
+    POST /documents - загрузка документа (base64 в JSON)
+    POST /documents?action=upload-url - presigned-ссылки для загрузки в S3
+    POST /documents?action=complete - подтверждение загрузки
     GET /documents - список документов
+    GET /documents?id=123 - документ со статусом распознавания
     """
     method = event.get('httpMethod', 'GET')
     
@@ -208,8 +633,19 @@ def handler(event: dict, context) -> dict:
         return cors_response(200, {})
     
     if method == 'POST':
-        return upload_document(event)
+        params = event.get('queryStringParameters', {}) or {}
+        action = params.get('action')
+        
+        if action == 'upload-url':
+            return request_upload(event)
+        elif action == 'complete':
+            return complete_upload(event)
+        else:
+            return upload_document(event)
     elif method == 'GET':
+        params = event.get('queryStringParameters', {}) or {}
+        if params.get('id'):
+            return get_document(event)
         return get_documents(event)
     else:
         return cors_response(405, {"error": "Method not allowed"})
@@ -10,21 +10,163 @@ Flow:
 """
 
 import json
+import math
 import os
 import hashlib
+import random
 import secrets
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import Any, Optional, Dict, List, Tuple
 import psycopg2
+from psycopg2 import extensions, pool
 import jwt
 
 
+# =============================================================================
+# LOGGING
+# =============================================================================
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "512"))
+
+# One request at a time per function instance, so plain module state is enough
+# and worker threads log with the id of the request that started them
+_log_context: Dict[str, Any] = {"request_id": None, "sampled": True}
+
+
+def start_request_log(event: dict, context) -> None:
+    """
+    Bind the request id used to correlate log lines and decide whether this
+    request is sampled: DEBUG/INFO lines are written for LOG_SAMPLE_RATE of
+    requests, WARNING and ERROR always.
+    """
+    request_id = (
+        getattr(context, "request_id", None)
+        or (event.get("requestContext") or {}).get("requestId")
+        or uuid.uuid4().hex
+    )
+    _log_context["request_id"] = request_id
+    _log_context["sampled"] = random.random() < LOG_SAMPLE_RATE
+
+
+def log_enabled(level: str) -> bool:
+    """Cheap check to guard building expensive log fields."""
+    level_no = LOG_LEVELS[level]
+    if level_no < LOG_LEVEL:
+        return False
+    return level_no >= LOG_LEVELS["WARNING"] or _log_context["sampled"]
+
+
+def _log_field(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if len(text) > LOG_MAX_FIELD_CHARS:
+        return text[:LOG_MAX_FIELD_CHARS] + f"...(+{len(text) - LOG_MAX_FIELD_CHARS} chars)"
+    return text
+
+
+def _write_log(level: str, message: str, fields: Dict[str, Any]) -> None:
+    record = {"level": level, "msg": message, "request_id": _log_context["request_id"]}
+    for key, value in fields.items():
+        record[key] = _log_field(value)
+    print(json.dumps(record, ensure_ascii=False))
+
+
+def log(level: str, message: str, **fields: Any) -> None:
+    """Write one JSON log line; fields longer than LOG_MAX_FIELD_CHARS are truncated."""
+    if log_enabled(level):
+        _write_log(level, message, fields)
+
+
+def log_metric(message: str, **fields: Any) -> None:
+    """
+    Write an INFO line with run totals (worker throughput, sweep counts) that
+    is never sampled away, so the numbers stay complete at LOG_SAMPLE_RATE < 1.
+    """
+    if LOG_LEVELS["INFO"] >= LOG_LEVEL:
+        _write_log("INFO", message, fields)
+
+
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
 
-def get_db_connection():
-    return psycopg2.connect(os.environ["DATABASE_URL"])
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Process-wide connection pool, reused across warm invocations."""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            int(os.environ.get("DB_POOL_MAX_SIZE", "5")),
+            os.environ["DATABASE_URL"],
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Check a pooled connection before handing it out: not closed, younger than
+    DB_CONN_MAX_LIFETIME seconds and, after idling longer than
+    DB_CONN_PING_AFTER seconds, still answering SELECT 1.
+    """
+    if conn.closed:
+        return False
+
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(os.environ.get("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+
+    if now - last_used_at > float(os.environ.get("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Borrow a connection from the pool. Any uncommitted transaction is rolled
+    back on exit and the connection goes back to the pool.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
 
 
 def get_schema() -> str:
@@ -65,65 +207,107 @@ def create_jwt(user_id: int, secret: str, expires_in: int = 900) -> str:
 # DATABASE OPERATIONS
 # =============================================================================
 
-def get_auth_token(cursor, token: str) -> Optional[dict]:
-    """Get auth token data by token."""
-    token_hash = hash_token(token)
+def consume_auth_token(
+    cursor,
+    token_hash: str,
+    refresh_token_hash: str,
+    refresh_expires: datetime
+) -> Optional[dict]:
+    """
+    Exchange an auth token for a session in one statement: mark the token
+    used (only if unused and not expired), create or update the user by
+    telegram_id and save the refresh token. Returns the user, or None if the
+    token could not be consumed (see get_auth_token_error).
+    """
     schema = get_schema()
-
     cursor.execute(f"""
-        SELECT telegram_id, telegram_username, telegram_first_name,
-               telegram_last_name, telegram_photo_url, expires_at, used
-        FROM {schema}telegram_auth_tokens
-        WHERE token_hash = %s
-    """, (token_hash,))
+        WITH consumed AS (
+            UPDATE {schema}telegram_auth_tokens
+            SET used = TRUE, used_at = NOW()
+            WHERE token_hash = %s AND used = FALSE AND expires_at > NOW()
+              AND telegram_id IS NOT NULL
+            RETURNING telegram_id, telegram_username, telegram_first_name,
+                      telegram_last_name, telegram_photo_url
+        ),
+        upserted AS (
+            INSERT INTO {schema}users AS u
+                (telegram_id, name, avatar_url, email_verified, password_hash,
+                 created_at, updated_at, last_login_at)
+            SELECT telegram_id,
+                   COALESCE(
+                       NULLIF(concat_ws(' ', NULLIF(telegram_first_name, ''), NULLIF(telegram_last_name, '')), ''),
+                       NULLIF(telegram_username, ''),
+                       'User ' || telegram_id
+                   ),
+                   telegram_photo_url, TRUE, '', NOW(), NOW(), NOW()
+            FROM consumed
+            ON CONFLICT (telegram_id) DO UPDATE
+            SET name = COALESCE(EXCLUDED.name, u.name),
+                avatar_url = COALESCE(EXCLUDED.avatar_url, u.avatar_url),
+                last_login_at = NOW(),
+                updated_at = NOW()
+            RETURNING u.id, u.email, u.name, u.avatar_url, u.telegram_id
+        ),
+        session AS (
+            INSERT INTO {schema}refresh_tokens (user_id, token_hash, expires_at)
+            SELECT id, %s, %s FROM upserted
+        )
+        SELECT id, email, name, avatar_url, telegram_id FROM upserted
+    """, (token_hash, refresh_token_hash, refresh_expires))
 
     row = cursor.fetchone()
-    if not row:
-        return None
-
-    return {
-        "telegram_id": row[0],
-        "telegram_username": row[1],
-        "telegram_first_name": row[2],
-        "telegram_last_name": row[3],
-        "telegram_photo_url": row[4],
-        "expires_at": row[5],
-        "used": row[6],
-    }
+    if row:
+        return {
+            "id": row[0],
+            "email": row[1],
+            "name": row[2],
+            "avatar_url": row[3],
+            "telegram_id": row[4],
+        }
+    return None
 
 
-def mark_token_used(cursor, token: str) -> bool:
-    """Mark token as used."""
-    token_hash = hash_token(token)
+def get_auth_token_error(cursor, token_hash: str) -> Tuple[int, str]:
+    """Slow path: explain why an auth token could not be consumed."""
     schema = get_schema()
-
     cursor.execute(f"""
-        UPDATE {schema}telegram_auth_tokens
-        SET used = TRUE
-        WHERE token_hash = %s AND used = FALSE
-        RETURNING id
+        SELECT telegram_id, expires_at > NOW(), used
+        FROM {schema}telegram_auth_tokens
+        WHERE token_hash = %s
     """, (token_hash,))
 
-    return cursor.fetchone() is not None
-
-
-def cleanup_expired_tokens(cursor) -> None:
-    """Remove expired auth tokens."""
-    schema = get_schema()
-    cursor.execute(f"""
-        DELETE FROM {schema}telegram_auth_tokens
-        WHERE expires_at < NOW() OR (used = TRUE AND created_at < NOW() - INTERVAL '1 hour')
-    """)
+    row = cursor.fetchone()
+    if not row:
+        return 404, "Token not found"
+    if not row[1]:
+        return 410, "Token expired"
+    if row[2]:
+        return 410, "Token already used"
+    return 400, "Token not authenticated"
 
 
-def find_user_by_telegram_id(cursor, telegram_id: str) -> Optional[dict]:
-    """Find user by Telegram ID."""
+def rotate_refresh_token(cursor, token_hash: str, new_token_hash: str, expires_at: datetime) -> Optional[dict]:
+    """
+    Consume a refresh token and issue its replacement in one statement.
+    Returns the owning user, or None if the token is unknown, expired or
+    was already rotated by a concurrent request.
+    """
     schema = get_schema()
     cursor.execute(f"""
-        SELECT id, email, name, avatar_url, telegram_id
-        FROM {schema}users
-        WHERE telegram_id = %s
-    """, (telegram_id,))
+        WITH consumed AS (
+            DELETE FROM {schema}refresh_tokens
+            WHERE token_hash = %s AND expires_at > NOW()
+            RETURNING user_id
+        ),
+        issued AS (
+            INSERT INTO {schema}refresh_tokens (user_id, token_hash, expires_at)
+            SELECT user_id, %s, %s FROM consumed
+            RETURNING user_id
+        )
+        SELECT u.id, u.email, u.name, u.avatar_url, u.telegram_id
+        FROM issued
+        JOIN {schema}users u ON u.id = issued.user_id
+    """, (token_hash, new_token_hash, expires_at))
 
     row = cursor.fetchone()
     if row:
@@ -137,111 +321,132 @@ def find_user_by_telegram_id(cursor, telegram_id: str) -> Optional[dict]:
     return None
 
 
-def create_or_update_user(
-    cursor,
-    telegram_id: str,
-    username: Optional[str],
-    first_name: Optional[str],
-    last_name: Optional[str],
-    photo_url: Optional[str]
-) -> dict:
-    """Create new user or update existing one."""
+def delete_refresh_token(cursor, token_hash: str) -> None:
+    """Delete refresh token."""
     schema = get_schema()
+    cursor.execute(f"DELETE FROM {schema}refresh_tokens WHERE token_hash = %s", (token_hash,))
 
-    # Build display name
-    name_parts = []
-    if first_name:
-        name_parts.append(first_name)
-    if last_name:
-        name_parts.append(last_name)
-    display_name = " ".join(name_parts) if name_parts else username or f"User {telegram_id}"
-
-    # Check if user exists
-    existing = find_user_by_telegram_id(cursor, telegram_id)
-
-    if existing:
-        # Update existing user
-        cursor.execute(f"""
-            UPDATE {schema}users
-            SET name = COALESCE(%s, name),
-                avatar_url = COALESCE(%s, avatar_url),
-                last_login_at = NOW(),
-                updated_at = NOW()
-            WHERE telegram_id = %s
-            RETURNING id, email, name, avatar_url, telegram_id
-        """, (display_name, photo_url, telegram_id))
-    else:
-        # Create new user
-        cursor.execute(f"""
-            INSERT INTO {schema}users (telegram_id, name, avatar_url, email_verified, password_hash, created_at, updated_at, last_login_at)
-            VALUES (%s, %s, %s, TRUE, '', NOW(), NOW(), NOW())
-            RETURNING id, email, name, avatar_url, telegram_id
-        """, (telegram_id, display_name, photo_url))
 
-    row = cursor.fetchone()
-    return {
-        "id": row[0],
-        "email": row[1],
-        "name": row[2],
-        "avatar_url": row[3],
-        "telegram_id": row[4],
-    }
+# =============================================================================
+# REVOCATION FILTER
+# =============================================================================
 
+class RevocationBloomFilter:
+    """
+    Process-local Bloom filter of recently revoked refresh token hashes.
+    Two generations of `capacity` entries each are kept; when the current one
+    fills up it becomes the previous one and the oldest is dropped. A hit
+    means "probably revoked" with a false positive rate of about `error_rate`.
+    """
 
-def save_refresh_token(cursor, user_id: int, token_hash: str, expires_at: datetime) -> None:
-    """Save hashed refresh token to DB."""
-    schema = get_schema()
-    cursor.execute(f"""
-        INSERT INTO {schema}refresh_tokens (user_id, token_hash, expires_at)
-        VALUES (%s, %s, %s)
-    """, (user_id, token_hash, expires_at))
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._current = bytearray((self.size + 7) // 8)
+        self._previous: Optional[bytearray] = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, token_hash: str) -> List[int]:
+        # token_hash is already a SHA-256 hex digest: enhanced double hashing
+        # seeded from two of its 64-bit words
+        a = int(token_hash[:16], 16) % self.size
+        b = int(token_hash[16:32], 16) % self.size
+        positions = []
+        for i in range(self.hash_count):
+            positions.append(a)
+            a = (a + b) % self.size
+            b = (b + i) % self.size
+        return positions
+
+    def add(self, token_hash: str) -> None:
+        with self._lock:
+            if self._count >= self.capacity:
+                self._previous = self._current
+                self._current = bytearray(len(self._current))
+                self._count = 0
+            for pos in self._positions(token_hash):
+                self._current[pos >> 3] |= 1 << (pos & 7)
+            self._count += 1
+
+    def __contains__(self, token_hash: str) -> bool:
+        positions = self._positions(token_hash)
+        with self._lock:
+            for bits in (self._current, self._previous):
+                if bits is not None and all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+                    return True
+        return False
+
+
+revoked_refresh_tokens = RevocationBloomFilter(
+    int(os.environ.get("REVOCATION_FILTER_CAPACITY", "100000")),
+    float(os.environ.get("REVOCATION_FILTER_ERROR_RATE", "1e-7")),
+)
 
 
-def find_refresh_token(cursor, token_hash: str) -> Optional[dict]:
-    """Find refresh token by hash."""
-    schema = get_schema()
-    cursor.execute(f"""
-        SELECT user_id, expires_at
-        FROM {schema}refresh_tokens
-        WHERE token_hash = %s AND expires_at > NOW()
-    """, (token_hash,))
+# =============================================================================
+# EXPIRY SWEEPER
+# =============================================================================
 
-    row = cursor.fetchone()
-    if row:
-        return {"user_id": row[0], "expires_at": row[1]}
-    return None
+SWEEP_BATCH_SIZE = int(os.environ.get("SWEEP_BATCH_SIZE", "1000"))
+SWEEP_MAX_SECONDS = float(os.environ.get("SWEEP_MAX_SECONDS", "20"))
 
+# Table -> condition for rows the sweeper removes
+SWEEP_TARGETS = {
+    "telegram_auth_tokens": "expires_at < NOW() OR (used = TRUE AND created_at < NOW() - INTERVAL '1 hour')",
+    "refresh_tokens": "expires_at < NOW()",
+}
 
-def delete_refresh_token(cursor, token_hash: str) -> None:
-    """Delete refresh token."""
+
+def sweep_table(conn, table: str, condition: str, deadline: float) -> dict:
+    """
+    Delete matching rows in batches of SWEEP_BATCH_SIZE, committing after each
+    batch so row locks are held only briefly. Rows locked by live requests are
+    skipped and picked up on the next run.
+    """
     schema = get_schema()
-    cursor.execute(f"DELETE FROM {schema}refresh_tokens WHERE token_hash = %s", (token_hash,))
+    started = time.monotonic()
+    removed = 0
+    batches = 0
+
+    with conn.cursor() as cursor:
+        while time.monotonic() < deadline:
+            cursor.execute(f"""
+                DELETE FROM {schema}{table}
+                WHERE ctid = ANY(ARRAY(
+                    SELECT ctid FROM {schema}{table}
+                    WHERE {condition}
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ))
+            """, (SWEEP_BATCH_SIZE,))
+            deleted = cursor.rowcount
+            conn.commit()
+
+            removed += deleted
+            batches += 1
+            if deleted < SWEEP_BATCH_SIZE:
+                break
 
+    return {
+        "removed": removed,
+        "batches": batches,
+        "duration_ms": round((time.monotonic() - started) * 1000, 1),
+    }
 
-def get_user_by_id(cursor, user_id: int) -> Optional[dict]:
-    """Get user by ID."""
-    schema = get_schema()
-    cursor.execute(f"""
-        SELECT id, email, name, avatar_url, telegram_id
-        FROM {schema}users WHERE id = %s
-    """, (user_id,))
 
-    row = cursor.fetchone()
-    if row:
-        return {
-            "id": row[0],
-            "email": row[1],
-            "name": row[2],
-            "avatar_url": row[3],
-            "telegram_id": row[4],
-        }
-    return None
+def run_sweeper() -> dict:
+    """Remove expired auth and refresh tokens and log the per-table totals."""
+    deadline = time.monotonic() + SWEEP_MAX_SECONDS
+    metrics = {}
 
+    with db_connection() as conn:
+        for table, condition in SWEEP_TARGETS.items():
+            metrics[table] = sweep_table(conn, table, condition, deadline)
 
-def cleanup_expired_refresh_tokens(cursor) -> None:
-    """Remove expired refresh tokens."""
-    schema = get_schema()
-    cursor.execute(f"DELETE FROM {schema}refresh_tokens WHERE expires_at < NOW()")
+    log_metric("Expiry sweep finished", **metrics)
+    return metrics
 
 
 # =============================================================================
@@ -287,53 +492,22 @@ def handle_callback(cursor, body: dict) -> dict:
     if not token:
         return cors_response(400, {"error": "Missing token"})
 
-    token_data = get_auth_token(cursor, token)
-
-    if not token_data:
-        return cors_response(404, {"error": "Token not found"})
-
-    # Check if expired (handle both naive and aware datetime from DB)
-    expires_at = token_data["expires_at"]
-    now = datetime.now(timezone.utc)
-    # Convert to naive UTC for comparison if needed
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    if expires_at < now:
-        return cors_response(410, {"error": "Token expired"})
-
-    # Check if already used
-    if token_data["used"]:
-        return cors_response(410, {"error": "Token already used"})
-
-    # Check if user data exists
-    if not token_data["telegram_id"]:
-        return cors_response(400, {"error": "Token not authenticated"})
-
     # Get JWT secret
     jwt_secret = get_env("JWT_SECRET")
     if len(jwt_secret) < 32:
         return cors_response(500, {"error": "Server configuration error"})
 
-    # Create or update user
-    user = create_or_update_user(
-        cursor,
-        telegram_id=token_data["telegram_id"],
-        username=token_data["telegram_username"],
-        first_name=token_data["telegram_first_name"],
-        last_name=token_data["telegram_last_name"],
-        photo_url=token_data["telegram_photo_url"],
-    )
-
-    # Mark token as used
-    mark_token_used(cursor, token)
-
-    # Generate tokens
-    access_token = create_jwt(user["id"], jwt_secret)
+    token_hash = hash_token(token)
     refresh_token = generate_token(48)
-    refresh_token_hash = hash_token(refresh_token)
     refresh_expires = datetime.now(timezone.utc) + timedelta(days=30)
 
-    save_refresh_token(cursor, user["id"], refresh_token_hash, refresh_expires)
+    # Validate and consume the token, upsert the user, save the refresh token
+    user = consume_auth_token(cursor, token_hash, hash_token(refresh_token), refresh_expires)
+    if not user:
+        status, error = get_auth_token_error(cursor, token_hash)
+        return cors_response(status, {"error": error})
+
+    access_token = create_jwt(user["id"], jwt_secret)
 
     return cors_response(200, {
         "access_token": access_token,
@@ -343,10 +517,12 @@ def handle_callback(cursor, body: dict) -> dict:
     })
 
 
-def handle_refresh(cursor, body: dict) -> dict:
+def handle_refresh(cursor, body: dict, revoked: List[str]) -> dict:
     """
     POST ?action=refresh
-    Refresh access token using refresh token.
+    Refresh access token using refresh token. The refresh token is rotated:
+    the old one stops working and a new one is returned. The old token's hash
+    is appended to revoked, to be added to the filter once the rotation commits.
     """
     refresh_token = body.get("refresh_token")
     if not refresh_token:
@@ -355,33 +531,40 @@ def handle_refresh(cursor, body: dict) -> dict:
     jwt_secret = get_env("JWT_SECRET")
     token_hash = hash_token(refresh_token)
 
-    token_data = find_refresh_token(cursor, token_hash)
-    if not token_data:
+    # Replayed token already rotated or logged out in this process
+    if token_hash in revoked_refresh_tokens:
         return cors_response(401, {"error": "Invalid or expired refresh token"})
 
-    user = get_user_by_id(cursor, token_data["user_id"])
+    new_refresh_token = generate_token(48)
+    refresh_expires = datetime.now(timezone.utc) + timedelta(days=30)
+
+    user = rotate_refresh_token(cursor, token_hash, hash_token(new_refresh_token), refresh_expires)
     if not user:
-        return cors_response(401, {"error": "User not found"})
+        return cors_response(401, {"error": "Invalid or expired refresh token"})
+
+    revoked.append(token_hash)
 
     # Generate new access token
     access_token = create_jwt(user["id"], jwt_secret)
 
     return cors_response(200, {
         "access_token": access_token,
+        "refresh_token": new_refresh_token,
         "expires_in": 900,
         "user": user,
     })
 
 
-def handle_logout(cursor, body: dict) -> dict:
+def handle_logout(cursor, body: dict, revoked: List[str]) -> dict:
     """
     POST ?action=logout
-    Invalidate refresh token.
+    Invalidate refresh token (its hash goes to revoked, as in handle_refresh).
     """
     refresh_token = body.get("refresh_token")
     if refresh_token:
         token_hash = hash_token(refresh_token)
         delete_refresh_token(cursor, token_hash)
+        revoked.append(token_hash)
 
     return cors_response(200, {"success": True})
 
@@ -391,7 +574,19 @@ def handle_logout(cursor, body: dict) -> dict:
 # =============================================================================
 
 def handler(event, context):
-    """Main entry point."""
+    """
+    Main entry point.
+    Invocations without httpMethod (timer trigger) run the expiry sweeper.
+    """
+    start_request_log(event, context)
+
+    if "httpMethod" not in event:
+        try:
+            return cors_response(200, run_sweeper())
+        except Exception as e:
+            log("ERROR", "Sweeper error", error=str(e))
+            return cors_response(500, {"error": "Internal server error"})
+
     method = event.get("httpMethod", "GET")
 
     # Handle CORS preflight
@@ -411,35 +606,31 @@ def handler(event, context):
         except json.JSONDecodeError:
             return cors_response(400, {"error": "Invalid JSON"})
 
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Cleanup expired tokens periodically
-        cleanup_expired_tokens(cursor)
-        cleanup_expired_refresh_tokens(cursor)
-
-        # Route to action handler
-        if action == "callback" and method == "POST":
-            response = handle_callback(cursor, body)
-        elif action == "refresh" and method == "POST":
-            response = handle_refresh(cursor, body)
-        elif action == "logout" and method == "POST":
-            response = handle_logout(cursor, body)
-        else:
-            response = cors_response(400, {"error": f"Unknown action: {action}"})
-
-        conn.commit()
-        return response
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            revoked: List[str] = []
+
+            # Route to action handler
+            if action == "callback" and method == "POST":
+                response = handle_callback(cursor, body)
+            elif action == "refresh" and method == "POST":
+                response = handle_refresh(cursor, body, revoked)
+            elif action == "logout" and method == "POST":
+                response = handle_logout(cursor, body, revoked)
+            else:
+                response = cors_response(400, {"error": f"Unknown action: {action}"})
+
+            conn.commit()
+
+            # Only once the database agrees the tokens are gone: if the commit
+            # fails they are still valid and must not be rejected here
+            for token_hash in revoked:
+                revoked_refresh_tokens.add(token_hash)
+            return response
 
     except ValueError as e:
         return cors_response(500, {"error": "Server configuration error"})
     except Exception as e:
-        if conn:
-            conn.rollback()
-        print(f"Error: {e}")
+        log("ERROR", "Request failed", error=str(e))
         return cors_response(500, {"error": "Internal server error"})
-    finally:
-        if conn:
-            conn.close()
@@ -5,17 +5,97 @@ Telegram Bot Function
 1. Webhook от Telegram для авторизации через /start web_auth
 2. Отправку уведомлений через API (action=send, action=send-photo)
 3. Тестовые сообщения (action=test)
+4. Рассылки (action=broadcast): получатели ставятся в очередь, воркер
+   (вызов по таймеру) отправляет их с учётом лимитов Telegram
 """
 
 import json
 import os
 import uuid
 import hashlib
+import hmac
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import Any, Optional, Dict, List, Callable, TypeVar
 
 import psycopg2
+from psycopg2 import extensions, pool
+import requests
+from requests.adapters import HTTPAdapter
 import telebot
+from telebot import apihelper
+
+
+# =============================================================================
+# LOGGING
+# =============================================================================
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "512"))
+
+# One request at a time per function instance, so plain module state is enough
+# and worker threads log with the id of the request that started them
+_log_context: Dict[str, Any] = {"request_id": None, "sampled": True}
+
+
+def start_request_log(event: dict, context) -> None:
+    """
+    Bind the request id used to correlate log lines and decide whether this
+    request is sampled: DEBUG/INFO lines are written for LOG_SAMPLE_RATE of
+    requests, WARNING and ERROR always.
+    """
+    request_id = (
+        getattr(context, "request_id", None)
+        or (event.get("requestContext") or {}).get("requestId")
+        or uuid.uuid4().hex
+    )
+    _log_context["request_id"] = request_id
+    _log_context["sampled"] = random.random() < LOG_SAMPLE_RATE
+
+
+def log_enabled(level: str) -> bool:
+    """Cheap check to guard building expensive log fields."""
+    level_no = LOG_LEVELS[level]
+    if level_no < LOG_LEVEL:
+        return False
+    return level_no >= LOG_LEVELS["WARNING"] or _log_context["sampled"]
+
+
+def _log_field(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if len(text) > LOG_MAX_FIELD_CHARS:
+        return text[:LOG_MAX_FIELD_CHARS] + f"...(+{len(text) - LOG_MAX_FIELD_CHARS} chars)"
+    return text
+
+
+def _write_log(level: str, message: str, fields: Dict[str, Any]) -> None:
+    record = {"level": level, "msg": message, "request_id": _log_context["request_id"]}
+    for key, value in fields.items():
+        record[key] = _log_field(value)
+    print(json.dumps(record, ensure_ascii=False))
+
+
+def log(level: str, message: str, **fields: Any) -> None:
+    """Write one JSON log line; fields longer than LOG_MAX_FIELD_CHARS are truncated."""
+    if log_enabled(level):
+        _write_log(level, message, fields)
+
+
+def log_metric(message: str, **fields: Any) -> None:
+    """
+    Write an INFO line with run totals (worker throughput, sweep counts) that
+    is never sampled away, so the numbers stay complete at LOG_SAMPLE_RATE < 1.
+    """
+    if LOG_LEVELS["INFO"] >= LOG_LEVEL:
+        _write_log("INFO", message, fields)
 
 
 # =============================================================================
@@ -30,9 +110,105 @@ def get_bot_token() -> str:
     return token
 
 
+TELEGRAM_MAX_CONNECTIONS = int(os.environ.get("TELEGRAM_MAX_CONNECTIONS", "8"))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_INTERVAL = float(os.environ.get("TELEGRAM_CHAT_INTERVAL", "1"))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", "3"))
+TELEGRAM_MAX_RETRY_WAIT = float(os.environ.get("TELEGRAM_MAX_RETRY_WAIT", "10"))
+
+_bot: Optional[telebot.TeleBot] = None
+
+T = TypeVar("T")
+
+
 def get_bot() -> telebot.TeleBot:
-    """Create bot instance."""
-    return telebot.TeleBot(get_bot_token())
+    """
+    Process-wide bot instance. All Bot API calls share one keep-alive
+    requests session sized to TELEGRAM_MAX_CONNECTIONS.
+    """
+    global _bot
+    if _bot is None:
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=TELEGRAM_MAX_CONNECTIONS,
+        ))
+        apihelper.session = session
+        apihelper.SESSION_TIME_TO_LIVE = None
+        _bot = telebot.TeleBot(get_bot_token(), threaded=False)
+    return _bot
+
+
+class TelegramRateLimiter:
+    """
+    Spaces out Bot API sends to stay under Telegram's limits: `global_rate`
+    messages per second overall and one message per `chat_interval` seconds
+    to the same chat. The global rate is adaptive: a 429 halves it and
+    pauses all sends for retry_after seconds, each success restores it
+    a little.
+
+    The budget is per process and best-effort: every warm instance assumes
+    the full `global_rate` for the bot. Bulk sends are bounded by running a
+    single broadcast worker at a time (see broadcast_worker_lock); webhook
+    replies from other instances are rare and rely on the 429 backoff.
+    """
+
+    def __init__(self, global_rate: float, chat_interval: float):
+        self.max_rate = global_rate
+        self.rate = global_rate
+        self.chat_interval = chat_interval
+        self._next_global = 0.0
+        self._next_chat: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id) -> None:
+        """Reserve the next send slot for chat_id and sleep until it comes."""
+        chat_key = str(chat_id)
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_global, self._next_chat.get(chat_key, 0.0))
+            self._next_global = slot + 1 / self.rate
+            self._next_chat[chat_key] = slot + self.chat_interval
+            if len(self._next_chat) > 10000:
+                self._next_chat = {k: v for k, v in self._next_chat.items() if v > now}
+        if slot > now:
+            time.sleep(slot - now)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.5)
+
+    def record_throttled(self, chat_id, retry_after: float) -> None:
+        with self._lock:
+            self.rate = max(1.0, self.rate / 2)
+            resume_at = time.monotonic() + retry_after
+            self._next_global = max(self._next_global, resume_at)
+            self._next_chat[str(chat_id)] = max(self._next_chat.get(str(chat_id), 0.0), resume_at)
+
+
+rate_limiter = TelegramRateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL)
+
+
+def send_with_limits(chat_id, send: Callable[[], T]) -> T:
+    """
+    Run a Bot API send through the rate limiter. On 429 the call is retried
+    after the retry_after Telegram asks for (up to TELEGRAM_MAX_RETRIES times
+    and TELEGRAM_MAX_RETRY_WAIT seconds per wait); other errors are raised.
+    """
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        rate_limiter.acquire(chat_id)
+        try:
+            result = send()
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+                raise
+            retry_after = float((e.result_json.get("parameters") or {}).get("retry_after", 1))
+            if retry_after > TELEGRAM_MAX_RETRY_WAIT:
+                raise
+            rate_limiter.record_throttled(chat_id, retry_after)
+            continue
+        rate_limiter.record_success()
+        return result
 
 
 def get_default_chat_id() -> str:
@@ -40,6 +216,77 @@ def get_default_chat_id() -> str:
     return os.environ.get("TELEGRAM_CHAT_ID", "")
 
 
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Process-wide connection pool, reused across warm invocations."""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            int(os.environ.get("DB_POOL_MAX_SIZE", "5")),
+            os.environ["DATABASE_URL"],
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Check a pooled connection before handing it out: not closed, younger than
+    DB_CONN_MAX_LIFETIME seconds and, after idling longer than
+    DB_CONN_PING_AFTER seconds, still answering SELECT 1.
+    """
+    if conn.closed:
+        return False
+
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(os.environ.get("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+
+    if now - last_used_at > float(os.environ.get("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Borrow a connection from the pool. Any uncommitted transaction is rolled
+    back on exit and the connection goes back to the pool.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+
+
 def get_schema() -> str:
     """Get database schema prefix."""
     schema = os.environ.get("MAIN_DB_SCHEMA", "public")
@@ -54,8 +301,8 @@ def get_cors_headers() -> dict:
     allowed_origins = os.environ.get("ALLOWED_ORIGINS", "*")
     return {
         "Access-Control-Allow-Origin": allowed_origins,
-        "Access-Control-Allow-Methods": "POST, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Bot-Api-Secret-Token",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+        "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Bot-Api-Secret-Token, X-Broadcast-Token",
     }
 
 
@@ -90,8 +337,7 @@ def save_auth_token(
     token_hash = hashlib.sha256(token.encode()).hexdigest()
     schema = get_schema()
 
-    conn = psycopg2.connect(os.environ["DATABASE_URL"])
-    try:
+    with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(f"""
             INSERT INTO {schema}telegram_auth_tokens
@@ -108,8 +354,6 @@ def save_auth_token(
             datetime.now(timezone.utc) + timedelta(minutes=5)
         ))
         conn.commit()
-    finally:
-        conn.close()
 
     return token
 
@@ -131,19 +375,21 @@ def handle_web_auth(chat_id: int, user: dict) -> None:
     auth_url = f"{site_url}/auth/telegram/callback?token={token}"
 
     bot = get_bot()
-    bot.send_message(
+    send_with_limits(chat_id, lambda: bot.send_message(
         chat_id,
         f"Авторизация готова!\n\nНажмите кнопку ниже, чтобы войти на сайт 👇\n\nСсылка действительна 5 минут.",
         reply_markup=telebot.types.InlineKeyboardMarkup().add(
             telebot.types.InlineKeyboardButton("Войти на сайт", url=auth_url)
         )
-    )
+    ))
 
 
 def handle_start(chat_id: int) -> None:
     """Обработка команды /start без параметров."""
     bot = get_bot()
-    bot.send_message(chat_id, "Привет! Используйте кнопку «Войти через Telegram» на сайте.")
+    send_with_limits(chat_id, lambda: bot.send_message(
+        chat_id, "Привет! Используйте кнопку «Войти через Telegram» на сайте."
+    ))
 
 
 def process_webhook(body: dict) -> dict:
@@ -162,19 +408,17 @@ def process_webhook(body: dict) -> dict:
 
     try:
         if text.startswith("/start"):
-            print(f"[DEBUG] Processing /start command for chat_id={chat_id}")
             parts = text.split(" ", 1)
             if len(parts) > 1 and parts[1] == "web_auth":
-                print(f"[DEBUG] Handling web_auth")
+                log("DEBUG", "Handling /start web_auth", chat_id=chat_id)
                 handle_web_auth(chat_id, user)
             else:
-                print(f"[DEBUG] Handling regular start")
+                log("DEBUG", "Handling /start", chat_id=chat_id)
                 handle_start(chat_id)
-            print(f"[DEBUG] Message sent successfully")
     except telebot.apihelper.ApiTelegramException as e:
-        print(f"[ERROR] Telegram API error: {e}")
+        log("ERROR", "Telegram API error", chat_id=chat_id, error_code=e.error_code, error=e.description)
     except Exception as e:
-        print(f"[ERROR] Error processing webhook: {e}")
+        log("ERROR", "Error processing webhook", chat_id=chat_id, error=str(e))
 
     return {"statusCode": 200, "body": json.dumps({"ok": True})}
 
@@ -204,13 +448,13 @@ def handle_send(body: dict) -> dict:
 
     try:
         bot = get_bot()
-        result = bot.send_message(
+        result = send_with_limits(chat_id, lambda: bot.send_message(
             chat_id=chat_id,
             text=text,
             parse_mode=parse_mode,
             disable_notification=silent,
             disable_web_page_preview=True,
-        )
+        ))
         return cors_response(200, {
             "success": True,
             "message_id": result.message_id,
@@ -242,12 +486,12 @@ def handle_send_photo(body: dict) -> dict:
 
     try:
         bot = get_bot()
-        result = bot.send_photo(
+        result = send_with_limits(chat_id, lambda: bot.send_photo(
             chat_id=chat_id,
             photo=photo_url,
             caption=caption if caption else None,
             parse_mode=parse_mode,
-        )
+        ))
         return cors_response(200, {
             "success": True,
             "message_id": result.message_id,
@@ -279,11 +523,11 @@ def handle_test(body: dict) -> dict:
 
     try:
         bot = get_bot()
-        result = bot.send_message(
+        result = send_with_limits(chat_id, lambda: bot.send_message(
             chat_id=chat_id,
             text=text,
             parse_mode="HTML",
-        )
+        ))
         return cors_response(200, {
             "success": True,
             "message": "Test message sent",
@@ -298,13 +542,336 @@ def handle_test(body: dict) -> dict:
         return cors_response(500, {"error": str(e)})
 
 
+# =============================================================================
+# BROADCASTS
+# =============================================================================
+
+BROADCAST_MAX_RECIPIENTS = int(os.environ.get("BROADCAST_MAX_RECIPIENTS", "50000"))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "100"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_WORKER_SECONDS = float(os.environ.get("BROADCAST_WORKER_SECONDS", "50"))
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get("BROADCAST_MAX_ATTEMPTS", "5"))
+BROADCAST_LOCK_TIMEOUT = int(os.environ.get("BROADCAST_LOCK_TIMEOUT", "300"))
+
+# Named recipient segments -> query returning chat ids
+BROADCAST_SEGMENTS = {
+    "all": "SELECT telegram_id FROM {schema}users WHERE telegram_id IS NOT NULL",
+    "clients": """
+        SELECT DISTINCT u.telegram_id
+        FROM {schema}users u
+        JOIN {schema}client_accountant_assignments a ON a.client_user_id = u.id
+        WHERE u.telegram_id IS NOT NULL AND a.is_active = true
+    """,
+}
+
+
+def enqueue_broadcast(text: str, parse_mode: Optional[str], chat_ids: Optional[List[str]],
+                      segment: Optional[str]) -> Dict:
+    """
+    Save the broadcast and queue one row per recipient in a single statement
+    (plus the update of its recipient count).
+    Recipients come either from an explicit chat_ids list or a named segment.
+    """
+    schema = get_schema()
+    if segment:
+        recipients_sql = BROADCAST_SEGMENTS[segment].format(schema=schema) + " LIMIT %(limit)s"
+    else:
+        recipients_sql = "SELECT DISTINCT unnest(%(chat_ids)s::varchar[])"
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            WITH broadcast AS (
+                INSERT INTO {schema}telegram_broadcasts (text, parse_mode, segment)
+                VALUES (%(text)s, %(parse_mode)s, %(segment)s)
+                RETURNING id
+            ),
+            queued AS (
+                INSERT INTO {schema}telegram_broadcast_recipients (broadcast_id, chat_id)
+                SELECT broadcast.id, recipients.chat_id
+                FROM broadcast, ({recipients_sql}) AS recipients(chat_id)
+                ON CONFLICT (broadcast_id, chat_id) DO NOTHING
+                RETURNING 1
+            )
+            SELECT (SELECT id FROM broadcast), (SELECT COUNT(*) FROM queued)
+        """, {
+            "text": text,
+            "parse_mode": parse_mode,
+            "segment": segment,
+            "chat_ids": [str(c) for c in chat_ids or []],
+            "limit": BROADCAST_MAX_RECIPIENTS,
+        })
+        broadcast_id, total = cursor.fetchone()
+        # Rows inserted by a CTE are not visible to other parts of the same statement.
+        # With no recipients the worker never sees the broadcast, so complete it here
+        if total:
+            cursor.execute(f"UPDATE {schema}telegram_broadcasts SET total = %s WHERE id = %s", (total, broadcast_id))
+        else:
+            cursor.execute(f"""
+                UPDATE {schema}telegram_broadcasts
+                SET total = 0, status = 'completed', completed_at = NOW()
+                WHERE id = %s
+            """, (broadcast_id,))
+        conn.commit()
+        cursor.close()
+
+    return {"broadcast_id": broadcast_id, "total": total}
+
+
+def dequeue_broadcast_recipients(batch_size: int) -> List[Dict]:
+    """
+    Claim a batch of pending recipients with FOR UPDATE SKIP LOCKED so
+    parallel workers never send the same message twice. Rows stuck in
+    processing longer than BROADCAST_LOCK_TIMEOUT seconds are reclaimed.
+    """
+    schema = get_schema()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            UPDATE {schema}telegram_broadcast_recipients r
+            SET status = 'processing', attempts = r.attempts + 1, locked_at = NOW()
+            FROM {schema}telegram_broadcasts b
+            WHERE b.id = r.broadcast_id
+              AND r.id IN (
+                  SELECT id FROM {schema}telegram_broadcast_recipients
+                  WHERE (status = 'pending' AND run_after <= NOW())
+                     OR (status = 'processing' AND locked_at < NOW() - make_interval(secs => %s))
+                  ORDER BY id
+                  LIMIT %s
+                  FOR UPDATE SKIP LOCKED
+              )
+            RETURNING r.id, r.broadcast_id, r.chat_id, r.attempts, b.text, b.parse_mode
+        """, (BROADCAST_LOCK_TIMEOUT, batch_size))
+        recipients = [
+            {"id": row[0], "broadcast_id": row[1], "chat_id": row[2], "attempts": row[3],
+             "text": row[4], "parse_mode": row[5]}
+            for row in cursor.fetchall()
+        ]
+        conn.commit()
+        cursor.close()
+    return recipients
+
+
+def deliver_broadcast_message(recipient: Dict) -> Dict:
+    """Send one broadcast message; returns the recipient's new status."""
+    bot = get_bot()
+    try:
+        result = send_with_limits(recipient["chat_id"], lambda: bot.send_message(
+            chat_id=recipient["chat_id"],
+            text=recipient["text"],
+            parse_mode=recipient["parse_mode"],
+            disable_web_page_preview=True,
+        ))
+        return {"id": recipient["id"], "status": "sent", "message_id": result.message_id, "error": None}
+    except telebot.apihelper.ApiTelegramException as e:
+        # 400/403: chat not found or bot blocked by the user - retrying will not help
+        retryable = e.error_code == 429 or e.error_code >= 500
+        error = f"{e.error_code}: {e.description}"
+    except Exception as e:
+        retryable = True
+        error = str(e)
+
+    if retryable and recipient["attempts"] < BROADCAST_MAX_ATTEMPTS:
+        return {"id": recipient["id"], "status": "pending", "message_id": None, "error": error,
+                "retry_in": 30 * 2 ** (recipient["attempts"] - 1)}
+    return {"id": recipient["id"], "status": "failed", "message_id": None, "error": error}
+
+
+def save_broadcast_results(results: List[Dict]) -> None:
+    """Record per-recipient delivery status and close finished broadcasts."""
+    schema = get_schema()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            UPDATE {schema}telegram_broadcast_recipients r
+            SET status = v.status,
+                message_id = v.message_id,
+                last_error = v.error,
+                locked_at = NULL,
+                sent_at = CASE WHEN v.status = 'sent' THEN NOW() END,
+                run_after = NOW() + make_interval(secs => v.retry_in)
+            FROM jsonb_to_recordset(%s::jsonb)
+                AS v(id INTEGER, status VARCHAR, message_id BIGINT, error TEXT, retry_in INTEGER)
+            WHERE r.id = v.id
+            RETURNING r.broadcast_id
+        """, (json.dumps([{**r, "retry_in": r.get("retry_in", 0)} for r in results]),))
+        broadcast_ids = list({row[0] for row in cursor.fetchall()})
+
+        cursor.execute(f"""
+            UPDATE {schema}telegram_broadcasts b
+            SET status = 'completed', completed_at = NOW()
+            WHERE b.id = ANY(%s) AND b.status = 'queued'
+              AND NOT EXISTS (
+                  SELECT 1 FROM {schema}telegram_broadcast_recipients r
+                  WHERE r.broadcast_id = b.id AND r.status IN ('pending', 'processing')
+              )
+        """, (broadcast_ids,))
+        conn.commit()
+        cursor.close()
+
+
+@contextmanager
+def broadcast_worker_lock():
+    """
+    Session advisory lock held for the whole worker run, so only one
+    instance sends broadcasts and its rate limiter is the global budget.
+    Yields False when another worker already holds the lock.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext('telegram_broadcast_worker'))")
+        acquired = cursor.fetchone()[0]
+        conn.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired and not conn.closed:
+                cursor.execute("SELECT pg_advisory_unlock(hashtext('telegram_broadcast_worker'))")
+                conn.commit()
+            cursor.close()
+
+
+def process_broadcast_queue() -> Dict:
+    """
+    Broadcast worker: drains the recipient queue in batches with
+    BROADCAST_CONCURRENCY parallel sends (all going through the shared rate
+    limiter) until the queue is empty or BROADCAST_WORKER_SECONDS pass.
+    Skips the run if another worker is already sending.
+    """
+    started = time.monotonic()
+    deadline = started + BROADCAST_WORKER_SECONDS
+    totals = {"sent": 0, "failed": 0, "retry": 0}
+
+    with broadcast_worker_lock() as acquired:
+        if not acquired:
+            log("INFO", "Broadcast worker already running, skipping")
+            return {**totals, "skipped": True}
+
+        # Create the shared bot before the worker threads race to do it
+        get_bot()
+
+        with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY) as executor:
+            while time.monotonic() < deadline:
+                recipients = dequeue_broadcast_recipients(BROADCAST_BATCH_SIZE)
+                if not recipients:
+                    break
+
+                results = list(executor.map(deliver_broadcast_message, recipients))
+                save_broadcast_results(results)
+                for result in results:
+                    totals["retry" if result["status"] == "pending" else result["status"]] += 1
+
+    elapsed = time.monotonic() - started
+    totals["duration_ms"] = round(elapsed * 1000, 1)
+    totals["messages_per_second"] = round(totals["sent"] / elapsed, 2) if elapsed else 0.0
+    log_metric("Broadcast worker finished", **totals)
+    return totals
+
+
+def get_broadcast_status(broadcast_id: int) -> Optional[Dict]:
+    """Broadcast progress: recipient counts by delivery status."""
+    schema = get_schema()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT b.status, b.total, b.created_at, b.completed_at, r.status, COUNT(r.id)
+            FROM {schema}telegram_broadcasts b
+            LEFT JOIN {schema}telegram_broadcast_recipients r ON r.broadcast_id = b.id
+            WHERE b.id = %s
+            GROUP BY b.id, r.status
+        """, (broadcast_id,))
+        rows = cursor.fetchall()
+        cursor.close()
+
+    if not rows:
+        return None
+    return {
+        "broadcast_id": broadcast_id,
+        "status": rows[0][0],
+        "total": rows[0][1],
+        "created_at": rows[0][2].isoformat() if rows[0][2] else None,
+        "completed_at": rows[0][3].isoformat() if rows[0][3] else None,
+        "recipients": {row[4]: row[5] for row in rows if row[4]},
+    }
+
+
+def is_broadcast_authorized(event: dict) -> bool:
+    """Broadcast API requires the X-Broadcast-Token header to match BROADCAST_TOKEN."""
+    expected = os.environ.get("BROADCAST_TOKEN", "")
+    token = (event.get("headers") or {}).get("X-Broadcast-Token", "")
+    return bool(expected) and hmac.compare_digest(token, expected)
+
+
+def handle_broadcast(body: dict) -> dict:
+    """
+    POST ?action=broadcast
+    Queue a message for many recipients; delivery is done by the worker.
+    Body: {"text": "...", "chat_ids": [...]} or {"text": "...", "segment": "clients"}
+    """
+    text = body.get("text", "").strip()
+    parse_mode = body.get("parse_mode", "HTML")
+    chat_ids = body.get("chat_ids")
+    segment = body.get("segment")
+
+    if not text:
+        return cors_response(400, {"error": "text is required"})
+
+    if len(text) > 4096:
+        return cors_response(400, {"error": "Message too long (max 4096 characters)"})
+
+    if segment:
+        if segment not in BROADCAST_SEGMENTS:
+            return cors_response(400, {"error": f"Unknown segment: {segment}"})
+        chat_ids = None
+    elif not isinstance(chat_ids, list) or not chat_ids:
+        return cors_response(400, {"error": "chat_ids or segment is required"})
+    elif len(chat_ids) > BROADCAST_MAX_RECIPIENTS:
+        return cors_response(400, {"error": f"Too many recipients (max {BROADCAST_MAX_RECIPIENTS})"})
+
+    try:
+        result = enqueue_broadcast(text, parse_mode, chat_ids, segment)
+        return cors_response(202, {"success": True, **result})
+    except Exception as e:
+        return cors_response(500, {"error": str(e)})
+
+
+def handle_broadcast_status(params: dict) -> dict:
+    """
+    GET ?action=broadcast-status&id=...
+    Delivery progress of a broadcast.
+    """
+    try:
+        broadcast_id = int(params.get("id", ""))
+    except ValueError:
+        return cors_response(400, {"error": "id is required"})
+
+    try:
+        status = get_broadcast_status(broadcast_id)
+    except Exception as e:
+        return cors_response(500, {"error": str(e)})
+
+    if not status:
+        return cors_response(404, {"error": "Broadcast not found"})
+    return cors_response(200, status)
+
+
 # =============================================================================
 # MAIN HANDLER
 # =============================================================================
 
 def handler(event: dict, context) -> dict:
-    """Main entry point."""
-    print(f"[DEBUG] Received event: {json.dumps(event)}")
+    """
+    Main entry point.
+    Invocations without httpMethod (timer trigger) run the broadcast worker.
+    """
+    start_request_log(event, context)
+    if "httpMethod" not in event:
+        try:
+            return cors_response(200, process_broadcast_queue())
+        except Exception as e:
+            log("ERROR", "Broadcast worker error", error=str(e))
+            return cors_response(500, {"error": "Internal server error"})
+
     method = event.get("httpMethod", "POST")
 
     if method == "OPTIONS":
@@ -312,6 +879,7 @@ def handler(event: dict, context) -> dict:
 
     params = event.get("queryStringParameters") or {}
     action = params.get("action", "")
+    log("DEBUG", "Request received", method=method, action=action)
 
     # If action specified — handle notification API
     if action:
@@ -329,10 +897,21 @@ def handler(event: dict, context) -> dict:
             return handle_send_photo(body)
         elif action == "test" and method == "POST":
             return handle_test(body)
+        elif action in ("broadcast", "broadcast-status", "process-broadcasts"):
+            if not is_broadcast_authorized(event):
+                return cors_response(403, {"error": "Forbidden"})
+            if action == "broadcast" and method == "POST":
+                return handle_broadcast(body)
+            if action == "broadcast-status" and method == "GET":
+                return handle_broadcast_status(params)
+            if action == "process-broadcasts" and method == "POST":
+                return cors_response(200, process_broadcast_queue())
+            return cors_response(400, {"error": f"Unknown action: {action}"})
         else:
             return cors_response(400, {"error": f"Unknown action: {action}"})
 
     # No action — handle Telegram webhook
     body = json.loads(event.get("body", "{}"))
-    print(f"[DEBUG] Webhook body: {json.dumps(body)}")
+    if log_enabled("DEBUG"):
+        log("DEBUG", "Webhook update", update_id=body.get("update_id"), update_types=list(body))
     return process_webhook(body)
\ No newline at end of file
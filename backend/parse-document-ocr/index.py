@@ -1,16 +1,181 @@
 import json
 import os
 import re
+import time
 import base64
+import binascii
+import hashlib
+import hmac
+import threading
+import boto3
+import jwt
+import psycopg2
 import requests
+from psycopg2 import extensions, pool
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
+
+OCR_WORKER_BATCH_SIZE = int(os.environ.get('OCR_WORKER_BATCH_SIZE', '10'))
+OCR_JOB_MAX_ATTEMPTS = int(os.environ.get('OCR_JOB_MAX_ATTEMPTS', '3'))
+OCR_JOB_LOCK_TIMEOUT = int(os.environ.get('OCR_JOB_LOCK_TIMEOUT', '600'))
+
+# Форматы, которые принимает OCR API; остальные изображения отправляются как JPEG
+OCR_MIME_TYPES = {'application/pdf': 'application/pdf', 'image/png': 'image/png'}
+
+YANDEX_OCR_URL = os.environ.get('YANDEX_OCR_URL', 'https://ocr.api.cloud.yandex.net/ocr/v1/recognizeText')
+OCR_BATCH_CONCURRENCY = int(os.environ.get('OCR_BATCH_CONCURRENCY', '8'))
+OCR_BATCH_MAX_DOCUMENTS = int(os.environ.get('OCR_BATCH_MAX_DOCUMENTS', '300'))
+OCR_BATCH_CHUNK_SIZE = int(os.environ.get('OCR_BATCH_CHUNK_SIZE', '32'))
+OCR_MAX_RETRIES = int(os.environ.get('OCR_MAX_RETRIES', '4'))
+
+OCR_CACHE_MAX_BYTES = int(os.environ.get('OCR_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+
+JWT_SECRET = os.environ.get('JWT_SECRET', '')
+JWT_CACHE_MAX_SIZE = int(os.environ.get('JWT_CACHE_MAX_SIZE', '1024'))
+JWT_CACHE_TTL = float(os.environ.get('JWT_CACHE_TTL', '300'))
+
+_jwt_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+
+_http_session: Optional[requests.Session] = None
+
+_ocr_cache: "OrderedDict[str, Tuple[str, Optional[Dict]]]" = OrderedDict()
+_ocr_cache_bytes = 0
+_ocr_cache_lock = threading.Lock()
+ocr_cache_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'db_errors': 0}
+
+
+def get_http_session() -> requests.Session:
+    '''
+    HTTP-сессия к OCR API, общая для всех вызовов в процессе: keep-alive
+    пул соединений на OCR_BATCH_CONCURRENCY и повтор с экспоненциальной
+    задержкой (с учётом Retry-After) при ответах 429 и 5xx
+    '''
+    global _http_session
+    if _http_session is None:
+        retry = Retry(
+            total=OCR_MAX_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(['POST']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=OCR_BATCH_CONCURRENCY,
+            max_retries=retry
+        )
+        _http_session = requests.Session()
+        _http_session.mount('https://', adapter)
+        _http_session.mount('http://', adapter)
+    return _http_session
+
+
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            int(os.environ.get("DB_POOL_MAX_SIZE", "5")),
+            os.environ["DATABASE_URL"]
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(os.environ.get("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(os.environ.get("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+
+
 
 def handler(event: dict, context) -> dict:
     '''
     Распознаёт текст на загруженных документах через OCR (Yandex Vision)
-    и извлекает суммы, даты, номера счетов из счетов и актов
+    и извлекает суммы, даты, номера счетов из счетов и актов.
+    Тело {"documents": [...]} — пакетное распознавание нескольких документов
+    (нужен заголовок X-Authorization).
     '''
+    params = event.get('queryStringParameters') or {}
+    
+    # Вызов по таймеру (без httpMethod) или ?action=process-queue с заголовком X-Worker-Token — разбор очереди OCR
+    if 'httpMethod' not in event or params.get('action') == 'process-queue':
+        if 'httpMethod' in event:
+            token = (event.get('headers') or {}).get('X-Worker-Token', '')
+            expected = os.environ.get('OCR_WORKER_TOKEN', '')
+            if not expected or not hmac.compare_digest(token, expected):
+                return {
+                    'statusCode': 403,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Forbidden'})
+                }
+        
+        processed = process_ocr_queue(OCR_WORKER_BATCH_SIZE)
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'processed': processed, 'cacheStats': get_ocr_cache_stats()})
+        }
+    
     method = event.get('httpMethod', 'POST')
     
     if method == 'OPTIONS':
@@ -19,7 +184,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
+                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization, X-Worker-Token'
             },
             'body': ''
         }
@@ -36,6 +201,10 @@ def handler(event: dict, context) -> dict:
         if not body_str or body_str == '':
             body_str = '{}'
         body = json.loads(body_str)
+        
+        if 'documents' in body:
+            return recognize_batch(event, body.get('documents'))
+        
         image_base64 = body.get('imageContent')
         
         if not image_base64:
@@ -58,7 +227,7 @@ def handler(event: dict, context) -> dict:
                 })
             }
         
-        ocr_result = recognize_text_yandex(image_base64, api_key)
+        ocr_result, extracted_data, cached = recognize_document(image_base64, api_key)
         
         if not ocr_result:
             return {
@@ -71,18 +240,23 @@ def handler(event: dict, context) -> dict:
                 })
             }
         
-        extracted_data = extract_financial_data(ocr_result)
-        
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'success': True,
                 'extractedData': extracted_data,
-                'rawText': ocr_result
+                'rawText': ocr_result,
+                'cached': cached
             })
         }
         
+    except binascii.Error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'imageContent must be valid base64'})
+        }
     except Exception as e:
         return {
             'statusCode': 500,
@@ -91,23 +265,52 @@ def handler(event: dict, context) -> dict:
         }
 
 
-def recognize_text_yandex(image_base64: str, api_key: str) -> Optional[str]:
+def verify_jwt(token: str) -> Optional[int]:
+    '''
+    Проверяет JWT токен и возвращает user_id. Расшифрованные токены кэшируются
+    (LRU по SHA-256 токена) до истечения exp, но не дольше JWT_CACHE_TTL секунд
+    '''
+    if not token:
+        return None
+    
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    
+    cached = _jwt_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _jwt_cache.move_to_end(token_hash)
+        return cached[0]
+    _jwt_cache.pop(token_hash, None)
+    
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+    except jwt.PyJWTError:
+        return None
+    
+    user_id = payload.get('user_id')
+    if user_id:
+        expires_at = min(payload.get('exp', now + JWT_CACHE_TTL), now + JWT_CACHE_TTL)
+        _jwt_cache[token_hash] = (user_id, expires_at)
+        if len(_jwt_cache) > JWT_CACHE_MAX_SIZE:
+            _jwt_cache.popitem(last=False)
+    return user_id
+
+
+def recognize_text_yandex(image_base64: str, api_key: str, mime_type: str = 'image/jpeg') -> Optional[str]:
     '''Распознаёт текст через Yandex Vision OCR'''
     try:
-        url = 'https://ocr.api.cloud.yandex.net/ocr/v1/recognizeText'
-        
         headers = {
             'Authorization': f'Api-Key {api_key}',
             'Content-Type': 'application/json'
         }
         
         payload = {
-            'mimeType': 'image/jpeg',
+            'mimeType': mime_type,
             'languageCodes': ['ru', 'en'],
             'content': image_base64
         }
         
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = get_http_session().post(YANDEX_OCR_URL, headers=headers, json=payload, timeout=30)
         
         if response.status_code != 200:
             return None
@@ -127,8 +330,393 @@ def recognize_text_yandex(image_base64: str, api_key: str) -> Optional[str]:
         return None
 
 
+def remember_ocr_result(content_hash: str, raw_text: str, extracted_data: Optional[Dict]) -> None:
+    '''Кладёт результат в LRU процесса, ограниченный OCR_CACHE_MAX_BYTES байт текста'''
+    global _ocr_cache_bytes
+    size = len(raw_text.encode())
+    if size > OCR_CACHE_MAX_BYTES:
+        return
+    
+    with _ocr_cache_lock:
+        if content_hash in _ocr_cache:
+            _ocr_cache.move_to_end(content_hash)
+            return
+        _ocr_cache[content_hash] = (raw_text, extracted_data)
+        _ocr_cache_bytes += size
+        while _ocr_cache_bytes > OCR_CACHE_MAX_BYTES:
+            _, (old_text, _) = _ocr_cache.popitem(last=False)
+            _ocr_cache_bytes -= len(old_text.encode())
+
+
+def get_cached_ocr_result(content_hash: str) -> Optional[Tuple[str, Optional[Dict]]]:
+    '''Ищет результат OCR сначала в LRU процесса, затем в таблице ocr_result_cache'''
+    with _ocr_cache_lock:
+        cached = _ocr_cache.get(content_hash)
+        if cached:
+            _ocr_cache.move_to_end(content_hash)
+            ocr_cache_stats['memory_hits'] += 1
+            return cached
+    
+    row = None
+    try:
+        schema = get_schema()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'''
+                UPDATE {schema}ocr_result_cache
+                SET hits = hits + 1, last_hit_at = NOW()
+                WHERE content_hash = %s
+                RETURNING raw_text, extracted_data
+            ''', (content_hash,))
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+    except Exception:
+        with _ocr_cache_lock:
+            ocr_cache_stats['db_errors'] += 1
+    
+    with _ocr_cache_lock:
+        ocr_cache_stats['db_hits' if row else 'misses'] += 1
+    
+    if not row:
+        return None
+    remember_ocr_result(content_hash, row[0], row[1])
+    return row[0], row[1]
+
+
+def store_ocr_result(content_hash: str, raw_text: str, extracted_data: Optional[Dict]) -> None:
+    '''Сохраняет результат OCR в LRU процесса и в ocr_result_cache'''
+    remember_ocr_result(content_hash, raw_text, extracted_data)
+    try:
+        schema = get_schema()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'''
+                INSERT INTO {schema}ocr_result_cache (content_hash, raw_text, extracted_data)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (content_hash) DO NOTHING
+            ''', (content_hash, raw_text, json.dumps(extracted_data, ensure_ascii=False)))
+            conn.commit()
+            cur.close()
+    except Exception:
+        with _ocr_cache_lock:
+            ocr_cache_stats['db_errors'] += 1
+
+
+def get_ocr_cache_stats() -> Dict:
+    '''Счётчики кэша OCR и доля попаданий'''
+    with _ocr_cache_lock:
+        stats = dict(ocr_cache_stats)
+        stats['entries'] = len(_ocr_cache)
+    lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+    stats['hit_ratio'] = round((stats['memory_hits'] + stats['db_hits']) / lookups, 4) if lookups else 0.0
+    return stats
+
+
+def get_cached_ocr_results(content_hashes: List[str]) -> Dict[str, Tuple[str, Optional[Dict]]]:
+    '''
+    Пакетный поиск в кэше OCR: сначала LRU процесса, затем одним запросом
+    к ocr_result_cache по всем оставшимся хэшам
+    '''
+    found = {}
+    with _ocr_cache_lock:
+        for content_hash in content_hashes:
+            cached = _ocr_cache.get(content_hash)
+            if cached:
+                _ocr_cache.move_to_end(content_hash)
+                found[content_hash] = cached
+        ocr_cache_stats['memory_hits'] += len(found)
+    
+    missing = [content_hash for content_hash in content_hashes if content_hash not in found]
+    if not missing:
+        return found
+    
+    rows = []
+    try:
+        schema = get_schema()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'''
+                UPDATE {schema}ocr_result_cache
+                SET hits = hits + 1, last_hit_at = NOW()
+                WHERE content_hash = ANY(%s::bpchar[])
+                RETURNING content_hash, raw_text, extracted_data
+            ''', (missing,))
+            rows = cur.fetchall()
+            conn.commit()
+            cur.close()
+    except Exception:
+        with _ocr_cache_lock:
+            ocr_cache_stats['db_errors'] += 1
+    
+    for content_hash, raw_text, extracted_data in rows:
+        remember_ocr_result(content_hash, raw_text, extracted_data)
+        found[content_hash] = (raw_text, extracted_data)
+    
+    with _ocr_cache_lock:
+        ocr_cache_stats['db_hits'] += len(rows)
+        ocr_cache_stats['misses'] += len(missing) - len(rows)
+    return found
+
+
+def store_ocr_results(results: Dict[str, Tuple[str, Optional[Dict]]]) -> None:
+    '''Сохраняет пачку результатов OCR в LRU процесса и одним запросом в ocr_result_cache'''
+    if not results:
+        return
+    
+    for content_hash, (raw_text, extracted_data) in results.items():
+        remember_ocr_result(content_hash, raw_text, extracted_data)
+    
+    content_hashes = list(results)
+    try:
+        schema = get_schema()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'''
+                INSERT INTO {schema}ocr_result_cache (content_hash, raw_text, extracted_data)
+                SELECT content_hash, raw_text, extracted_data::jsonb
+                FROM unnest(%s::text[], %s::text[], %s::text[]) AS r(content_hash, raw_text, extracted_data)
+                ON CONFLICT (content_hash) DO NOTHING
+            ''', (
+                content_hashes,
+                [results[h][0] for h in content_hashes],
+                [json.dumps(results[h][1], ensure_ascii=False) for h in content_hashes]
+            ))
+            conn.commit()
+            cur.close()
+    except Exception:
+        with _ocr_cache_lock:
+            ocr_cache_stats['db_errors'] += 1
+
+
+def recognize_document(image_base64: str, api_key: str, mime_type: str = 'image/jpeg',
+                       image_bytes: Optional[bytes] = None) -> Tuple[Optional[str], Optional[Dict], bool]:
+    '''
+    Распознаёт документ с кэшем по SHA-256 содержимого файла: повторная
+    загрузка того же документа не обращается к OCR API.
+    Возвращает (текст, извлечённые данные, признак попадания в кэш).
+    '''
+    if image_bytes is None:
+        image_bytes = base64.b64decode(image_base64)
+    content_hash = hashlib.sha256(image_bytes).hexdigest()
+    
+    cached = get_cached_ocr_result(content_hash)
+    if cached:
+        return cached[0], cached[1], True
+    
+    raw_text = recognize_text_yandex(image_base64, api_key, mime_type)
+    if raw_text is None:
+        return None, None, False
+    
+    extracted_data = extract_financial_data(raw_text) if raw_text else None
+    store_ocr_result(content_hash, raw_text, extracted_data)
+    return raw_text, extracted_data, False
+
+
+def get_user_documents(user_id: int, document_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+    '''Ключ S3 и тип файла документов пользователя по id; чужие документы не возвращаются'''
+    schema = get_schema()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'''
+            SELECT id, s3_key, file_type
+            FROM {schema}accounting_documents
+            WHERE user_id = %s AND id = ANY(%s) AND s3_key IS NOT NULL
+        ''', (user_id, document_ids))
+        documents = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+        cur.close()
+    return documents
+
+
+def load_batch_item(item: Dict, s3, documents: Dict[int, Tuple[str, str]]) -> Dict:
+    '''
+    Готовит документ пакета к распознаванию (base64 в imageContent или документ
+    пользователя по documentId): содержимое, SHA-256 и MIME-тип либо ошибка
+    '''
+    try:
+        image_base64 = item.get('imageContent')
+        mime_type = item.get('mimeType', 'image/jpeg')
+        if image_base64:
+            image_bytes = base64.b64decode(image_base64)
+        elif item.get('documentId') is not None:
+            document = documents.get(item['documentId'])
+            if not document:
+                return {'error': 'Document not found'}
+            s3_key, file_type = document
+            image_bytes = s3.get_object(Bucket='files', Key=s3_key)['Body'].read()
+            image_base64 = base64.b64encode(image_bytes).decode()
+            mime_type = OCR_MIME_TYPES.get(file_type, 'image/jpeg')
+        else:
+            return {'error': 'imageContent or documentId required'}
+    except Exception as e:
+        return {'error': str(e)}
+    
+    return {
+        'content': image_base64,
+        'hash': hashlib.sha256(image_bytes).hexdigest(),
+        'mimeType': mime_type
+    }
+
+
+def recognize_batch_content(loaded: Dict, api_key: str) -> Optional[Tuple[str, Optional[Dict]]]:
+    '''Распознаёт документ пакета, которого нет в кэше; без обращений к БД'''
+    raw_text = recognize_text_yandex(loaded['content'], api_key, loaded['mimeType'])
+    if raw_text is None:
+        return None
+    return raw_text, extract_financial_data(raw_text) if raw_text else None
+
+
+def recognize_batch(event: dict, documents) -> dict:
+    '''
+    Пакетное распознавание: {"documents": [{"id": 1, "imageContent": "..."}, {"id": 2, "documentId": 15}]}.
+    documentId — загруженный документ текущего пользователя, файл берётся из S3.
+    Запросы к OCR API идут параллельно, не больше OCR_BATCH_CONCURRENCY одновременно,
+    результат возвращается по каждому документу в исходном порядке
+    '''
+    auth_header = (event.get('headers') or {}).get('X-Authorization', '')
+    user_id = verify_jwt(auth_header.replace('Bearer ', '') if auth_header else '')
+    if not user_id:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Unauthorized'})
+        }
+    
+    if not isinstance(documents, list) or not documents:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'documents must be a non-empty list'})
+        }
+    
+    if len(documents) > OCR_BATCH_MAX_DOCUMENTS:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Too many documents (max {OCR_BATCH_MAX_DOCUMENTS})'})
+        }
+    
+    api_key = os.environ.get('YANDEX_OCR_API_KEY')
+    if not api_key:
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'OCR not configured', 'results': []})
+        }
+    
+    items = [item if isinstance(item, dict) else {} for item in documents]
+    document_ids = [
+        item['documentId'] for item in items
+        if not item.get('imageContent') and isinstance(item.get('documentId'), int)
+    ]
+    user_documents = get_user_documents(user_id, document_ids) if document_ids else {}
+    s3 = get_s3_client() if user_documents else None
+    
+    # Потоки только читают S3 и вызывают OCR API; кэш читается и пишется
+    # одним запросом из основного потока, поэтому пул БД не зависит от параллельности.
+    # Пакет обрабатывается частями по OCR_BATCH_CHUNK_SIZE документов: содержимое
+    # файлов в памяти только у текущей части, от прежних остаются лишь результаты
+    known = {}
+    results = []
+    with ThreadPoolExecutor(max_workers=min(OCR_BATCH_CONCURRENCY, len(items))) as executor:
+        for chunk_start in range(0, len(items), OCR_BATCH_CHUNK_SIZE):
+            chunk = items[chunk_start:chunk_start + OCR_BATCH_CHUNK_SIZE]
+            loaded_items = list(executor.map(lambda item: load_batch_item(item, s3, user_documents), chunk))
+            
+            content_hashes = list(dict.fromkeys(
+                loaded['hash'] for loaded in loaded_items
+                if 'hash' in loaded and loaded['hash'] not in known
+            ))
+            cached = get_cached_ocr_results(content_hashes)
+            
+            to_recognize = {}
+            for loaded in loaded_items:
+                if 'hash' in loaded and loaded['hash'] not in known and loaded['hash'] not in cached:
+                    to_recognize.setdefault(loaded['hash'], loaded)
+            recognized = dict(zip(
+                to_recognize,
+                executor.map(lambda loaded: recognize_batch_content(loaded, api_key), to_recognize.values())
+            ))
+            
+            fresh = {content_hash: result for content_hash, result in recognized.items() if result is not None}
+            store_ocr_results(fresh)
+            known.update((content_hash, (*result, True)) for content_hash, result in cached.items())
+            known.update((content_hash, (*result, False)) for content_hash, result in fresh.items())
+            
+            for index, (item, loaded) in enumerate(zip(chunk, loaded_items), chunk_start):
+                result = {'id': item.get('id', index), 'success': False, 'extractedData': None}
+                if 'error' in loaded:
+                    result['error'] = loaded['error']
+                elif loaded['hash'] in known:
+                    raw_text, extracted_data, from_cache = known[loaded['hash']]
+                    result['success'] = True
+                    result['extractedData'] = extracted_data
+                    result['rawText'] = raw_text
+                    result['cached'] = from_cache
+                else:
+                    result['error'] = 'OCR request failed'
+                results.append(result)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'processed': len(results),
+            'failed': sum(1 for r in results if not r['success']),
+            'cacheStats': get_ocr_cache_stats(),
+            'results': results
+        })
+    }
+
+
+AMOUNT_PATTERN = r'(?:\d{1,3}(?:[ \u00a0,]\d{3})+|\d+)(?:[.,]\d{1,2})?'
+
+# Все поля документа ищутся одним проходом по тексту: альтернативы
+# проверяются в каждой позиции по порядку, сработавшая определяется по lastgroup
+FINANCIAL_FIELDS_RE = re.compile(rf'''
+    (?P<inn>ИНН[:\s]*(?P<inn_value>\d{{10,12}}))
+  | (?P<number>(?P<number_keyword>№|номер|сч[её]т(?:[- ]фактур[аы])?)[:\s\#]*(?P<number_value>\d+(?:[/-]\d+)?))
+  | (?P<date>(?:(?:от|дата)[:\s]*)?(?<!\d)(?P<date_value>\d{{2}}[./-]\d{{2}}[./-](?:\d{{4}}|\d{{2}}))(?!\d))
+  | (?P<labeled_amount>(?:итого|сумма|к\ оплате|всего)[:\s]*(?P<labeled_amount_value>{AMOUNT_PATTERN}))
+  | (?P<amount>(?<![\d.,])(?P<amount_value>{AMOUNT_PATTERN})\s*(?:руб|₽))
+  | (?P<doc_type>сч[её]т[- ]фактур|\bакт|сч[её]т|накладн)
+''', re.IGNORECASE | re.VERBOSE)
+
+DECIMAL_TAIL_RE = re.compile(r'[.,](\d{1,2})$')
+
+DOCUMENT_TYPE_PRIORITY = ['Счёт-фактура', 'Акт', 'Счёт', 'Накладная']
+
+
+def parse_amount(raw: str) -> Optional[float]:
+    '''Переводит сумму вида "1 234 567,89" в число'''
+    value = raw.replace(' ', '').replace('\u00a0', '')
+    decimal_match = DECIMAL_TAIL_RE.search(value)
+    if decimal_match:
+        integer_part = value[:decimal_match.start()].replace(',', '').replace('.', '')
+        value = f'{integer_part}.{decimal_match.group(1)}'
+    else:
+        value = value.replace(',', '').replace('.', '')
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def document_type_for(keyword: str) -> str:
+    '''Тип документа по найденному ключевому слову'''
+    keyword = keyword.lower()
+    if 'фактур' in keyword:
+        return 'Счёт-фактура'
+    if keyword == 'акт':
+        return 'Акт'
+    if keyword.startswith('сч'):
+        return 'Счёт'
+    return 'Накладная'
+
+
 def extract_financial_data(text: str) -> Dict:
-    '''Извлекает финансовые данные из распознанного текста'''
+    '''Извлекает финансовые данные из распознанного текста за один проход'''
     data = {
         'amounts': [],
         'dates': [],
@@ -138,52 +726,183 @@ def extract_financial_data(text: str) -> Dict:
         'totalAmount': None
     }
     
-    amount_patterns = [
-        r'(?:итого|сумма|к оплате|всего)[:\s]*(\d+[\s,]?\d*[.,]?\d*)\s*(?:руб|₽)?',
-        r'(\d+[\s,]?\d*[.,]\d{2})\s*(?:руб|₽)',
-        r'(?:^|\s)(\d{1,3}(?:[\s,]\d{3})*(?:[.,]\d{2})?)\s*(?:руб|₽)',
-    ]
+    document_types = set()
     
-    for pattern in amount_patterns:
-        matches = re.finditer(pattern, text, re.IGNORECASE | re.MULTILINE)
-        for match in matches:
-            amount_str = match.group(1).replace(' ', '').replace(',', '')
-            try:
-                amount = float(amount_str.replace(',', '.'))
-                if amount > 0:
-                    data['amounts'].append(amount)
-            except ValueError:
-                pass
-    
-    date_patterns = [
-        r'(\d{2}[./-]\d{2}[./-]\d{4})',
-        r'(\d{2}\.\d{2}\.\d{2})',
-        r'(?:от|дата)[:\s]*(\d{2}[./-]\d{2}[./-]\d{2,4})',
-    ]
+    for match in FINANCIAL_FIELDS_RE.finditer(text):
+        kind = match.lastgroup
+        
+        if kind in ('labeled_amount', 'amount'):
+            amount = parse_amount(match.group(f'{kind}_value'))
+            if amount:
+                data['amounts'].append(amount)
+        elif kind == 'date':
+            data['dates'].append(match.group('date_value'))
+        elif kind == 'number':
+            if data['documentNumber'] is None:
+                data['documentNumber'] = match.group('number_value')
+            keyword = match.group('number_keyword')
+            if keyword.lower().startswith('сч'):
+                document_types.add(document_type_for(keyword))
+        elif kind == 'doc_type':
+            document_types.add(document_type_for(match.group('doc_type')))
+        elif kind == 'inn':
+            if data['inn'] is None:
+                data['inn'] = match.group('inn_value')
     
-    for pattern in date_patterns:
-        matches = re.finditer(pattern, text, re.IGNORECASE)
-        for match in matches:
-            data['dates'].append(match.group(1))
+    for document_type in DOCUMENT_TYPE_PRIORITY:
+        if document_type in document_types:
+            data['documentType'] = document_type
+            break
     
-    doc_number_match = re.search(r'(?:№|номер|счет)[:\s#]*(\d+(?:[/-]\d+)?)', text, re.IGNORECASE)
-    if doc_number_match:
-        data['documentNumber'] = doc_number_match.group(1)
+    if data['amounts']:
+        data['totalAmount'] = max(data['amounts'])
     
-    if re.search(r'счет[- ]фактура', text, re.IGNORECASE):
-        data['documentType'] = 'Счёт-фактура'
-    elif re.search(r'акт', text, re.IGNORECASE):
-        data['documentType'] = 'Акт'
-    elif re.search(r'счет', text, re.IGNORECASE):
-        data['documentType'] = 'Счёт'
-    elif re.search(r'накладн', text, re.IGNORECASE):
-        data['documentType'] = 'Накладная'
+    return data
+
+
+def get_schema() -> str:
+    '''Префикс схемы БД'''
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    return f'{schema}.' if schema else ''
+
+
+def get_s3_client():
+    '''Создаёт S3 клиента для хранилища проекта'''
+    return boto3.client('s3',
+        endpoint_url='https://bucket.poehali.dev',
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+    )
+
+
+def dequeue_ocr_jobs(batch_size: int) -> List[Dict]:
+    '''
+    Забирает пачку задач OCR через FOR UPDATE SKIP LOCKED, чтобы параллельные
+    воркеры не брали одни и те же документы. Задачи, зависшие в processing
+    дольше OCR_JOB_LOCK_TIMEOUT секунд, возвращаются в работу, а исчерпавшие
+    OCR_JOB_MAX_ATTEMPTS попыток помечаются failed вместе с документом.
+    '''
+    schema = get_schema()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'''
+            WITH expired AS (
+                UPDATE {schema}ocr_jobs
+                SET status = 'failed', last_error = 'Processing timed out', updated_at = NOW()
+                WHERE status = 'processing'
+                  AND locked_at < NOW() - make_interval(secs => %s)
+                  AND attempts >= %s
+                RETURNING document_id
+            )
+            UPDATE {schema}accounting_documents d
+            SET status = 'failed', processed_at = NOW(), ocr_error = 'Processing timed out'
+            FROM expired
+            WHERE d.id = expired.document_id
+        ''', (OCR_JOB_LOCK_TIMEOUT, OCR_JOB_MAX_ATTEMPTS))
+        cur.execute(f'''
+            UPDATE {schema}ocr_jobs j
+            SET status = 'processing', attempts = j.attempts + 1,
+                locked_at = NOW(), updated_at = NOW()
+            FROM {schema}accounting_documents d
+            WHERE d.id = j.document_id
+              AND j.id IN (
+                  SELECT id FROM {schema}ocr_jobs
+                  WHERE (status = 'pending' AND run_after <= NOW())
+                     OR (status = 'processing' AND locked_at < NOW() - make_interval(secs => %s)
+                         AND attempts < %s)
+                  ORDER BY id
+                  LIMIT %s
+                  FOR UPDATE SKIP LOCKED
+              )
+            RETURNING j.id, j.document_id, j.attempts, d.s3_key, d.file_type
+        ''', (OCR_JOB_LOCK_TIMEOUT, OCR_JOB_MAX_ATTEMPTS, batch_size))
+        jobs = [
+            {'id': row[0], 'document_id': row[1], 'attempts': row[2], 's3_key': row[3], 'file_type': row[4]}
+            for row in cur.fetchall()
+        ]
+        conn.commit()
+        cur.close()
+    return jobs
+
+
+def finish_ocr_job(job: Dict, extracted_data: Optional[Dict], raw_text: str) -> None:
+    '''Сохраняет результат распознавания в документ и закрывает задачу'''
+    schema = get_schema()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'''
+            UPDATE {schema}accounting_documents
+            SET status = 'processed', processed_at = NOW(),
+                extracted_data = %s, ocr_error = NULL
+            WHERE id = %s
+        ''', (json.dumps({'extractedData': extracted_data, 'rawText': raw_text}, ensure_ascii=False), job['document_id']))
+        cur.execute(f'''
+            UPDATE {schema}ocr_jobs
+            SET status = 'done', last_error = NULL, updated_at = NOW()
+            WHERE id = %s
+        ''', (job['id'],))
+        conn.commit()
+        cur.close()
+
+
+def fail_ocr_job(job: Dict, error: str) -> None:
+    '''
+    Возвращает задачу в очередь с экспоненциальной задержкой,
+    а после OCR_JOB_MAX_ATTEMPTS попыток помечает документ как failed
+    '''
+    schema = get_schema()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if job['attempts'] >= OCR_JOB_MAX_ATTEMPTS:
+            cur.execute(f'''
+                UPDATE {schema}ocr_jobs
+                SET status = 'failed', last_error = %s, updated_at = NOW()
+                WHERE id = %s
+            ''', (error, job['id']))
+            cur.execute(f'''
+                UPDATE {schema}accounting_documents
+                SET status = 'failed', processed_at = NOW(), ocr_error = %s
+                WHERE id = %s
+            ''', (error, job['document_id']))
+        else:
+            cur.execute(f'''
+                UPDATE {schema}ocr_jobs
+                SET status = 'pending', last_error = %s, locked_at = NULL,
+                    run_after = NOW() + make_interval(secs => %s), updated_at = NOW()
+                WHERE id = %s
+            ''', (error, 30 * 2 ** (job['attempts'] - 1), job['id']))
+        conn.commit()
+        cur.close()
+
+
+def process_ocr_queue(batch_size: int) -> int:
+    '''
+    Воркер очереди OCR: скачивает документы из S3, распознаёт текст
+    и записывает извлечённые данные. Возвращает число обработанных задач.
+    '''
+    api_key = os.environ.get('YANDEX_OCR_API_KEY')
+    if not api_key:
+        return 0
     
-    inn_match = re.search(r'ИНН[:\s]*(\d{10,12})', text, re.IGNORECASE)
-    if inn_match:
-        data['inn'] = inn_match.group(1)
+    jobs = dequeue_ocr_jobs(batch_size)
+    if not jobs:
+        return 0
     
-    if data['amounts']:
-        data['totalAmount'] = max(data['amounts'])
+    s3 = get_s3_client()
+    for job in jobs:
+        try:
+            obj = s3.get_object(Bucket='files', Key=job['s3_key'])
+            image_bytes = obj['Body'].read()
+            image_base64 = base64.b64encode(image_bytes).decode()
+            mime_type = OCR_MIME_TYPES.get(job['file_type'], 'image/jpeg')
+            
+            ocr_result, extracted_data, _ = recognize_document(image_base64, api_key, mime_type, image_bytes)
+            if ocr_result is None:
+                fail_ocr_job(job, 'OCR request failed')
+                continue
+            
+            finish_ocr_job(job, extracted_data, ocr_result)
+        except Exception as e:
+            fail_ocr_job(job, str(e))
     
-    return data
\ No newline at end of file
+    return len(jobs)
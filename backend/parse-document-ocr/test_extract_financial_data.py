@@ -0,0 +1,144 @@
+"""
+Золотые примеры для extract_financial_data: разбор сумм, ИНН,
+номера, дат и типа документа по распознанному тексту.
+Запуск: python -m pytest backend/parse-document-ocr
+"""
+import ast
+import importlib.util
+import os
+import re
+import types
+from typing import Dict, Optional
+
+import pytest
+
+INDEX_PATH = os.path.join(os.path.dirname(__file__), 'index.py')
+
+# Извлекатель полей зависит только от re; клиенты S3, БД, HTTP и JWT,
+# которые index.py импортирует при загрузке, для него не нужны
+EXTRACTOR_NAMES = {
+    'AMOUNT_PATTERN', 'FINANCIAL_FIELDS_RE', 'DECIMAL_TAIL_RE', 'DOCUMENT_TYPE_PRIORITY',
+    'parse_amount', 'document_type_for', 'extract_financial_data',
+}
+
+
+def load_extractor() -> types.ModuleType:
+    '''Собирает модуль только из определений извлекателя в index.py'''
+    with open(INDEX_PATH, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), INDEX_PATH)
+    nodes = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in EXTRACTOR_NAMES:
+            nodes.append(node)
+        elif isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id in EXTRACTOR_NAMES for target in node.targets
+        ):
+            nodes.append(node)
+    module = types.ModuleType('parse_document_ocr_extractor')
+    module.__dict__.update({'re': re, 'Dict': Dict, 'Optional': Optional})
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), INDEX_PATH, 'exec'), module.__dict__)
+    return module
+
+
+ocr = load_extractor()
+
+
+GOLDEN = [
+    (
+        'Счёт на оплату № 123 от 15.03.2024\nИНН 7707083893\nИтого: 12 345,67 руб.',
+        {
+            'amounts': [12345.67],
+            'dates': ['15.03.2024'],
+            'documentNumber': '123',
+            'documentType': 'Счёт',
+            'inn': '7707083893',
+            'totalAmount': 12345.67,
+        },
+    ),
+    (
+        'ИНН 500100732259\nАкт № 45/2 от 01.02.24',
+        {
+            'amounts': [],
+            'dates': ['01.02.24'],
+            'documentNumber': '45/2',
+            'documentType': 'Акт',
+            'inn': '500100732259',
+            'totalAmount': None,
+        },
+    ),
+    (
+        'Счет-фактура № 7 от 01.04.2024\nСумма 1 000,00 руб.\nВсего 1 200,50 руб.',
+        {
+            'amounts': [1000.0, 1200.5],
+            'dates': ['01.04.2024'],
+            'documentNumber': '7',
+            'documentType': 'Счёт-фактура',
+            'inn': None,
+            'totalAmount': 1200.5,
+        },
+    ),
+    (
+        'Товарная накладная 15.05.2024 сумма 99.9',
+        {
+            'amounts': [99.9],
+            'dates': ['15.05.2024'],
+            'documentNumber': None,
+            'documentType': 'Накладная',
+            'inn': None,
+            'totalAmount': 99.9,
+        },
+    ),
+    (
+        # ISO-дата не разбирается, и её хвост "24-03-15" не должен считаться датой
+        'Дата: 2024-03-15',
+        {
+            'amounts': [],
+            'dates': [],
+            'documentNumber': None,
+            'documentType': None,
+            'inn': None,
+            'totalAmount': None,
+        },
+    ),
+]
+
+
+@pytest.mark.parametrize('text,expected', GOLDEN)
+def test_golden_documents(text, expected):
+    assert ocr.extract_financial_data(text) == expected
+
+
+@pytest.mark.parametrize('raw,expected', [
+    ('12 345,67', 12345.67),
+    ('12 345,67', 12345.67),
+    ('1,234,567.89', 1234567.89),
+    ('12 345 678,9', 12345678.9),
+    ('1500', 1500.0),
+])
+def test_parse_amount(raw, expected):
+    assert ocr.parse_amount(raw) == expected
+
+
+def test_labeled_currency_amount_reported_once():
+    # "Итого ... руб." подходит и под подписанную сумму, и под сумму с валютой
+    data = ocr.extract_financial_data('Итого к оплате: 12 345,67 руб.')
+    assert data['amounts'] == [12345.67]
+
+
+def test_date_followed_by_digits_is_not_a_date():
+    assert ocr.extract_financial_data('код 01.02.20245')['dates'] == []
+
+
+def test_act_requires_word_start():
+    assert ocr.extract_financial_data('Контактное лицо: Иванов')['documentType'] is None
+
+
+def test_index_module_uses_same_extractor():
+    # Полная загрузка index.py нужна только для сверки с тем, что проверено выше
+    for dependency in ('boto3', 'psycopg2', 'requests', 'jwt'):
+        pytest.importorskip(dependency)
+    spec = importlib.util.spec_from_file_location('parse_document_ocr_index', INDEX_PATH)
+    index = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(index)
+    for text, expected in GOLDEN:
+        assert index.extract_financial_data(text) == expected
@@ -1,10 +1,86 @@
 import json
 import os
+import time
 import random
 import psycopg2
+from psycopg2 import extensions, pool
+from contextlib import contextmanager
+from typing import Optional, Dict, List
 from datetime import datetime, timedelta
 import requests
 
+
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            int(os.environ.get("DB_POOL_MAX_SIZE", "5")),
+            os.environ["DATABASE_URL"]
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(os.environ.get("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(os.environ.get("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+
+
 def handler(event: dict, context) -> dict:
     """Отправка SMS-кода для авторизации пользователя"""
     
@@ -44,21 +120,20 @@ def handler(event: dict, context) -> dict:
         
         code = str(random.randint(1000, 9999))
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
-        
-        expires_at = (datetime.now() + timedelta(minutes=5)).isoformat()
-        
-        cur.execute("""
-            INSERT INTO sms_codes (phone, code, expires_at, created_at)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (phone) 
-            DO UPDATE SET code = EXCLUDED.code, expires_at = EXCLUDED.expires_at, created_at = EXCLUDED.created_at
-        """, (phone, code, expires_at, datetime.now().isoformat()))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            expires_at = (datetime.now() + timedelta(minutes=5)).isoformat()
+            
+            cur.execute("""
+                INSERT INTO sms_codes (phone, code, expires_at, created_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (phone) 
+                DO UPDATE SET code = EXCLUDED.code, expires_at = EXCLUDED.expires_at, created_at = EXCLUDED.created_at
+            """, (phone, code, expires_at, datetime.now().isoformat()))
+            
+            conn.commit()
+            cur.close()
         
         sms_api_key = os.environ.get('SMS_API_KEY', '')
         if sms_api_key:
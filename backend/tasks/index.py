@@ -4,9 +4,16 @@ API для управления задачами бухгалтеру через
 """
 import json
 import os
+import hashlib
+import base64
+import time
+import jwt
 import psycopg2
+from psycopg2 import extensions, pool
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Dict, List, Tuple
 
 
 def get_env(key: str, default: str = "") -> str:
@@ -14,10 +21,75 @@ def get_env(key: str, default: str = "") -> str:
     return os.environ.get(key, default)
 
 
-def get_db_connection():
-    """Создать подключение к базе данных"""
-    dsn = get_env("DATABASE_URL")
-    return psycopg2.connect(dsn)
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(get_env("DB_POOL_MIN_SIZE", "1")),
+            int(get_env("DB_POOL_MAX_SIZE", "5")),
+            get_env("DATABASE_URL")
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(get_env("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(get_env("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
 
 
 def cors_response(status_code: int, body: dict) -> dict:
@@ -34,18 +106,47 @@ def cors_response(status_code: int, body: dict) -> dict:
     }
 
 
+JWT_SECRET = get_env("JWT_SECRET")
+JWT_CACHE_MAX_SIZE = int(get_env("JWT_CACHE_MAX_SIZE", "1024"))
+JWT_CACHE_TTL = float(get_env("JWT_CACHE_TTL", "300"))
+
+_jwt_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+jwt_cache_stats = {"hits": 0, "misses": 0}
+
+
 def verify_jwt(token: str) -> Optional[int]:
-    """Проверка JWT токена и извлечение user_id"""
+    """
+    Проверка JWT токена и извлечение user_id.
+    Расшифрованные токены кэшируются (LRU по SHA-256 токена) до истечения
+    exp, но не дольше JWT_CACHE_TTL секунд.
+    """
     if not token:
         return None
     
-    import jwt
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    
+    cached = _jwt_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _jwt_cache.move_to_end(token_hash)
+        jwt_cache_stats["hits"] += 1
+        return cached[0]
+    
+    jwt_cache_stats["misses"] += 1
+    _jwt_cache.pop(token_hash, None)
+    
     try:
-        jwt_secret = get_env("JWT_SECRET")
-        payload = jwt.decode(token, jwt_secret, algorithms=["HS256"])
-        return payload.get("user_id")
-    except:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except jwt.PyJWTError:
         return None
+    
+    user_id = payload.get("user_id")
+    if user_id:
+        expires_at = min(payload.get("exp", now + JWT_CACHE_TTL), now + JWT_CACHE_TTL)
+        _jwt_cache[token_hash] = (user_id, expires_at)
+        if len(_jwt_cache) > JWT_CACHE_MAX_SIZE:
+            _jwt_cache.popitem(last=False)
+    return user_id
 
 
 def create_task(event: dict) -> dict:
@@ -84,44 +185,45 @@ def create_task(event: dict) -> dict:
         return cors_response(400, {"error": "Title is required"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        cursor.execute(f"""
-            INSERT INTO {schema}.accountant_tasks 
-            (user_id, task_type, title, description, priority, due_date)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id, status, created_at
-        """, (user_id, task_type, title, description, priority, due_date))
-        
-        task_id, status, created_at = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return cors_response(201, {
-            "success": True,
-            "task": {
-                "id": task_id,
-                "task_type": task_type,
-                "title": title,
-                "description": description,
-                "status": status,
-                "priority": priority,
-                "due_date": due_date,
-                "created_at": created_at.isoformat() if created_at else None
-            }
-        })
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            cursor.execute(f"""
+                INSERT INTO {schema}.accountant_tasks 
+                (user_id, task_type, title, description, priority, due_date)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id, status, created_at
+            """, (user_id, task_type, title, description, priority, due_date))
+            
+            task_id, status, created_at = cursor.fetchone()
+            conn.commit()
+            cursor.close()
+            
+            return cors_response(201, {
+                "success": True,
+                "task": {
+                    "id": task_id,
+                    "task_type": task_type,
+                    "title": title,
+                    "description": description,
+                    "status": status,
+                    "priority": priority,
+                    "due_date": due_date,
+                    "created_at": created_at.isoformat() if created_at else None
+                }
+            })
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
 
 def get_tasks(event: dict) -> dict:
     """
+    GET /tasks?status=pending&limit=50&cursor=...
     GET /tasks?status=pending&limit=50&offset=0
-    Получить список задач пользователя
+    Получить список задач пользователя.
+    Без offset используется постраничный вывод по курсору (next_cursor в ответе).
     """
     # Авторизация
     auth_header = event.get('headers', {}).get('X-Authorization', '')
@@ -134,74 +236,173 @@ def get_tasks(event: dict) -> dict:
     # Параметры фильтрации и пагинации
     params = event.get('queryStringParameters', {}) or {}
     status_filter = params.get('status')
-    limit = int(params.get('limit', 50))
-    offset = int(params.get('offset', 0))
+    try:
+        limit = int(params.get('limit', 50))
+        offset = int(params.get('offset', 0))
+    except ValueError:
+        return cors_response(400, {"error": "Invalid limit or offset"})
+    
+    if 'offset' not in params:
+        position = None
+        if params.get('cursor'):
+            position = decode_cursor(params['cursor'])
+            if position is None:
+                return cors_response(400, {"error": "Invalid cursor"})
+        return get_tasks_page(user_id, status_filter, limit, position)
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        
-        if status_filter:
-            cursor.execute(f"""
-                SELECT id, task_type, title, description, status, priority, 
-                       due_date, completed_at, created_at, updated_at
-                FROM {schema}.accountant_tasks
-                WHERE user_id = %s AND status = %s
-                ORDER BY 
-                    CASE priority 
-                        WHEN 'urgent' THEN 1
-                        WHEN 'high' THEN 2
-                        WHEN 'medium' THEN 3
-                        ELSE 4
-                    END,
-                    due_date ASC NULLS LAST,
-                    created_at DESC
-                LIMIT %s OFFSET %s
-            """, (user_id, status_filter, limit, offset))
-        else:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            
+            if status_filter:
+                cursor.execute(f"""
+                    SELECT id, task_type, title, description, status, priority, 
+                           due_date, completed_at, created_at, updated_at
+                    FROM {schema}.accountant_tasks
+                    WHERE user_id = %s AND status = %s
+                    ORDER BY 
+                        CASE priority 
+                            WHEN 'urgent' THEN 1
+                            WHEN 'high' THEN 2
+                            WHEN 'medium' THEN 3
+                            ELSE 4
+                        END,
+                        due_date ASC NULLS LAST,
+                        created_at DESC
+                    LIMIT %s OFFSET %s
+                """, (user_id, status_filter, limit, offset))
+            else:
+                cursor.execute(f"""
+                    SELECT id, task_type, title, description, status, priority, 
+                           due_date, completed_at, created_at, updated_at
+                    FROM {schema}.accountant_tasks
+                    WHERE user_id = %s
+                    ORDER BY 
+                        CASE status 
+                            WHEN 'in_progress' THEN 1
+                            WHEN 'pending' THEN 2
+                            ELSE 3
+                        END,
+                        CASE priority 
+                            WHEN 'urgent' THEN 1
+                            WHEN 'high' THEN 2
+                            WHEN 'medium' THEN 3
+                            ELSE 4
+                        END,
+                        due_date ASC NULLS LAST
+                    LIMIT %s OFFSET %s
+                """, (user_id, limit, offset))
+            
+            tasks = []
+            for row in cursor.fetchall():
+                tasks.append({
+                    "id": row[0],
+                    "task_type": row[1],
+                    "title": row[2],
+                    "description": row[3],
+                    "status": row[4],
+                    "priority": row[5],
+                    "due_date": row[6].isoformat() if row[6] else None,
+                    "completed_at": row[7].isoformat() if row[7] else None,
+                    "created_at": row[8].isoformat() if row[8] else None,
+                    "updated_at": row[9].isoformat() if row[9] else None
+                })
+            
+            cursor.close()
+            
+            return cors_response(200, {"tasks": tasks})
+            
+    except Exception as e:
+        return cors_response(500, {"error": f"Database error: {str(e)}"})
+
+
+def encode_cursor(status_rank: int, priority_rank: int, due_key: str, task_id: int) -> str:
+    """Упаковать позицию последней задачи страницы в непрозрачный курсор"""
+    raw = json.dumps([status_rank, priority_rank, due_key, task_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor_value: str) -> Optional[Tuple[int, int, str, int]]:
+    """Распаковать курсор; None, если курсор повреждён"""
+    try:
+        padded = cursor_value + '=' * (-len(cursor_value) % 4)
+        status_rank, priority_rank, due_key, task_id = json.loads(base64.urlsafe_b64decode(padded))
+        # В SQL ключ приводится к timestamp: подделанное значение отсекаем здесь
+        if due_key != 'infinity':
+            due_key = datetime.fromisoformat(due_key).isoformat()
+        return int(status_rank), int(priority_rank), due_key, int(task_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def get_tasks_page(user_id: int, status_filter: Optional[str], limit: int,
+                   position: Optional[Tuple[int, int, str, int]]) -> dict:
+    """
+    Страница задач по курсору (keyset-пагинация).
+    Сортировка по status_rank, priority_rank, сроку (без срока — в конце) и id
+    обслуживается индексом idx_accountant_tasks_keyset, поэтому стоимость
+    страницы не зависит от её номера.
+    """
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            
+            conditions = ["user_id = %s"]
+            values = [user_id]
+            
+            if status_filter:
+                conditions.append("status = %s")
+                values.append(status_filter)
+            
+            if position:
+                conditions.append("""
+                    (status_rank, priority_rank, COALESCE(due_date, 'infinity'::timestamp), id)
+                    > (%s, %s, %s::timestamp, %s)
+                """)
+                values.extend(position)
+            
+            values.append(limit + 1)
             cursor.execute(f"""
                 SELECT id, task_type, title, description, status, priority, 
-                       due_date, completed_at, created_at, updated_at
+                       due_date, completed_at, created_at, updated_at,
+                       status_rank, priority_rank
                 FROM {schema}.accountant_tasks
-                WHERE user_id = %s
-                ORDER BY 
-                    CASE status 
-                        WHEN 'in_progress' THEN 1
-                        WHEN 'pending' THEN 2
-                        ELSE 3
-                    END,
-                    CASE priority 
-                        WHEN 'urgent' THEN 1
-                        WHEN 'high' THEN 2
-                        WHEN 'medium' THEN 3
-                        ELSE 4
-                    END,
-                    due_date ASC NULLS LAST
-                LIMIT %s OFFSET %s
-            """, (user_id, limit, offset))
-        
-        tasks = []
-        for row in cursor.fetchall():
-            tasks.append({
-                "id": row[0],
-                "task_type": row[1],
-                "title": row[2],
-                "description": row[3],
-                "status": row[4],
-                "priority": row[5],
-                "due_date": row[6].isoformat() if row[6] else None,
-                "completed_at": row[7].isoformat() if row[7] else None,
-                "created_at": row[8].isoformat() if row[8] else None,
-                "updated_at": row[9].isoformat() if row[9] else None
-            })
-        
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {"tasks": tasks})
-        
+                WHERE {' AND '.join(conditions)}
+                ORDER BY status_rank, priority_rank,
+                         COALESCE(due_date, 'infinity'::timestamp), id
+                LIMIT %s
+            """, values)
+            
+            rows = cursor.fetchall()
+            cursor.close()
+            
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                last = rows[-1]
+                due_key = last[6].isoformat() if last[6] else 'infinity'
+                next_cursor = encode_cursor(last[10], last[11], due_key, last[0])
+            
+            tasks = []
+            for row in rows:
+                tasks.append({
+                    "id": row[0],
+                    "task_type": row[1],
+                    "title": row[2],
+                    "description": row[3],
+                    "status": row[4],
+                    "priority": row[5],
+                    "due_date": row[6].isoformat() if row[6] else None,
+                    "completed_at": row[7].isoformat() if row[7] else None,
+                    "created_at": row[8].isoformat() if row[8] else None,
+                    "updated_at": row[9].isoformat() if row[9] else None
+                })
+            
+            return cors_response(200, {"tasks": tasks, "next_cursor": next_cursor})
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
@@ -237,87 +438,84 @@ def update_task(event: dict) -> dict:
         return cors_response(400, {"error": "Invalid JSON"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        
-        # Проверка прав доступа
-        cursor.execute(f"""
-            SELECT id FROM {schema}.accountant_tasks
-            WHERE id = %s AND user_id = %s
-        """, (task_id, user_id))
-        
-        if not cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return cors_response(404, {"error": "Task not found"})
-        
-        # Формирование запроса на обновление
-        updates = []
-        values = []
-        
-        if 'status' in body:
-            updates.append("status = %s")
-            values.append(body['status'])
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            schema = get_env("MAIN_DB_SCHEMA", "public")
             
-            # Если статус completed, установить completed_at
-            if body['status'] == 'completed':
-                updates.append("completed_at = CURRENT_TIMESTAMP")
-        
-        if 'title' in body:
-            updates.append("title = %s")
-            values.append(body['title'])
-        
-        if 'description' in body:
-            updates.append("description = %s")
-            values.append(body['description'])
-        
-        if 'priority' in body:
-            updates.append("priority = %s")
-            values.append(body['priority'])
-        
-        if 'due_date' in body:
-            updates.append("due_date = %s")
-            values.append(body['due_date'])
-        
-        if not updates:
+            # Проверка прав доступа
+            cursor.execute(f"""
+                SELECT id FROM {schema}.accountant_tasks
+                WHERE id = %s AND user_id = %s
+            """, (task_id, user_id))
+            
+            if not cursor.fetchone():
+                cursor.close()
+                return cors_response(404, {"error": "Task not found"})
+            
+            # Формирование запроса на обновление
+            updates = []
+            values = []
+            
+            if 'status' in body:
+                updates.append("status = %s")
+                values.append(body['status'])
+                
+                # Если статус completed, установить completed_at
+                if body['status'] == 'completed':
+                    updates.append("completed_at = CURRENT_TIMESTAMP")
+            
+            if 'title' in body:
+                updates.append("title = %s")
+                values.append(body['title'])
+            
+            if 'description' in body:
+                updates.append("description = %s")
+                values.append(body['description'])
+            
+            if 'priority' in body:
+                updates.append("priority = %s")
+                values.append(body['priority'])
+            
+            if 'due_date' in body:
+                updates.append("due_date = %s")
+                values.append(body['due_date'])
+            
+            if not updates:
+                cursor.close()
+                return cors_response(400, {"error": "No fields to update"})
+            
+            updates.append("updated_at = CURRENT_TIMESTAMP")
+            values.append(task_id)
+            
+            query = f"""
+                UPDATE {schema}.accountant_tasks
+                SET {', '.join(updates)}
+                WHERE id = %s
+                RETURNING id, task_type, title, description, status, priority, 
+                          due_date, completed_at, created_at, updated_at
+            """
+            
+            cursor.execute(query, values)
+            row = cursor.fetchone()
+            conn.commit()
             cursor.close()
-            conn.close()
-            return cors_response(400, {"error": "No fields to update"})
-        
-        updates.append("updated_at = CURRENT_TIMESTAMP")
-        values.append(task_id)
-        
-        query = f"""
-            UPDATE {schema}.accountant_tasks
-            SET {', '.join(updates)}
-            WHERE id = %s
-            RETURNING id, task_type, title, description, status, priority, 
-                      due_date, completed_at, created_at, updated_at
-        """
-        
-        cursor.execute(query, values)
-        row = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {
-            "success": True,
-            "task": {
-                "id": row[0],
-                "task_type": row[1],
-                "title": row[2],
-                "description": row[3],
-                "status": row[4],
-                "priority": row[5],
-                "due_date": row[6].isoformat() if row[6] else None,
-                "completed_at": row[7].isoformat() if row[7] else None,
-                "created_at": row[8].isoformat() if row[8] else None,
-                "updated_at": row[9].isoformat() if row[9] else None
-            }
-        })
-        
+            
+            return cors_response(200, {
+                "success": True,
+                "task": {
+                    "id": row[0],
+                    "task_type": row[1],
+                    "title": row[2],
+                    "description": row[3],
+                    "status": row[4],
+                    "priority": row[5],
+                    "due_date": row[6].isoformat() if row[6] else None,
+                    "completed_at": row[7].isoformat() if row[7] else None,
+                    "created_at": row[8].isoformat() if row[8] else None,
+                    "updated_at": row[9].isoformat() if row[9] else None
+                }
+            })
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
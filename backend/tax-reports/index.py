@@ -4,9 +4,15 @@ API для управления календарём налоговых отчё
 """
 import json
 import os
+import hashlib
+import time
+import jwt
 import psycopg2
+from psycopg2 import extensions, pool
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Dict, List, Tuple
 
 
 def get_env(key: str, default: str = "") -> str:
@@ -14,10 +20,75 @@ def get_env(key: str, default: str = "") -> str:
     return os.environ.get(key, default)
 
 
-def get_db_connection():
-    """Создать подключение к базе данных"""
-    dsn = get_env("DATABASE_URL")
-    return psycopg2.connect(dsn)
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(get_env("DB_POOL_MIN_SIZE", "1")),
+            int(get_env("DB_POOL_MAX_SIZE", "5")),
+            get_env("DATABASE_URL")
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(get_env("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(get_env("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
 
 
 def cors_response(status_code: int, body: dict) -> dict:
@@ -34,18 +105,47 @@ def cors_response(status_code: int, body: dict) -> dict:
     }
 
 
+JWT_SECRET = get_env("JWT_SECRET")
+JWT_CACHE_MAX_SIZE = int(get_env("JWT_CACHE_MAX_SIZE", "1024"))
+JWT_CACHE_TTL = float(get_env("JWT_CACHE_TTL", "300"))
+
+_jwt_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+jwt_cache_stats = {"hits": 0, "misses": 0}
+
+
 def verify_jwt(token: str) -> Optional[int]:
-    """Проверка JWT токена и извлечение user_id"""
+    """
+    Проверка JWT токена и извлечение user_id.
+    Расшифрованные токены кэшируются (LRU по SHA-256 токена) до истечения
+    exp, но не дольше JWT_CACHE_TTL секунд.
+    """
     if not token:
         return None
     
-    import jwt
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    
+    cached = _jwt_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _jwt_cache.move_to_end(token_hash)
+        jwt_cache_stats["hits"] += 1
+        return cached[0]
+    
+    jwt_cache_stats["misses"] += 1
+    _jwt_cache.pop(token_hash, None)
+    
     try:
-        jwt_secret = get_env("JWT_SECRET")
-        payload = jwt.decode(token, jwt_secret, algorithms=["HS256"])
-        return payload.get("user_id")
-    except:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except jwt.PyJWTError:
         return None
+    
+    user_id = payload.get("user_id")
+    if user_id:
+        expires_at = min(payload.get("exp", now + JWT_CACHE_TTL), now + JWT_CACHE_TTL)
+        _jwt_cache[token_hash] = (user_id, expires_at)
+        if len(_jwt_cache) > JWT_CACHE_MAX_SIZE:
+            _jwt_cache.popitem(last=False)
+    return user_id
 
 
 def get_reports(event: dict) -> dict:
@@ -68,66 +168,65 @@ def get_reports(event: dict) -> dict:
     status_filter = params.get('status')
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        
-        # Базовый запрос
-        query_parts = [f"""
-            SELECT id, report_type, report_name, description, due_date, 
-                   frequency, status, submitted_at, reminder_days, 
-                   created_at, updated_at
-            FROM {schema}.tax_reports_calendar
-            WHERE user_id = %s
-        """]
-        query_params = [user_id]
-        
-        # Фильтры
-        if from_date:
-            query_parts.append("AND due_date >= %s")
-            query_params.append(from_date)
-        
-        if to_date:
-            query_parts.append("AND due_date <= %s")
-            query_params.append(to_date)
-        
-        if status_filter:
-            query_parts.append("AND status = %s")
-            query_params.append(status_filter)
-        
-        query_parts.append("ORDER BY due_date ASC, created_at DESC")
-        
-        cursor.execute(" ".join(query_parts), query_params)
-        
-        reports = []
-        today = datetime.now().date()
-        
-        for row in cursor.fetchall():
-            due_date = row[4]
-            days_until_due = (due_date - today).days if due_date else None
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            
+            # Базовый запрос
+            query_parts = [f"""
+                SELECT id, report_type, report_name, description, due_date, 
+                       frequency, status, submitted_at, reminder_days, 
+                       created_at, updated_at
+                FROM {schema}.tax_reports_calendar
+                WHERE user_id = %s
+            """]
+            query_params = [user_id]
+            
+            # Фильтры
+            if from_date:
+                query_parts.append("AND due_date >= %s")
+                query_params.append(from_date)
+            
+            if to_date:
+                query_parts.append("AND due_date <= %s")
+                query_params.append(to_date)
+            
+            if status_filter:
+                query_parts.append("AND status = %s")
+                query_params.append(status_filter)
+            
+            query_parts.append("ORDER BY due_date ASC, created_at DESC")
+            
+            cursor.execute(" ".join(query_parts), query_params)
+            
+            reports = []
+            today = datetime.now().date()
+            
+            for row in cursor.fetchall():
+                due_date = row[4]
+                days_until_due = (due_date - today).days if due_date else None
+                
+                reports.append({
+                    "id": row[0],
+                    "report_type": row[1],
+                    "report_name": row[2],
+                    "description": row[3],
+                    "due_date": due_date.isoformat() if due_date else None,
+                    "frequency": row[5],
+                    "status": row[6],
+                    "submitted_at": row[7].isoformat() if row[7] else None,
+                    "reminder_days": row[8],
+                    "days_until_due": days_until_due,
+                    "is_urgent": days_until_due is not None and 0 <= days_until_due <= row[8],
+                    "created_at": row[9].isoformat() if row[9] else None,
+                    "updated_at": row[10].isoformat() if row[10] else None
+                })
+            
+            cursor.close()
+            
+            return cors_response(200, {"reports": reports})
             
-            reports.append({
-                "id": row[0],
-                "report_type": row[1],
-                "report_name": row[2],
-                "description": row[3],
-                "due_date": due_date.isoformat() if due_date else None,
-                "frequency": row[5],
-                "status": row[6],
-                "submitted_at": row[7].isoformat() if row[7] else None,
-                "reminder_days": row[8],
-                "days_until_due": days_until_due,
-                "is_urgent": days_until_due is not None and 0 <= days_until_due <= row[8],
-                "created_at": row[9].isoformat() if row[9] else None,
-                "updated_at": row[10].isoformat() if row[10] else None
-            })
-        
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {"reports": reports})
-        
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
@@ -170,37 +269,36 @@ def create_report(event: dict) -> dict:
         return cors_response(400, {"error": "Report name and due date are required"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        cursor.execute(f"""
-            INSERT INTO {schema}.tax_reports_calendar 
-            (user_id, report_type, report_name, description, due_date, frequency, reminder_days)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id, status, created_at
-        """, (user_id, report_type, report_name, description, due_date, frequency, reminder_days))
-        
-        report_id, status, created_at = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return cors_response(201, {
-            "success": True,
-            "report": {
-                "id": report_id,
-                "report_type": report_type,
-                "report_name": report_name,
-                "description": description,
-                "due_date": due_date,
-                "frequency": frequency,
-                "status": status,
-                "reminder_days": reminder_days,
-                "created_at": created_at.isoformat() if created_at else None
-            }
-        })
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            schema = get_env("MAIN_DB_SCHEMA", "public")
+            cursor.execute(f"""
+                INSERT INTO {schema}.tax_reports_calendar 
+                (user_id, report_type, report_name, description, due_date, frequency, reminder_days)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id, status, created_at
+            """, (user_id, report_type, report_name, description, due_date, frequency, reminder_days))
+            
+            report_id, status, created_at = cursor.fetchone()
+            conn.commit()
+            cursor.close()
+            
+            return cors_response(201, {
+                "success": True,
+                "report": {
+                    "id": report_id,
+                    "report_type": report_type,
+                    "report_name": report_name,
+                    "description": description,
+                    "due_date": due_date,
+                    "frequency": frequency,
+                    "status": status,
+                    "reminder_days": reminder_days,
+                    "created_at": created_at.isoformat() if created_at else None
+                }
+            })
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
@@ -235,81 +333,78 @@ def update_report(event: dict) -> dict:
         return cors_response(400, {"error": "Invalid JSON"})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        schema = get_env("MAIN_DB_SCHEMA", "public")
-        
-        # Проверка прав доступа
-        cursor.execute(f"""
-            SELECT id FROM {schema}.tax_reports_calendar
-            WHERE id = %s AND user_id = %s
-        """, (report_id, user_id))
-        
-        if not cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return cors_response(404, {"error": "Report not found"})
-        
-        # Формирование запроса на обновление
-        updates = []
-        values = []
-        
-        if 'status' in body:
-            updates.append("status = %s")
-            values.append(body['status'])
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            schema = get_env("MAIN_DB_SCHEMA", "public")
             
-            # Если статус submitted, установить submitted_at
-            if body['status'] == 'submitted':
-                updates.append("submitted_at = CURRENT_TIMESTAMP")
-        
-        if 'due_date' in body:
-            updates.append("due_date = %s")
-            values.append(body['due_date'])
-        
-        if 'reminder_days' in body:
-            updates.append("reminder_days = %s")
-            values.append(body['reminder_days'])
-        
-        if not updates:
+            # Проверка прав доступа
+            cursor.execute(f"""
+                SELECT id FROM {schema}.tax_reports_calendar
+                WHERE id = %s AND user_id = %s
+            """, (report_id, user_id))
+            
+            if not cursor.fetchone():
+                cursor.close()
+                return cors_response(404, {"error": "Report not found"})
+            
+            # Формирование запроса на обновление
+            updates = []
+            values = []
+            
+            if 'status' in body:
+                updates.append("status = %s")
+                values.append(body['status'])
+                
+                # Если статус submitted, установить submitted_at
+                if body['status'] == 'submitted':
+                    updates.append("submitted_at = CURRENT_TIMESTAMP")
+            
+            if 'due_date' in body:
+                updates.append("due_date = %s")
+                values.append(body['due_date'])
+            
+            if 'reminder_days' in body:
+                updates.append("reminder_days = %s")
+                values.append(body['reminder_days'])
+            
+            if not updates:
+                cursor.close()
+                return cors_response(400, {"error": "No fields to update"})
+            
+            updates.append("updated_at = CURRENT_TIMESTAMP")
+            values.append(report_id)
+            
+            query = f"""
+                UPDATE {schema}.tax_reports_calendar
+                SET {', '.join(updates)}
+                WHERE id = %s
+                RETURNING id, report_type, report_name, description, due_date, 
+                          frequency, status, submitted_at, reminder_days, 
+                          created_at, updated_at
+            """
+            
+            cursor.execute(query, values)
+            row = cursor.fetchone()
+            conn.commit()
             cursor.close()
-            conn.close()
-            return cors_response(400, {"error": "No fields to update"})
-        
-        updates.append("updated_at = CURRENT_TIMESTAMP")
-        values.append(report_id)
-        
-        query = f"""
-            UPDATE {schema}.tax_reports_calendar
-            SET {', '.join(updates)}
-            WHERE id = %s
-            RETURNING id, report_type, report_name, description, due_date, 
-                      frequency, status, submitted_at, reminder_days, 
-                      created_at, updated_at
-        """
-        
-        cursor.execute(query, values)
-        row = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return cors_response(200, {
-            "success": True,
-            "report": {
-                "id": row[0],
-                "report_type": row[1],
-                "report_name": row[2],
-                "description": row[3],
-                "due_date": row[4].isoformat() if row[4] else None,
-                "frequency": row[5],
-                "status": row[6],
-                "submitted_at": row[7].isoformat() if row[7] else None,
-                "reminder_days": row[8],
-                "created_at": row[9].isoformat() if row[9] else None,
-                "updated_at": row[10].isoformat() if row[10] else None
-            }
-        })
-        
+            
+            return cors_response(200, {
+                "success": True,
+                "report": {
+                    "id": row[0],
+                    "report_type": row[1],
+                    "report_name": row[2],
+                    "description": row[3],
+                    "due_date": row[4].isoformat() if row[4] else None,
+                    "frequency": row[5],
+                    "status": row[6],
+                    "submitted_at": row[7].isoformat() if row[7] else None,
+                    "reminder_days": row[8],
+                    "created_at": row[9].isoformat() if row[9] else None,
+                    "updated_at": row[10].isoformat() if row[10] else None
+                }
+            })
+            
     except Exception as e:
         return cors_response(500, {"error": f"Database error: {str(e)}"})
 
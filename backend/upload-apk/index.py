@@ -1,8 +1,84 @@
 import json
 import os
+import time
 import boto3
 import base64
 import psycopg2
+from psycopg2 import extensions, pool
+from contextlib import contextmanager
+from typing import Optional, Dict, List
+
+
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            int(os.environ.get("DB_POOL_MAX_SIZE", "5")),
+            os.environ["DATABASE_URL"]
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(os.environ.get("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(os.environ.get("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+
 
 def handler(event: dict, context) -> dict:
     '''API для загрузки APK-файла в облачное хранилище через браузер'''
@@ -22,47 +98,46 @@ def handler(event: dict, context) -> dict:
     # GET запрос - вернуть текущий URL APK
     if method == 'GET':
         try:
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
-            cur = conn.cursor()
-            
-            cur.execute("""
-                SELECT download_url, file_name 
-                FROM mobile_apk_versions 
-                WHERE is_active = true 
-                ORDER BY uploaded_at DESC 
-                LIMIT 1
-            """)
-            
-            result = cur.fetchone()
-            cur.close()
-            conn.close()
-            
-            if result:
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({
-                        'success': True,
-                        'downloadUrl': result[0],
-                        'fileName': result[1]
-                    })
-                }
-            else:
-                return {
-                    'statusCode': 404,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({
-                        'success': False,
-                        'error': 'APK файл еще не загружен'
-                    })
-                }
+            with db_connection() as conn:
+                cur = conn.cursor()
+                
+                cur.execute("""
+                    SELECT download_url, file_name 
+                    FROM mobile_apk_versions 
+                    WHERE is_active = true 
+                    ORDER BY uploaded_at DESC 
+                    LIMIT 1
+                """)
+                
+                result = cur.fetchone()
+                cur.close()
                 
+                if result:
+                    return {
+                        'statusCode': 200,
+                        'headers': {
+                            'Content-Type': 'application/json',
+                            'Access-Control-Allow-Origin': '*'
+                        },
+                        'body': json.dumps({
+                            'success': True,
+                            'downloadUrl': result[0],
+                            'fileName': result[1]
+                        })
+                    }
+                else:
+                    return {
+                        'statusCode': 404,
+                        'headers': {
+                            'Content-Type': 'application/json',
+                            'Access-Control-Allow-Origin': '*'
+                        },
+                        'body': json.dumps({
+                            'success': False,
+                            'error': 'APK файл еще не загружен'
+                        })
+                    }
+                    
         except Exception as e:
             return {
                 'statusCode': 500,
@@ -115,41 +190,40 @@ def handler(event: dict, context) -> dict:
             cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{apk_key}"
             
             # Сохраняем в базу данных
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
-            cur = conn.cursor()
-            
-            # Деактивируем предыдущие версии
-            cur.execute("""
-                UPDATE mobile_apk_versions 
-                SET is_active = false 
-                WHERE is_active = true
-            """)
-            
-            # Добавляем новую версию
-            cur.execute("""
-                INSERT INTO mobile_apk_versions 
-                (file_name, download_url, is_active) 
-                VALUES (%s, %s, %s)
-            """, (file_name, cdn_url, True))
-            
-            conn.commit()
-            cur.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'success': True,
-                    'message': 'APK успешно загружен',
-                    'downloadUrl': cdn_url,
-                    'fileName': file_name
-                })
-            }
-            
+            with db_connection() as conn:
+                cur = conn.cursor()
+                
+                # Деактивируем предыдущие версии
+                cur.execute("""
+                    UPDATE mobile_apk_versions 
+                    SET is_active = false 
+                    WHERE is_active = true
+                """)
+                
+                # Добавляем новую версию
+                cur.execute("""
+                    INSERT INTO mobile_apk_versions 
+                    (file_name, download_url, is_active) 
+                    VALUES (%s, %s, %s)
+                """, (file_name, cdn_url, True))
+                
+                conn.commit()
+                cur.close()
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'success': True,
+                        'message': 'APK успешно загружен',
+                        'downloadUrl': cdn_url,
+                        'fileName': file_name
+                    })
+                }
+                
         except Exception as e:
             return {
                 'statusCode': 500,
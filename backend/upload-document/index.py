@@ -1,14 +1,123 @@
 import json
 import os
+import time
 import base64
+import hashlib
 import boto3
+import jwt
 import requests
+import psycopg2
+from psycopg2 import extensions, pool
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Optional, Dict, List, Tuple
+from botocore.exceptions import ClientError
+
+UPLOAD_PART_SIZE = int(os.environ.get('UPLOAD_PART_SIZE', str(8 * 1024 * 1024)))
+UPLOAD_URL_TTL = int(os.environ.get('UPLOAD_URL_TTL', '3600'))
+MAX_UPLOAD_PARTS = 10000
+
+CONTENT_TYPE_MAP = {
+    'pdf': 'application/pdf',
+    'doc': 'application/msword',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'xls': 'application/vnd.ms-excel',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+}
+
+OCR_EXTENSIONS = ['jpg', 'jpeg', 'png', 'pdf']
+OCR_FUNCTION_URL = 'https://functions.poehali.dev/c0e33330-1f53-405f-9e4a-081015ff0924'
+
+JWT_SECRET = os.environ.get('JWT_SECRET', '')
+JWT_CACHE_MAX_SIZE = int(os.environ.get('JWT_CACHE_MAX_SIZE', '1024'))
+JWT_CACHE_TTL = float(os.environ.get('JWT_CACHE_TTL', '300'))
+
+_jwt_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+
+
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            int(os.environ.get("DB_POOL_MAX_SIZE", "5")),
+            os.environ["DATABASE_URL"]
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(os.environ.get("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(os.environ.get("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+
 
 def handler(event: dict, context) -> dict:
     '''
     Загружает документы (счета, акты, накладные) в S3 хранилище 
-    и сохраняет метаданные в базу данных для модуля бухгалтерии
+    и сохраняет метаданные в базу данных для модуля бухгалтерии.
+    Для авторизованных клиентов распознавание ставится в очередь ocr_jobs
+    и выполняется воркером parse-document-ocr; статус доступен по documentId.
+    Без токена документ не сохраняется и распознаётся синхронно (ocrData),
+    пока старые клиенты не перейдут на загрузку по presigned-ссылке.
     '''
     method = event.get('httpMethod', 'POST')
     
@@ -18,7 +127,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
+                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization'
             },
             'body': ''
         }
@@ -32,6 +141,14 @@ def handler(event: dict, context) -> dict:
     
     try:
         body = json.loads(event.get('body', '{}'))
+        
+        params = event.get('queryStringParameters') or {}
+        action = params.get('action')
+        if action == 'upload-url':
+            return request_upload_url(event, body)
+        if action == 'complete':
+            return complete_upload(event, body)
+        
         file_name = body.get('fileName')
         file_content_base64 = body.get('fileContent')
         file_type = body.get('fileType', 'document')
@@ -45,28 +162,13 @@ def handler(event: dict, context) -> dict:
         
         file_data = base64.b64decode(file_content_base64)
         
-        s3 = boto3.client('s3',
-            endpoint_url='https://bucket.poehali.dev',
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
-        )
+        s3 = get_s3_client()
         
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         s3_key = f'accounting/documents/{timestamp}_{file_name}'
         
-        content_type_map = {
-            'pdf': 'application/pdf',
-            'doc': 'application/msword',
-            'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'xls': 'application/vnd.ms-excel',
-            'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'jpg': 'image/jpeg',
-            'jpeg': 'image/jpeg',
-            'png': 'image/png',
-        }
-        
         extension = file_name.split('.')[-1].lower()
-        content_type = content_type_map.get(extension, 'application/octet-stream')
+        content_type = CONTENT_TYPE_MAP.get(extension, 'application/octet-stream')
         
         s3.put_object(
             Bucket='files',
@@ -77,20 +179,18 @@ def handler(event: dict, context) -> dict:
         
         cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{s3_key}"
         
-        ocr_data = None
-        if extension in ['jpg', 'jpeg', 'png', 'pdf']:
-            try:
-                ocr_response = requests.post(
-                    'https://functions.poehali.dev/c0e33330-1f53-405f-9e4a-081015ff0924',
-                    json={'imageContent': file_content_base64},
-                    timeout=30
-                )
-                if ocr_response.status_code == 200:
-                    ocr_result = ocr_response.json()
-                    if ocr_result.get('success'):
-                        ocr_data = ocr_result.get('extractedData')
-            except Exception:
-                pass
+        user_id = get_user_id(event)
+        if user_id:
+            document_id, ocr_status = save_document(
+                user_id, file_name, cdn_url, content_type, len(file_data), s3_key,
+                extension in OCR_EXTENSIONS
+            )
+            result = {'documentId': document_id, 'ocrStatus': ocr_status}
+        else:
+            ocr_data = None
+            if extension in OCR_EXTENSIONS:
+                ocr_data = recognize_inline(file_content_base64)
+            result = {'ocrData': ocr_data}
         
         return {
             'statusCode': 200,
@@ -101,7 +201,7 @@ def handler(event: dict, context) -> dict:
                 'fileName': file_name,
                 'fileType': file_type,
                 'uploadedAt': datetime.now().isoformat(),
-                'ocrData': ocr_data
+                **result
             })
         }
         
@@ -110,4 +210,300 @@ def handler(event: dict, context) -> dict:
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': str(e)})
-        }
\ No newline at end of file
+        }
+
+
+def get_s3_client():
+    '''Создаёт S3 клиента для хранилища проекта'''
+    return boto3.client('s3',
+        endpoint_url='https://bucket.poehali.dev',
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+    )
+
+
+def verify_jwt(token: str) -> Optional[int]:
+    '''
+    Проверяет JWT токен и возвращает user_id. Расшифрованные токены кэшируются
+    (LRU по SHA-256 токена) до истечения exp, но не дольше JWT_CACHE_TTL секунд
+    '''
+    if not token:
+        return None
+    
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    
+    cached = _jwt_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _jwt_cache.move_to_end(token_hash)
+        return cached[0]
+    _jwt_cache.pop(token_hash, None)
+    
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+    except jwt.PyJWTError:
+        return None
+    
+    user_id = payload.get('user_id')
+    if user_id:
+        expires_at = min(payload.get('exp', now + JWT_CACHE_TTL), now + JWT_CACHE_TTL)
+        _jwt_cache[token_hash] = (user_id, expires_at)
+        if len(_jwt_cache) > JWT_CACHE_MAX_SIZE:
+            _jwt_cache.popitem(last=False)
+    return user_id
+
+
+def get_user_id(event: dict) -> Optional[int]:
+    '''user_id из заголовка X-Authorization или None'''
+    auth_header = (event.get('headers') or {}).get('X-Authorization', '')
+    return verify_jwt(auth_header.replace('Bearer ', '') if auth_header else '')
+
+
+def get_schema() -> str:
+    '''Префикс схемы БД'''
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    return f'{schema}.' if schema else ''
+
+
+def recognize_inline(file_content_base64: str) -> Optional[dict]:
+    '''Синхронное распознавание через parse-document-ocr для клиентов без токена'''
+    try:
+        ocr_response = requests.post(
+            OCR_FUNCTION_URL,
+            json={'imageContent': file_content_base64},
+            timeout=30
+        )
+        if ocr_response.status_code == 200:
+            ocr_result = ocr_response.json()
+            if ocr_result.get('success'):
+                return ocr_result.get('extractedData')
+    except Exception:
+        pass
+    return None
+
+
+def save_document(user_id: int, file_name: str, file_url: str, content_type: str,
+                  file_size: int, s3_key: str, enqueue_ocr: bool) -> Tuple[int, Optional[str]]:
+    '''
+    Сохраняет метаданные документа и, если нужно, ставит задачу OCR
+    в очередь одним запросом. Возвращает id документа и статус распознавания.
+    '''
+    schema = get_schema()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'''
+            WITH doc AS (
+                INSERT INTO {schema}accounting_documents
+                (user_id, file_name, file_url, file_type, file_size, status, s3_key)
+                VALUES (%s, %s, %s, %s, %s, 'pending', %s)
+                RETURNING id
+            ), job AS (
+                INSERT INTO {schema}ocr_jobs (document_id)
+                SELECT id FROM doc WHERE %s
+                RETURNING id
+            )
+            SELECT doc.id, (SELECT COUNT(*) FROM job) FROM doc
+        ''', (user_id, file_name, file_url, content_type, file_size, s3_key, enqueue_ocr))
+        document_id, queued = cur.fetchone()
+        conn.commit()
+        cur.close()
+    return document_id, 'pending' if queued else None
+
+
+def create_upload_document(user_id: int, file_name: str, file_url: str, content_type: str,
+                           file_size: int, s3_key: str) -> int:
+    '''Создаёт документ в статусе uploading до загрузки файла по presigned-ссылке'''
+    schema = get_schema()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'''
+            INSERT INTO {schema}accounting_documents
+            (user_id, file_name, file_url, file_type, file_size, status, s3_key)
+            VALUES (%s, %s, %s, %s, %s, 'uploading', %s)
+            RETURNING id
+        ''', (user_id, file_name, file_url, content_type, file_size, s3_key))
+        document_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    return document_id
+
+
+def request_upload_url(event: dict, body: dict) -> dict:
+    '''
+    Выдаёт presigned-ссылки для загрузки файла напрямую в S3 и создаёт
+    документ в статусе uploading. Файлы больше UPLOAD_PART_SIZE загружаются
+    по частям (multipart).
+    '''
+    user_id = get_user_id(event)
+    if not user_id:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Unauthorized'})
+        }
+    
+    file_name = body.get('fileName')
+    file_size = int(body.get('fileSize') or 0)
+    
+    if not file_name or file_size <= 0:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'fileName and fileSize required'})
+        }
+    
+    part_count = (file_size + UPLOAD_PART_SIZE - 1) // UPLOAD_PART_SIZE
+    if part_count > MAX_UPLOAD_PARTS:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'File too large'})
+        }
+    
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    s3_key = f'accounting/documents/{timestamp}_{file_name}'
+    extension = file_name.split('.')[-1].lower()
+    content_type = CONTENT_TYPE_MAP.get(extension, 'application/octet-stream')
+    file_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{s3_key}"
+    
+    s3 = get_s3_client()
+    result = {'success': True, 's3Key': s3_key}
+    
+    if part_count > 1:
+        upload_id = s3.create_multipart_upload(Bucket='files', Key=s3_key, ContentType=content_type)['UploadId']
+        result['uploadId'] = upload_id
+        result['partSize'] = UPLOAD_PART_SIZE
+        result['partUrls'] = [
+            s3.generate_presigned_url('upload_part', Params={
+                'Bucket': 'files',
+                'Key': s3_key,
+                'UploadId': upload_id,
+                'PartNumber': part_number
+            }, ExpiresIn=UPLOAD_URL_TTL)
+            for part_number in range(1, part_count + 1)
+        ]
+    else:
+        result['uploadUrl'] = s3.generate_presigned_url('put_object', Params={
+            'Bucket': 'files',
+            'Key': s3_key,
+            'ContentType': content_type
+        }, ExpiresIn=UPLOAD_URL_TTL)
+    
+    result['documentId'] = create_upload_document(user_id, file_name, file_url, content_type, file_size, s3_key)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(result)
+    }
+
+
+def complete_upload(event: dict, body: dict) -> dict:
+    '''
+    Подтверждает загрузку по presigned-ссылке: собирает multipart-файл,
+    сохраняет фактический размер и контрольную сумму (ETag) объекта
+    в документе и ставит задачу OCR. Строка документа блокируется
+    на время подтверждения, повторный вызов получает 409.
+    '''
+    user_id = get_user_id(event)
+    if not user_id:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Unauthorized'})
+        }
+    
+    document_id = body.get('documentId')
+    upload_id = body.get('uploadId')
+    parts = body.get('parts') or []
+    
+    if not document_id or (upload_id and not parts):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'documentId and parts required'})
+        }
+    
+    schema = get_schema()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'''
+            SELECT s3_key, file_name, file_url, status
+            FROM {schema}accounting_documents
+            WHERE id = %s AND user_id = %s
+            FOR UPDATE
+        ''', (document_id, user_id))
+        row = cur.fetchone()
+        if not row:
+            cur.close()
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Document not found'})
+            }
+        
+        s3_key, file_name, file_url, status = row
+        if status != 'uploading':
+            cur.close()
+            return {
+                'statusCode': 409,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Upload already completed'})
+            }
+        
+        s3 = get_s3_client()
+        try:
+            if upload_id:
+                s3.complete_multipart_upload(
+                    Bucket='files',
+                    Key=s3_key,
+                    UploadId=upload_id,
+                    MultipartUpload={'Parts': [
+                        {'PartNumber': int(part['partNumber']), 'ETag': part['etag']}
+                        for part in parts
+                    ]}
+                )
+            head = s3.head_object(Bucket='files', Key=s3_key)
+        except ClientError as e:
+            cur.close()
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'File not uploaded: {str(e)}'})
+            }
+        
+        file_size = head['ContentLength']
+        checksum = head['ETag'].strip('"')
+        enqueue_ocr = file_name.split('.')[-1].lower() in OCR_EXTENSIONS
+        
+        cur.execute(f'''
+            WITH doc AS (
+                UPDATE {schema}accounting_documents
+                SET file_size = %s, checksum = %s, status = 'pending'
+                WHERE id = %s AND status = 'uploading'
+                RETURNING id
+            ), job AS (
+                INSERT INTO {schema}ocr_jobs (document_id)
+                SELECT id FROM doc WHERE %s
+                RETURNING id
+            )
+            SELECT (SELECT COUNT(*) FROM job)
+        ''', (file_size, checksum, document_id, enqueue_ocr))
+        queued = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'fileUrl': file_url,
+            'fileName': file_name,
+            'fileSize': file_size,
+            'checksum': checksum,
+            'uploadedAt': datetime.now().isoformat(),
+            'documentId': document_id,
+            'ocrStatus': 'pending' if queued else None
+        })
+    }
@@ -1,10 +1,86 @@
 import json
 import os
+import time
 import psycopg2
+from psycopg2 import extensions, pool
+from contextlib import contextmanager
+from typing import Optional, Dict, List
 from datetime import datetime
 import hashlib
 import secrets
 
+
+_db_pool: Optional[pool.ThreadedConnectionPool] = None
+_db_conn_meta: Dict[int, List[float]] = {}
+
+
+def get_db_pool() -> pool.ThreadedConnectionPool:
+    """Пул подключений к БД, переживающий тёплые вызовы функции"""
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = pool.ThreadedConnectionPool(
+            int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            int(os.environ.get("DB_POOL_MAX_SIZE", "5")),
+            os.environ["DATABASE_URL"]
+        )
+        _db_conn_meta.clear()
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: не закрыто, не старше
+    DB_CONN_MAX_LIFETIME секунд, а после простоя дольше DB_CONN_PING_AFTER
+    секунд отвечает на SELECT 1
+    """
+    if conn.closed:
+        return False
+    
+    now = time.monotonic()
+    created_at, last_used_at = _db_conn_meta.setdefault(id(conn), [now, now])
+    if now - created_at > float(os.environ.get("DB_CONN_MAX_LIFETIME", "300")):
+        return False
+    
+    if now - last_used_at > float(os.environ.get("DB_CONN_PING_AFTER", "30")):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+@contextmanager
+def db_connection():
+    """
+    Взять подключение из пула. Незакоммиченная транзакция откатывается
+    при выходе из блока, подключение возвращается в пул.
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    while not is_connection_healthy(conn):
+        _db_conn_meta.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+    
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        if broken:
+            _db_conn_meta.pop(id(conn), None)
+        else:
+            _db_conn_meta[id(conn)][1] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+
+
 def handler(event: dict, context) -> dict:
     """Проверка SMS-кода и создание сессии с привязкой ИИ-агента"""
     
@@ -43,92 +119,88 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT code, expires_at FROM sms_codes 
-            WHERE phone = %s
-        """, (phone,))
-        
-        result = cur.fetchone()
-        
-        if not result:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Code not found'}),
-                'isBase64Encoded': False
-            }
-        
-        stored_code, expires_at = result
-        
-        if datetime.fromisoformat(expires_at) < datetime.now():
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Code expired'}),
-                'isBase64Encoded': False
-            }
-        
-        if stored_code != code:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            cur.execute("""
+                SELECT code, expires_at FROM sms_codes 
+                WHERE phone = %s
+            """, (phone,))
+            
+            result = cur.fetchone()
+            
+            if not result:
+                cur.close()
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Code not found'}),
+                    'isBase64Encoded': False
+                }
+            
+            stored_code, expires_at = result
+            
+            if datetime.fromisoformat(expires_at) < datetime.now():
+                cur.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Code expired'}),
+                    'isBase64Encoded': False
+                }
+            
+            if stored_code != code:
+                cur.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid code'}),
+                    'isBase64Encoded': False
+                }
+            
+            cur.execute("""
+                SELECT id, agent_id FROM users WHERE phone = %s
+            """, (phone,))
+            
+            user = cur.fetchone()
+            
+            if user:
+                user_id, agent_id = user
+            else:
+                agent_id = f"agent_{secrets.token_hex(16)}"
+                
+                cur.execute("""
+                    INSERT INTO users (phone, agent_id, created_at)
+                    VALUES (%s, %s, %s)
+                    RETURNING id
+                """, (phone, agent_id, datetime.now().isoformat()))
+                
+                user_id = cur.fetchone()[0]
+            
+            token = secrets.token_urlsafe(32)
+            token_hash = hashlib.sha256(token.encode()).hexdigest()
+            
+            cur.execute("""
+                INSERT INTO user_sessions (user_id, token_hash, created_at, expires_at)
+                VALUES (%s, %s, %s, %s)
+            """, (user_id, token_hash, datetime.now().isoformat(), 
+                  (datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)).isoformat()))
+            
+            conn.commit()
             cur.close()
-            conn.close()
+            
             return {
-                'statusCode': 400,
+                'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid code'}),
+                'body': json.dumps({
+                    'success': True,
+                    'token': token,
+                    'agent_id': agent_id,
+                    'user_id': user_id
+                }),
                 'isBase64Encoded': False
             }
-        
-        cur.execute("""
-            SELECT id, agent_id FROM users WHERE phone = %s
-        """, (phone,))
-        
-        user = cur.fetchone()
-        
-        if user:
-            user_id, agent_id = user
-        else:
-            agent_id = f"agent_{secrets.token_hex(16)}"
             
-            cur.execute("""
-                INSERT INTO users (phone, agent_id, created_at)
-                VALUES (%s, %s, %s)
-                RETURNING id
-            """, (phone, agent_id, datetime.now().isoformat()))
-            
-            user_id = cur.fetchone()[0]
-        
-        token = secrets.token_urlsafe(32)
-        token_hash = hashlib.sha256(token.encode()).hexdigest()
-        
-        cur.execute("""
-            INSERT INTO user_sessions (user_id, token_hash, created_at, expires_at)
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, token_hash, datetime.now().isoformat(), 
-              (datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)).isoformat()))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'token': token,
-                'agent_id': agent_id,
-                'user_id': user_id
-            }),
-            'isBase64Encoded': False
-        }
-        
     except Exception as e:
         return {
             'statusCode': 500,
@@ -0,0 +1,23 @@
+-- Ранги статуса и приоритета задач для keyset-пагинации списка задач
+ALTER TABLE t_p37682378_remont_pod_klyuch.accountant_tasks
+    ADD COLUMN IF NOT EXISTS status_rank SMALLINT GENERATED ALWAYS AS (
+        CASE status
+            WHEN 'in_progress' THEN 1
+            WHEN 'pending' THEN 2
+            ELSE 3
+        END
+    ) STORED;
+
+ALTER TABLE t_p37682378_remont_pod_klyuch.accountant_tasks
+    ADD COLUMN IF NOT EXISTS priority_rank SMALLINT GENERATED ALWAYS AS (
+        CASE priority
+            WHEN 'urgent' THEN 1
+            WHEN 'high' THEN 2
+            WHEN 'medium' THEN 3
+            ELSE 4
+        END
+    ) STORED;
+
+-- Индекс повторяет порядок сортировки списка: срок без даты идёт последним
+CREATE INDEX IF NOT EXISTS idx_accountant_tasks_keyset ON t_p37682378_remont_pod_klyuch.accountant_tasks
+    (user_id, status_rank, priority_rank, (COALESCE(due_date, 'infinity'::timestamp)), id);
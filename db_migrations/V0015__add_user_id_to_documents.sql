@@ -0,0 +1,6 @@
+-- Привязка документов к загрузившему пользователю
+ALTER TABLE t_p37682378_remont_pod_klyuch.accounting_documents ADD COLUMN IF NOT EXISTS user_id INTEGER;
+
+-- Индекс для постраничного списка документов пользователя (новые первыми)
+CREATE INDEX IF NOT EXISTS idx_documents_user_uploaded ON t_p37682378_remont_pod_klyuch.accounting_documents
+    (user_id, uploaded_at DESC, id DESC);
@@ -0,0 +1,6 @@
+-- Ключ объекта в S3 и контрольная сумма для загрузки документов по presigned-ссылкам
+ALTER TABLE t_p37682378_remont_pod_klyuch.accounting_documents ADD COLUMN IF NOT EXISTS s3_key TEXT;
+ALTER TABLE t_p37682378_remont_pod_klyuch.accounting_documents ADD COLUMN IF NOT EXISTS checksum VARCHAR(128);
+
+-- Файлы, загруженные по частям, могут быть больше 2 ГБ
+ALTER TABLE t_p37682378_remont_pod_klyuch.accounting_documents ALTER COLUMN file_size TYPE BIGINT;
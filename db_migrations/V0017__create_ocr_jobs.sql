@@ -0,0 +1,20 @@
+-- Результаты распознавания документов
+ALTER TABLE t_p37682378_remont_pod_klyuch.accounting_documents ADD COLUMN IF NOT EXISTS extracted_data JSONB;
+ALTER TABLE t_p37682378_remont_pod_klyuch.accounting_documents ADD COLUMN IF NOT EXISTS ocr_error TEXT;
+
+-- Очередь фоновых задач OCR (разбирается воркером parse-document-ocr через SKIP LOCKED)
+CREATE TABLE IF NOT EXISTS t_p37682378_remont_pod_klyuch.ocr_jobs (
+    id SERIAL PRIMARY KEY,
+    document_id INTEGER NOT NULL REFERENCES t_p37682378_remont_pod_klyuch.accounting_documents(id),
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ocr_jobs_pending ON t_p37682378_remont_pod_klyuch.ocr_jobs(run_after) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_ocr_jobs_processing ON t_p37682378_remont_pod_klyuch.ocr_jobs(locked_at) WHERE status = 'processing';
+CREATE INDEX IF NOT EXISTS idx_ocr_jobs_document ON t_p37682378_remont_pod_klyuch.ocr_jobs(document_id);
@@ -0,0 +1,9 @@
+-- Кэш результатов OCR по SHA-256 содержимого файла: повторная загрузка того же документа не вызывает OCR API
+CREATE TABLE IF NOT EXISTS t_p37682378_remont_pod_klyuch.ocr_result_cache (
+    content_hash CHAR(64) PRIMARY KEY,
+    raw_text TEXT NOT NULL,
+    extracted_data JSONB,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP
+);
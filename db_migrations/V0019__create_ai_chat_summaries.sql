@@ -0,0 +1,12 @@
+-- Скользящее краткое содержание чата с AI: в промпт идёт сводка плюс последние сообщения,
+-- а не вся история. last_message_id - последнее сообщение, уже вошедшее в сводку
+CREATE TABLE IF NOT EXISTS t_p37682378_remont_pod_klyuch.ai_chat_summaries (
+    user_id INTEGER PRIMARY KEY,
+    summary TEXT NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    summarized_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Выборка ещё не вошедших в сводку сообщений пользователя
+CREATE INDEX IF NOT EXISTS idx_ai_chat_user_id_id ON t_p37682378_remont_pod_klyuch.ai_chat_messages (user_id, id);
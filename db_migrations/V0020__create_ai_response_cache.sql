@@ -0,0 +1,14 @@
+-- Кэш ответов AI на частые вопросы: ключ - SHA-256 версии промпта и нормализованного вопроса,
+-- поэтому при смене промпта старые ответы перестают находиться и удаляются по истечении expires_at
+CREATE TABLE IF NOT EXISTS t_p37682378_remont_pod_klyuch.ai_response_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    prompt_version VARCHAR(32) NOT NULL,
+    question TEXT NOT NULL,
+    response TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_ai_response_cache_expires ON t_p37682378_remont_pod_klyuch.ai_response_cache (expires_at);
@@ -0,0 +1,34 @@
+-- История агента и users.agent_id используются функциями ai-agent-chat и verify-sms, но ни одна
+-- миграция их не создавала: на новой базе они создаются здесь, на существующей ничего не меняется
+ALTER TABLE t_p37682378_remont_pod_klyuch.users ADD COLUMN IF NOT EXISTS agent_id VARCHAR(100);
+
+-- created_at — TIMESTAMP без часового пояса, как в ai_chat_messages: функции передают
+-- datetime (раньше — строку isoformat), Postgres приводит её к timestamp при вставке
+CREATE TABLE IF NOT EXISTS t_p37682378_remont_pod_klyuch.agent_history (
+    id SERIAL PRIMARY KEY,
+    agent_id VARCHAR(100) NOT NULL,
+    user_id INTEGER REFERENCES t_p37682378_remont_pod_klyuch.users(id),
+    message_type VARCHAR(20) NOT NULL,
+    message_text TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Если на существующей базе created_at хранится строкой, переводим его в TIMESTAMP:
+-- по нему сортируются последние сообщения и секционируется таблица (V0022)
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 't_p37682378_remont_pod_klyuch' AND table_name = 'agent_history'
+          AND column_name = 'created_at' AND data_type IN ('text', 'character varying')
+    ) THEN
+        ALTER TABLE t_p37682378_remont_pod_klyuch.agent_history
+            ALTER COLUMN created_at TYPE TIMESTAMP USING created_at::timestamp;
+    END IF;
+END $$;
+
+-- Последние сообщения агента: WHERE agent_id = ... ORDER BY created_at DESC LIMIT 10 читается по индексу без сортировки
+CREATE INDEX IF NOT EXISTS idx_agent_history_agent_created ON t_p37682378_remont_pod_klyuch.agent_history (agent_id, created_at DESC);
+
+-- Поиск пользователя по agent_id в том же запросе
+CREATE INDEX IF NOT EXISTS idx_users_agent_id ON t_p37682378_remont_pod_klyuch.users (agent_id);
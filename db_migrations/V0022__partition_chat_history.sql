@@ -0,0 +1,72 @@
+-- Помесячное секционирование истории чатов по created_at.
+-- Таблицы пересоздаются как секционированные, данные переносятся, секции создаются
+-- с месяца самой старой записи и на два месяца вперёд; дальше их создаёт функция chat-retention
+-- Ключ секционирования created_at — TIMESTAMP в обеих таблицах (для agent_history это обеспечивает V0021).
+-- Отсутствующая или уже секционированная таблица пропускается
+DO $$
+DECLARE
+    tbl TEXT;
+    seq RECORD;
+    month_start DATE;
+    last_month DATE := date_trunc('month', CURRENT_DATE) + INTERVAL '2 months';
+BEGIN
+    FOREACH tbl IN ARRAY ARRAY['ai_chat_messages', 'agent_history'] LOOP
+        IF to_regclass(format('t_p37682378_remont_pod_klyuch.%I', tbl)) IS NULL THEN
+            RAISE NOTICE 'Table % does not exist, skipping', tbl;
+            CONTINUE;
+        END IF;
+        IF EXISTS (
+            SELECT 1 FROM pg_partitioned_table
+            WHERE partrelid = format('t_p37682378_remont_pod_klyuch.%I', tbl)::regclass
+        ) THEN
+            CONTINUE;
+        END IF;
+
+        EXECUTE format('ALTER TABLE t_p37682378_remont_pod_klyuch.%I RENAME TO %I', tbl, tbl || '_unpartitioned');
+        EXECUTE format(
+            'CREATE TABLE t_p37682378_remont_pod_klyuch.%I (LIKE t_p37682378_remont_pod_klyuch.%I INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)',
+            tbl, tbl || '_unpartitioned'
+        );
+
+        -- Последовательности id переходят к новой таблице, иначе удалятся вместе со старой
+        FOR seq IN
+            SELECT s.relname, a.attname
+            FROM pg_depend d
+            JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+            JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+            WHERE d.refobjid = format('t_p37682378_remont_pod_klyuch.%I', tbl || '_unpartitioned')::regclass
+              AND d.deptype = 'a'
+        LOOP
+            EXECUTE format('ALTER SEQUENCE t_p37682378_remont_pod_klyuch.%I OWNED BY t_p37682378_remont_pod_klyuch.%I.%I', seq.relname, tbl, seq.attname);
+        END LOOP;
+
+        EXECUTE format(
+            'SELECT COALESCE(date_trunc(''month'', MIN(created_at)), date_trunc(''month'', CURRENT_DATE)) FROM t_p37682378_remont_pod_klyuch.%I',
+            tbl || '_unpartitioned'
+        ) INTO month_start;
+
+        WHILE month_start <= last_month LOOP
+            EXECUTE format(
+                'CREATE TABLE t_p37682378_remont_pod_klyuch.%I PARTITION OF t_p37682378_remont_pod_klyuch.%I FOR VALUES FROM (%L) TO (%L)',
+                tbl || '_p' || to_char(month_start, 'YYYY_MM'), tbl, month_start, (month_start + INTERVAL '1 month')::date
+            );
+            month_start := month_start + INTERVAL '1 month';
+        END LOOP;
+
+        EXECUTE format('CREATE TABLE t_p37682378_remont_pod_klyuch.%I PARTITION OF t_p37682378_remont_pod_klyuch.%I DEFAULT', tbl || '_default', tbl);
+
+        EXECUTE format('INSERT INTO t_p37682378_remont_pod_klyuch.%I SELECT * FROM t_p37682378_remont_pod_klyuch.%I', tbl, tbl || '_unpartitioned');
+        EXECUTE format('DROP TABLE t_p37682378_remont_pod_klyuch.%I', tbl || '_unpartitioned');
+    END LOOP;
+END $$;
+
+ALTER TABLE t_p37682378_remont_pod_klyuch.ai_chat_messages ADD PRIMARY KEY (id, created_at);
+ALTER TABLE t_p37682378_remont_pod_klyuch.ai_chat_messages ADD FOREIGN KEY (user_id) REFERENCES t_p37682378_remont_pod_klyuch.users(id);
+
+-- Индексы создаются на родительской таблице и наследуются каждой секцией
+-- "Последние N сообщений пользователя" читаются одним индексом
+CREATE INDEX IF NOT EXISTS idx_ai_chat_user_created ON t_p37682378_remont_pod_klyuch.ai_chat_messages (user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_ai_chat_user_id_id ON t_p37682378_remont_pod_klyuch.ai_chat_messages (user_id, id);
+
+CREATE INDEX IF NOT EXISTS idx_agent_history_agent_created ON t_p37682378_remont_pod_klyuch.agent_history (agent_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_agent_history_user_created ON t_p37682378_remont_pod_klyuch.agent_history (user_id, created_at DESC);
@@ -0,0 +1,5 @@
+-- Пачка кодов, выпущенных одним запросом (корпоративное подключение), для повторной выгрузки в CSV
+ALTER TABLE t_p37682378_remont_pod_klyuch.activation_codes ADD COLUMN IF NOT EXISTS batch_id UUID;
+
+CREATE INDEX IF NOT EXISTS idx_activation_codes_batch ON t_p37682378_remont_pod_klyuch.activation_codes (batch_id)
+    WHERE batch_id IS NOT NULL;
@@ -0,0 +1,9 @@
+-- Кто выпустил код (user_id - кто его активировал).
+-- Для кодов, выпущенных раньше, эмитент нигде не записан и восстановить его нельзя:
+-- они остаются с issued_by IS NULL, и их действующие коды показываются администраторам кодов
+ALTER TABLE t_p37682378_remont_pod_klyuch.activation_codes
+    ADD COLUMN IF NOT EXISTS issued_by INTEGER REFERENCES t_p37682378_remont_pod_klyuch.users(id);
+
+-- Действующие коды, выпущенные пользователем: частичный индекс только по неактивированным
+CREATE INDEX IF NOT EXISTS idx_activation_codes_issuer_active ON t_p37682378_remont_pod_klyuch.activation_codes (issued_by, created_at DESC)
+    WHERE user_id IS NULL AND used_at IS NULL;
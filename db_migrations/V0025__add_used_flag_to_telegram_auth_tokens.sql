@@ -0,0 +1,4 @@
+-- Флаг использования токена авторизации: функция telegram-auth гасит токен условием used = FALSE
+ALTER TABLE t_p37682378_remont_pod_klyuch.telegram_auth_tokens ADD COLUMN IF NOT EXISTS used BOOLEAN NOT NULL DEFAULT FALSE;
+
+UPDATE t_p37682378_remont_pod_klyuch.telegram_auth_tokens SET used = TRUE WHERE used_at IS NOT NULL AND used = FALSE;
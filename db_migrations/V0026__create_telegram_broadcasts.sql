@@ -0,0 +1,28 @@
+-- Рассылки через Telegram-бота: сообщение и очередь получателей (разбирается воркером telegram-bot через SKIP LOCKED)
+CREATE TABLE IF NOT EXISTS t_p37682378_remont_pod_klyuch.telegram_broadcasts (
+    id SERIAL PRIMARY KEY,
+    text TEXT NOT NULL,
+    parse_mode VARCHAR(20),
+    segment VARCHAR(50),
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    total INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS t_p37682378_remont_pod_klyuch.telegram_broadcast_recipients (
+    id SERIAL PRIMARY KEY,
+    broadcast_id INTEGER NOT NULL REFERENCES t_p37682378_remont_pod_klyuch.telegram_broadcasts(id),
+    chat_id VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    message_id BIGINT,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_at TIMESTAMP,
+    sent_at TIMESTAMP,
+    UNIQUE (broadcast_id, chat_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending ON t_p37682378_remont_pod_klyuch.telegram_broadcast_recipients(run_after) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_processing ON t_p37682378_remont_pod_klyuch.telegram_broadcast_recipients(locked_at) WHERE status = 'processing';
@@ -138,6 +138,7 @@ export function useTelegramAuth(options: UseTelegramAuthOptions): UseTelegramAut
 
       const data = await response.json();
       setAccessToken(data.access_token);
+      setStoredRefreshToken(data.refresh_token);
       setUser(data.user);
       scheduleRefresh(data.expires_in, refreshTokenFn);
       return true;